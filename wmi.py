@@ -96,14 +96,50 @@ __license__ = "http://www.opensource.org/licenses/mit-license.php"
 _DEBUG = False
 
 import sys
+import bisect
+import collections
 import csv
 import datetime
+import gzip
+import hashlib
+import json
+import mmap
+import numbers
+import os
+import random
 import re
 import struct
+import threading
+import time
 import warnings
 
-from win32com.client import GetObject, Dispatch
-import pywintypes
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+try:
+    from win32com.client import GetObject, Dispatch, DispatchWithEvents
+    import pythoncom
+    import pywintypes
+    import win32event
+except ImportError:
+    #
+    # Nothing here can talk to WMI without pywin32, but events
+    # recorded on Windows can still be replayed (see :func:`replay`),
+    # so that code which consumes them can be run anywhere else. On
+    # Windows pywin32 is simply missing, so say so.
+    #
+    if sys.platform == "win32":
+        raise
+    GetObject = Dispatch = DispatchWithEvents = pythoncom = win32event = None
+    class pywintypes(object):
+        class com_error(Exception):
+            pass
 
 def signed_to_unsigned(signed):
     """Convert a (possibly signed) long to unsigned hex. Useful
@@ -152,6 +188,55 @@ class SelfDeprecatingDict(object):
         except TypeError:
             return self.dict[item]
 
+class SelfDeprecatingSet(object):
+    """An immutable set of names which can also be read as a sorted
+    `list` or -- during the same interregnum as :class:`SelfDeprecatingDict`,
+    and issuing the same `DeprecationWarning` -- as a `dict` mapping each
+    name to `None`. Membership, iteration and indexing use the set and
+    sorted tuple built when it's created; nothing is copied on access.
+    """
+
+    dict_only = set(dir(dict)).difference(dir(list))
+
+    def __init__(self, names):
+        self.set = frozenset(names)
+        self.list = tuple(sorted(self.set))
+        self._dict = None
+
+    def __getattr__(self, attribute):
+        if attribute in self.dict_only:
+            warnings.warn("In future this will be a list and not a dictionary", DeprecationWarning)
+            if self._dict is None:
+                self._dict = dict.fromkeys(self.list)
+            return getattr(self._dict, attribute)
+        else:
+            return getattr(self.list, attribute)
+
+    def __contains__(self, name):
+        return name in self.set
+
+    def __iter__(self):
+        return iter(self.list)
+
+    def __len__(self):
+        return len(self.list)
+
+    def __str__(self):
+        return str(list(self.list))
+
+    def __repr__(self):
+        return repr(list(self.list))
+
+    def __getitem__(self, item):
+        if isinstance(item, numbers.Integral):
+            return self.list[item]
+        elif isinstance(item, slice):
+            return list(self.list[item])
+        warnings.warn("In future this will be a list and not a dictionary", DeprecationWarning)
+        if item in self.set:
+            return None
+        raise KeyError(item)
+
 class ProvideConstants(object):
     """When called on a ``win32com.client.Dispatch`` object,
     provides lazy access to constants defined in the typelib.
@@ -171,13 +256,39 @@ class ProvideConstants(object):
          raise AttributeError(name)
         return result[1].value
 
-obj = GetObject("winmgmts:")
-ProvideConstants(obj)
-
-wbemErrInvalidQuery = obj._constants.wbemErrInvalidQuery
-wbemErrTimedout = obj._constants.wbemErrTimedout
-wbemFlagReturnImmediately = obj._constants.wbemFlagReturnImmediately
-wbemFlagForwardOnly = obj._constants.wbemFlagForwardOnly
+if GetObject is not None:
+    obj = GetObject("winmgmts:")
+    ProvideConstants(obj)
+
+    wbemErrInvalidQuery = obj._constants.wbemErrInvalidQuery
+    wbemErrTimedout = obj._constants.wbemErrTimedout
+    wbemFlagReturnImmediately = obj._constants.wbemFlagReturnImmediately
+    wbemFlagForwardOnly = obj._constants.wbemFlagForwardOnly
+    wbemErrQuotaViolation = obj._constants.wbemErrQuotaViolation
+    wbemErrServerTooBusy = obj._constants.wbemErrServerTooBusy
+    wbemErrProviderLoadFailure = obj._constants.wbemErrProviderLoadFailure
+    wbemErrTransportFailure = obj._constants.wbemErrTransportFailure
+    wbemErrShuttingDown = obj._constants.wbemErrShuttingDown
+    wbemErrNotFound = obj._constants.wbemErrNotFound
+    wbemErrInvalidClass = obj._constants.wbemErrInvalidClass
+    wbemChangeFlagCreateOrUpdate = obj._constants.wbemChangeFlagCreateOrUpdate
+    wbemChangeFlagUpdateOnly = obj._constants.wbemChangeFlagUpdateOnly
+    wbemChangeFlagCreateOnly = obj._constants.wbemChangeFlagCreateOnly
+else:
+    wbemErrInvalidQuery = -2147217385 # 0x80041017
+    wbemErrTimedout = -2147209215 # 0x80043001
+    wbemFlagReturnImmediately = 16
+    wbemFlagForwardOnly = 32
+    wbemErrQuotaViolation = -2147217300 # 0x8004106C
+    wbemErrServerTooBusy = -2147217339 # 0x80041045
+    wbemErrProviderLoadFailure = -2147217389 # 0x80041013
+    wbemErrTransportFailure = -2147217387 # 0x80041015
+    wbemErrShuttingDown = -2147217357 # 0x80041033
+    wbemErrNotFound = -2147217406 # 0x80041002
+    wbemErrInvalidClass = -2147217392 # 0x80041010
+    wbemChangeFlagCreateOrUpdate = 0
+    wbemChangeFlagUpdateOnly = 1
+    wbemChangeFlagCreateOnly = 2
 
 #
 # Exceptions
@@ -225,6 +336,21 @@ class x_wmi_uninitialised_thread(x_wmi):
     """
     pass
 
+class x_wmi_circuit_open(x_wmi):
+    """Raised without contacting the host when recent calls to it
+    have failed often enough for its circuit breaker to open
+    """
+    pass
+
+class x_wmi_write_failed(x_wmi):
+    """Raised when some of the objects in a batch of deferred writes
+    could not be written. The objects and their exceptions are held,
+    as a list of tuples, in :attr:`failures`.
+    """
+    def __init__(self, info="", com_error=None, failures=[]):
+        x_wmi.__init__(self, info, com_error)
+        self.failures = failures
+
 WMI_EXCEPTIONS = {
     signed_to_unsigned(wbemErrInvalidQuery) : x_wmi_invalid_query,
     signed_to_unsigned(wbemErrTimedout) : x_wmi_timed_out,
@@ -257,6 +383,21 @@ def handle_com_error(err=None):
         klass = x_wmi
     raise klass(com_error=err)
 
+def _com_error_codes(err):
+    """Return the HRESULT and (if there is one) the SCODE of a COM error
+    as unsigned numbers. `err` can be a `pywintypes.com_error` or an
+    :exc:`x_wmi` wrapping one; for anything else, both are None.
+    """
+    if isinstance(err, x_wmi):
+        err = err.com_error
+    if not isinstance(err, pywintypes.com_error):
+        return None, None
+    hresult_code, hresult_name, additional_info, parameter_in_error = err.args
+    scode = None
+    if additional_info:
+        scode = signed_to_unsigned(additional_info[5])
+    return signed_to_unsigned(hresult_code), scode
+
 
 BASE = datetime.datetime(1601, 1, 1)
 def from_1601(ns100):
@@ -402,6 +543,13 @@ class _wmi_method(object):
                 self.out_parameter_names = []
             else:
                 self.out_parameter_names = [(i.Name, i.IsArray) for i in self.out_parameters.Properties_]
+            #
+            # Map each in parameter's name to its position among the
+            # parameter object's properties and whether it's an array
+            #
+            self._in_parameter_index = dict(
+                (name, (n, is_array)) for (n, (name, is_array)) in enumerate(self.in_parameter_names)
+            )
 
             doc = "%s (%s) => (%s)" % (
                 method_name,
@@ -419,58 +567,73 @@ class _wmi_method(object):
         """Execute the call to a WMI method, returning
         a tuple (even if is of only one value) containing
         the out and return parameters.
+
+        Each call fills in its own copy of the in parameters, so the
+        same method can be called from several threads at once.
         """
         try:
             if self.in_parameters:
-                parameter_names = {}
-                for name, is_array in self.in_parameter_names:
-                    parameter_names[name] = is_array
+                parameters = self.in_parameters.SpawnInstance_()
+                self._set_parameters(parameters, args, kwargs)
+                result = self.ole_object.ExecMethod_(self.method.Name, parameters)
+            else:
+                result = self.ole_object.ExecMethod_(self.method.Name)
+            return self._out_values(result)
 
-                parameters = self.in_parameters
+        except pywintypes.com_error:
+            handle_com_error()
 
-                #
-                # Check positional parameters first
-                #
-                for n_arg in range(len(args)):
-                    arg = args[n_arg]
-                    parameter = parameters.Properties_[n_arg]
-                    if parameter.IsArray:
-                        try: list(arg)
-                        except TypeError: raise TypeError("parameter %d must be iterable" % n_arg)
-                    parameter.Value = arg
+    def _set_parameters(self, parameters, args, kwargs):
+        """Check the positional and keyword arguments against the
+        method's signature and set them on `parameters`, an instance
+        of its in-parameters.
+        """
+        properties = list(parameters.Properties_)
 
-                #
-                # If any keyword param supersedes a positional one,
-                # it'll simply overwrite it.
-                #
-                for k, v in kwargs.items():
-                    is_array = parameter_names.get(k)
-                    if is_array is None:
-                        raise AttributeError("%s is not a valid parameter for %s" %(k, self.__doc__))
-                    else:
-                        if is_array:
-                            try: list(v)
-                            except TypeError: raise TypeError("%s must be iterable" % k)
-                    parameters.Properties_(k).Value = v
+        #
+        # Check positional parameters first
+        #
+        for n_arg in range(len(args)):
+            arg = args[n_arg]
+            if self.in_parameter_names[n_arg][1]:
+                try: list(arg)
+                except TypeError: raise TypeError("parameter %d must be iterable" % n_arg)
+            properties[n_arg].Value = arg
 
-                result = self.ole_object.ExecMethod_(self.method.Name, self.in_parameters)
+        #
+        # If any keyword param supersedes a positional one,
+        # it'll simply overwrite it.
+        #
+        for k, v in kwargs.items():
+            n_arg, is_array = self._in_parameter_index.get(k, (None, None))
+            if n_arg is None:
+                raise AttributeError("%s is not a valid parameter for %s" %(k, self.__doc__))
             else:
-                result = self.ole_object.ExecMethod_(self.method.Name)
-
-            results = []
-            for name, is_array in self.out_parameter_names:
-                value = result.Properties_(name).Value
                 if is_array:
-                    #
-                    # Thanks to Jonas Bjering for bug report and patch
-                    #
-                    results.append(list(value or []))
-                else:
-                    results.append(value)
-            return tuple(results)
+                    try: list(v)
+                    except TypeError: raise TypeError("%s must be iterable" % k)
+            properties[n_arg].Value = v
 
-        except pywintypes.com_error:
-            handle_com_error()
+    def _out_values(self, result):
+        """Return the out parameters of a method's result as a tuple. A
+        method with no out parameters has no result to read them from.
+        """
+        if not self.out_parameter_names:
+            return ()
+        properties = list(result.Properties_)
+        if len(properties) != len(self.out_parameter_names):
+            properties = [result.Properties_(name) for name, is_array in self.out_parameter_names]
+        results = []
+        for (name, is_array), property in zip(self.out_parameter_names, properties):
+            value = property.Value
+            if is_array:
+                #
+                # Thanks to Jonas Bjering for bug report and patch
+                #
+                results.append(list(value or []))
+            else:
+                results.append(value)
+        return tuple(results)
 
     def __repr__(self):
         return "<function %s>" % self.__doc__
@@ -494,6 +657,44 @@ class _wmi_property(object):
     def __getattr__(self, attr):
         return getattr(self.property, attr)
 
+_KEYS_REGISTRY_SIZE = 1024
+_keys_registry = collections.OrderedDict()
+_keys_registry_lock = threading.Lock()
+def _class_keys(ole_object):
+    """Return the names of the key properties of the class of `ole_object`,
+    a class or an instance. They're found from the properties' qualifiers
+    the first time each class is seen on each host and namespace and are
+    remembered in `_keys_registry`, which holds the most recently used
+    `_KEYS_REGISTRY_SIZE` classes so that it doesn't grow without bound
+    in a process which visits many hosts.
+    """
+    try:
+        path = ole_object.Path_
+        registry_key = (path.Server.lower(), path.Namespace.lower(), path.Class.lower())
+        with _keys_registry_lock:
+            keys = _keys_registry.pop(registry_key, None)
+            if keys is not None:
+                _keys_registry[registry_key] = keys
+        if keys is None:
+            #
+            # NB You can get the keys of an instance more directly, via
+            # Path\_.Keys but this doesn't apply to classes. The technique
+            # here appears to work for both.
+            #
+            keys = tuple(
+                property.Name
+                    for property in ole_object.Properties_
+                    for qualifier in property.Qualifiers_
+                    if qualifier.Name == "key" and qualifier.Value
+            )
+            with _keys_registry_lock:
+                _keys_registry[registry_key] = keys
+                while len(_keys_registry) > _KEYS_REGISTRY_SIZE:
+                    _keys_registry.popitem(last=False)
+        return keys
+    except pywintypes.com_error:
+        handle_com_error()
+
 #
 # class _wmi_object
 #
@@ -613,7 +814,7 @@ class _wmi_object(object):
             if attribute in self.properties:
                 self._cached_properties(attribute).set(value)
                 if self.ole_object.Path_.Path:
-                    self.ole_object.Put_()
+                    self._write([attribute])
             else:
                 raise AttributeError(attribute)
         except pywintypes.com_error:
@@ -641,15 +842,11 @@ class _wmi_object(object):
 
         :returns: list of key property names
         """
-        # NB You can get the keys of an instance more directly, via
-        # Path\_.Keys but this doesn't apply to classes. The technique
-        # here appears to work for both.
         if self._keys is None:
-            _set(self, "_keys", [])
-            for property in self.ole_object.Properties_:
-                for qualifier in property.Qualifiers_:
-                    if qualifier.Name == "key" and qualifier.Value:
-                        self._keys.append(property.Name)
+            if self._instance_of is not None:
+                _set(self, "_keys", list(self._instance_of.keys))
+            else:
+                _set(self, "_keys", list(_class_keys(self.ole_object)))
         return self._keys
     keys = property(_get_keys)
 
@@ -661,9 +858,21 @@ class _wmi_object(object):
 
     def put(self):
         """Push all outstanding property updates back to the
-        WMI database.
+        WMI database. Inside :func:`deferred_writes` the object
+        is only written when the batch is flushed.
+        """
+        self._write()
+
+    def _write(self, attributes=None):
+        """Write the object now or, inside :func:`deferred_writes`, when
+        the batch is flushed, noting which `attributes` have been set --
+        None meaning that it's not known which.
         """
-        self.ole_object.Put_()
+        batch = _write_batch()
+        if batch is None:
+            self.ole_object.Put_()
+        else:
+            batch.add(self, attributes)
 
     def set(self, **kwargs):
         """Set several properties of the underlying object
@@ -685,7 +894,7 @@ class _wmi_object(object):
                 #    back if the object exists.
                 #
                 if self.ole_object.Path_.Path:
-                    self.ole_object.Put_()
+                    self._write(list(kwargs))
             except pywintypes.com_error:
                 handle_com_error()
 
@@ -822,9 +1031,28 @@ class _wmi_class(_wmi_object):
         c = wmi.WMI()
         c_drives = c.Win32_LogicalDisk(Name='C:')
     """
-    def __init__(self, namespace, wmi_class):
-        _wmi_object.__init__(self, wmi_class)
-        _set(self, "_class_name", wmi_class.Path_.Class)
+    def __init__(self, namespace, wmi_class, definition=None):
+        if definition is None:
+            _wmi_object.__init__(self, wmi_class)
+            _set(self, "_class_name", wmi_class.Path_.Class)
+        else:
+            #
+            # Built from a cached :class:`_wmi_schema` definition: the
+            # class itself is only fetched if something needs it
+            #
+            _set(self, "id", definition["path"].lower())
+            _set(self, "_instance_of", None)
+            _set(self, "properties", dict.fromkeys(p[0] for p in definition["properties"]))
+            _set(self, "methods", dict.fromkeys(definition["methods"]))
+            _set(self, "property_map", {})
+            _set(self, "_associated_classes", None)
+            _set(self, "_keys", list(definition["keys"]))
+            _set(self, "_properties", self.properties.keys())
+            _set(self, "_methods", self.methods.keys())
+            _set(self, "qualifiers", dict(definition["qualifiers"]))
+            _set(self, "is_association", "Association" in self.qualifiers)
+            _set(self, "_class_name", definition["name"])
+            _set(self, "_derivation", tuple(definition["derivation"]))
         if namespace:
             _set(self, "_namespace", namespace)
         else:
@@ -842,24 +1070,35 @@ class _wmi_class(_wmi_object):
         except pywintypes.com_error:
             handle_com_error()
 
+    def _get_ole_object(self):
+        if "ole_object" not in self.__dict__:
+            try:
+                _set(self, "ole_object", self._namespace._namespace.Get(self._class_name))
+            except pywintypes.com_error:
+                handle_com_error()
+        return self.__dict__["ole_object"]
+    ole_object = property(_get_ole_object)
+
+    def derivation(self):
+        if "_derivation" in self.__dict__:
+            return self._derivation
+        index = self._namespace._known_class_index()
+        if index is not None and self._class_name in index:
+            return index.ancestors(self._class_name)
+        return _wmi_object.derivation(self)
+
+
+    def to_csv(self, filepath=None, fields=None, compress=None):
+        """Generate a csv listing all the instances of this class -- or
+        their `fields` -- with the property names as a header. The file is
+        `<class name>.csv` unless `filepath` is given. See :func:`export_csv`.
 
-    def to_csv(self, filepath=None):
-        """Generate a csv listing all the instances of this class with the class
-        name as a header.
+        :returns: the number of instances written
         """
-        def _to_utf8(item):
-            if isinstance(item, unicode):
-                return item.encode("utf-8")
-            else:
-                return str(item)
         if filepath is None:
             filepath = self._class_name + ".csv"
-        fields = list(p.Name for p in self.ole_object.Properties_)
-        with open(filepath, "wb") as f:
-            writer = csv.writer(f)
-            writer.writerow(fields)
-            for instance in self.query():
-                writer.writerow([_to_utf8(getattr(instance, field)) for field in fields])
+        path = filepath.replace("%", "%%")
+        return export_csv(self._namespace, [self._class_name], path, fields, compress)[filepath]
 
     def query(self, fields=[], **where_clause):
         """Make it slightly easier to query against the class,
@@ -888,6 +1127,11 @@ class _wmi_class(_wmi_object):
         notification_type="operation",
         delay_secs=1,
         fields=[],
+        lazy=False,
+        compact=False,
+        group_within=None,
+        group_by=None,
+        having=None,
         **where_clause
     ):
         if self._namespace is None:
@@ -902,6 +1146,44 @@ class _wmi_class(_wmi_object):
             wmi_class=self,
             delay_secs=delay_secs,
             fields=fields,
+            lazy=lazy,
+            compact=compact,
+            group_within=group_within,
+            group_by=group_by,
+            having=having,
+            **where_clause
+        )
+
+    def watch_for_async(
+        self,
+        notification_type="operation",
+        delay_secs=1,
+        fields=[],
+        timeout=None,
+        group_within=None,
+        group_by=None,
+        having=None,
+        **where_clause
+    ):
+        """Set up an asynchronous event subscription on this class: see
+        :meth:`_wmi_namespace.watch_for_async`
+        """
+        if self._namespace is None:
+            raise x_wmi_no_namespace("You cannot watch directly from a WMI class")
+
+        valid_notification_types = ("operation", "creation", "deletion", "modification")
+        if notification_type.lower () not in valid_notification_types:
+            raise x_wmi ("notification_type must be one of %s" % ", ".join (valid_notification_types))
+
+        return self._namespace.watch_for_async(
+            notification_type=notification_type,
+            wmi_class=self,
+            delay_secs=delay_secs,
+            fields=fields,
+            timeout=timeout,
+            group_within=group_within,
+            group_by=group_by,
+            having=having,
             **where_clause
         )
 
@@ -966,6 +1248,288 @@ class _wmi_result(object):
                 attr = p.Name
                 self.__dict__[attr] = obj.Properties_(attr).Value
 
+#
+# class _wmi_record
+#
+class _wmi_record(object):
+    """Base of the classes written by :func:`generate_classes`. Each
+    of those lists the properties of its WMI class in `__slots__`,
+    with a converter for each (or None) in `_converters` and the key
+    properties in `_keys`. A record holds the values of an instance's
+    properties as plain attributes, so reading them costs no more than
+    reading any other Python attribute.
+    """
+    __slots__ = ()
+    _class_name = None
+    _keys = ()
+    _converters = ()
+
+    @classmethod
+    def _from_values(cls, values):
+        record = cls.__new__(cls)
+        for name, convert, value in zip(cls.__slots__, cls._converters, values):
+            if convert is not None and value is not None:
+                value = convert(value)
+            setattr(record, name, value)
+        return record
+
+    @classmethod
+    def from_object(cls, obj):
+        """Return a record holding the values of the properties of `obj`,
+        a :class:`_wmi_object` or a raw WMI object.
+        """
+        ole_object = getattr(obj, "ole_object", obj)
+        try:
+            values = dict((p.Name, p.Value) for p in ole_object.Properties_)
+        except pywintypes.com_error:
+            handle_com_error()
+        return cls._from_values([values.get(name) for name in cls.__slots__])
+
+    def key(self):
+        """Return the values of the key properties as a tuple"""
+        return tuple(getattr(self, name) for name in self._keys)
+
+    def _identity(self):
+        if self._keys:
+            return self.key()
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self._identity() == other._identity()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self._class_name, self._identity()))
+
+    def __repr__(self):
+        return "<%s: %s>" % (
+            self._class_name,
+            ", ".join("%s=%r" % (name, getattr(self, name)) for name in self._keys)
+        )
+
+def _array_of(convert):
+    """Return a converter which applies `convert` to each item of an array"""
+    def _convert(values):
+        return [None if value is None else convert(value) for value in values]
+    return _convert
+
+#
+# Python type (for documentation) and converter (as it's written in
+# a generated module) for each CIMTYPE. 64-bit integers come back from
+# WMI as strings, and datetimes as strings of the form yyyymmddHHMMSS.mmmmmm+UUU
+#
+_cim_types = {
+    "boolean" : ("bool", None),
+    "char16" : ("int", None),
+    "datetime" : ("tuple", "wmi.to_time"),
+    "real32" : ("float", None),
+    "real64" : ("float", None),
+    "sint8" : ("int", None),
+    "sint16" : ("int", None),
+    "sint32" : ("int", None),
+    "sint64" : ("int", "int"),
+    "string" : ("str", None),
+    "uint8" : ("int", None),
+    "uint16" : ("int", None),
+    "uint32" : ("int", None),
+    "uint64" : ("int", "int"),
+}
+
+def _generate_class(definition):
+    python_types = []
+    converters = []
+    for name, cimtype, is_array in definition["properties"]:
+        python_type, converter = _cim_types.get((cimtype or "").split(":")[0], ("object", None))
+        if is_array:
+            python_type = "list"
+            if converter:
+                converter = "wmi._array_of(%s)" % converter
+        python_types.append(python_type)
+        converters.append(converter or "None")
+
+    names = [p[0] for p in definition["properties"]]
+    lines = [
+        "class %s(wmi._wmi_record):" % definition["name"],
+        '    """%s' % " <- ".join([definition["name"]] + definition["derivation"]),
+        "",
+        "    Keys: %s" % (", ".join(definition["keys"]) or "(none)"),
+        '    """',
+        "    __slots__ = (",
+    ]
+    lines.extend('        "%s",' % name for name in names)
+    lines.append("    )")
+    lines.append('    _class_name = "%s"' % definition["name"])
+    lines.append("    _keys = (%s)" % "".join('"%s", ' % key for key in definition["keys"]).rstrip())
+    lines.append("    _converters = (")
+    lines.extend(
+        "        %s, # %s: %s%s" % (converter, name, cimtype, "[]" if is_array else "")
+            for (converter, (name, cimtype, is_array)) in zip(converters, definition["properties"])
+    )
+    lines.append("    )")
+    if names:
+        lines.append("")
+        lines.append("    def __init__(")
+        lines.append("        self,")
+        lines.extend("        %s=None," % name for name in names)
+        lines.append("    ):")
+        lines.extend(
+            "        self.%s = %s # type: %s" % (name, name, python_type)
+                for (name, python_type) in zip(names, python_types)
+        )
+    return "\n".join(lines) + "\n"
+
+def generate_classes(namespace, class_names, filepath=None):
+    """Write the source of a Python module defining a class for each of
+    the WMI classes in `class_names` from `namespace`, a :class:`_wmi_namespace`.
+    Each class is a :class:`_wmi_record` with `__slots__` for the WMI
+    class's properties, a type for each property which IDEs can pick up,
+    a converter for each property whose value WMI returns as a string
+    (64-bit integers and datetimes) and a list of the key properties.
+    The definitions are taken from the namespace's :class:`_wmi_schema`
+    if it has one and otherwise from WMI. The source is returned and,
+    if `filepath` is given, written there::
+
+        c = wmi.WMI(cache_schema=True)
+        wmi.generate_classes(c, ["Win32_Process", "Win32_Service"], "cimv2.py")
+
+        import cimv2
+        for process in c.fetch_as(cimv2.Win32_Process, Name="python.exe"):
+            print(process.ProcessId, process.KernelModeTime)
+    """
+    definitions = [namespace._class_definition(class_name) for class_name in class_names]
+
+    source = [
+        '"""Classes generated by wmi.generate_classes for %s' % ", ".join(class_names),
+        "",
+        "Don't edit this module: generate it again if the classes change.",
+        '"""',
+        "import wmi",
+        "",
+    ]
+    for definition in definitions:
+        source.append("")
+        source.append(_generate_class(definition))
+    source = "\n".join(source)
+    if filepath:
+        with open(filepath, "w") as f:
+            f.write(source)
+    return source
+
+#
+# class _wmi_csv_writer
+#
+class _wmi_csv_writer(object):
+    """A buffered CSV file, gzipped if `compress` is true or, when
+    it's None, if the path ends in `.gz`, written as UTF-8 under
+    both Python 2 and Python 3. Values are written as text: None as
+    an empty string and arrays as their values separated by `;`.
+    """
+
+    BUFFER_SIZE = 1 << 16
+
+    def __init__(self, path, compress=None):
+        self.path = path
+        self.rows = 0
+        if compress is None:
+            compress = path.lower().endswith(".gz")
+        if sys.version_info[0] < 3:
+            self._encoding = "utf-8"
+            if compress:
+                self._file = gzip.open(path, "wb")
+            else:
+                self._file = open(path, "wb", self.BUFFER_SIZE)
+        else:
+            self._encoding = None
+            if compress:
+                self._file = gzip.open(path, "wt", encoding="utf-8", newline="")
+            else:
+                self._file = open(path, "w", self.BUFFER_SIZE, encoding="utf-8", newline="")
+        self._writer = csv.writer(self._file)
+
+    def __repr__(self):
+        return "<_wmi_csv_writer: %s; %d rows>" % (self.path, self.rows)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _text(self, value):
+        if value is None:
+            return ""
+        elif isinstance(value, (list, tuple)):
+            return ";".join(self._text(v) for v in value)
+        elif self._encoding and not isinstance(value, str):
+            return ("%s" % (value,)).encode(self._encoding)
+        else:
+            return "%s" % (value,)
+
+    def writerow(self, row):
+        self._writer.writerow([self._text(value) for value in row])
+        self.rows += 1
+
+    def writerows(self, rows):
+        """Write each of an iterable of rows, taking them one at a time"""
+        text = self._text
+        writerow = self._writer.writerow
+        for row in rows:
+            writerow([text(value) for value in row])
+            self.rows += 1
+
+    def close(self):
+        self._file.close()
+
+def export_csv(namespaces, class_names, filepath="%(class)s.csv", fields=None, compress=None):
+    """Write the instances of each of the WMI classes in `class_names`
+    from each of `namespaces` -- a :class:`_wmi_namespace` or a list of them,
+    eg on different hosts -- to CSV files. The rows are streamed from WMI
+    by :meth:`_wmi_namespace.stream` so memory use doesn't grow with the
+    number of instances::
+
+        hosts = [wmi.WMI(host) for host in ("srv1", "srv2", "srv3")]
+        wmi.export_csv(hosts, ["Win32_Service", "Win32_Share"], "%(class)s.csv.gz")
+
+    `filepath` is formatted with `class` and `host` to give each file;
+    rows which come out at the same path go to the same file. When there's
+    more than one namespace each row starts with the host it came from.
+    The first row of each file names the columns. `fields` can be a list of
+    properties to write for every class or a dictionary mapping class names
+    to lists; by default all of a class's properties are written. Files are
+    gzipped if `compress` is true or, when it's None, if they end in `.gz`.
+
+    :returns: a dictionary mapping each file written to its number of rows
+    """
+    if isinstance(namespaces, _wmi_namespace):
+        namespaces = [namespaces]
+    with_host = len(namespaces) > 1
+    writers = {}
+    try:
+        for class_name in class_names:
+            if isinstance(fields, dict):
+                class_fields = fields.get(class_name)
+            else:
+                class_fields = fields
+            if not class_fields:
+                class_fields = list(getattr(namespaces[0], class_name)._properties)
+            for namespace in namespaces:
+                path = filepath % {"class" : class_name, "host" : namespace.host}
+                writer = writers.get(path)
+                if writer is None:
+                    writer = writers[path] = _wmi_csv_writer(path, compress)
+                    writer.writerow((["Host"] if with_host else []) + list(class_fields))
+                rows = namespace.stream(class_name, class_fields)
+                if with_host:
+                    host = (namespace.host,)
+                    rows = (host + row for row in rows)
+                writer.writerows(rows)
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return dict((path, writer.rows - 1) for path, writer in writers.items())
+
 #
 # class WMI
 #
@@ -979,15 +1543,27 @@ class _wmi_namespace(object):
             if "user" in i.lower():
                 print(i)
     """
-    def __init__(self, namespace, find_classes):
+
+    NOT_A_CLASS = set([
+        signed_to_unsigned(wbemErrNotFound),
+        signed_to_unsigned(wbemErrInvalidClass),
+    ])
+
+    def __init__(self, namespace, find_classes, host=None, schema=None):
         _set(self, "_namespace", namespace)
         #
         # wmi attribute preserved for backwards compatibility
         #
         _set(self, "wmi", namespace)
 
+        self._host = host
+        self._schema = schema
+        self._connection = None
         self._classes = None
         self._classes_map = {}
+        self._not_classes = set()
+        self._definitions = {}
+        self._class_index = None
         #
         # Pick up the list of classes under this namespace
         #    so that they can be queried, and used as though
@@ -1007,10 +1583,80 @@ class _wmi_namespace(object):
 
     def _get_classes(self):
         if self._classes is None:
-            self._classes = self.subclasses_of()
-        return SelfDeprecatingDict(dict.fromkeys(self._classes))
+            self._classes = SelfDeprecatingSet(self.subclasses_of())
+        return self._classes
     classes = property(_get_classes)
 
+    def _get_class_index(self):
+        """The :class:`_wmi_class_index` of this namespace's classes,
+        taken from its schema if it has one and otherwise built, once,
+        from a single enumeration of all its classes.
+        """
+        if self._known_class_index() is None:
+            self._class_index = _wmi_class_index.from_services(self._namespace)
+        return self._class_index
+    class_index = property(_get_class_index)
+
+    def _known_class_index(self):
+        """Return the class index if it's already built or can be built
+        without asking WMI; otherwise None.
+        """
+        if self._class_index is None and self._schema is not None:
+            self._class_index = _wmi_class_index.from_schema(self._schema)
+        return self._class_index
+
+    def _class_definition(self, class_name):
+        """Return the definition of a class, as :meth:`_wmi_schema.definition`
+        gives it, from the namespace's schema if it has one and otherwise
+        from WMI, remembering it for next time.
+        """
+        definition = self._definitions.get(class_name)
+        if definition is None and self._schema is not None:
+            definition = self._schema.get(class_name)
+        if definition is None:
+            try:
+                definition = _wmi_schema.definition(self._namespace.Get(class_name))
+            except pywintypes.com_error:
+                handle_com_error()
+        self._definitions[class_name] = definition
+        return definition
+
+    def _connection_info(self):
+        """Return the arguments for :func:`connect` which would make another
+        connection to this namespace, eg on another thread, together with the
+        namespace's schema. If the namespace wasn't made by :func:`connect`
+        the arguments are worked out, once, from its path, with the default
+        security settings.
+        """
+        if self._connection is None:
+            try:
+                path = self._namespace.Get("__SystemClass").Path_
+                self._connection = _path_connection(path.Server, path.Namespace)
+            except pywintypes.com_error:
+                handle_com_error()
+        return dict(self._connection), self._schema
+
+    def _get_host(self):
+        """The name of the machine this namespace is on, used to pick the
+        :class:`_wmi_host_limiter` for its queries. If the namespace was
+        not made by :func:`connect` (which knows the name already) it is
+        looked up, once, from the server's copy of a system class.
+        """
+        if self._host is None:
+            try:
+                server = self._namespace.Get("__SystemClass").Path_.Server
+            except pywintypes.com_error:
+                server = ""
+            self._host = _server_host_key(server)
+        return self._host
+    host = property(_get_host)
+
+    def _limited(self, function, *args, **kwargs):
+        """Run `function` under this namespace's host limiter and
+        the module's retry policy: see :func:`_call_host`
+        """
+        return _call_host(self.host, function, *args, **kwargs)
+
     def get(self, moniker):
         try:
             return _wmi_object(self.wmi.Get(moniker))
@@ -1022,16 +1668,11 @@ class _wmi_namespace(object):
         return self._namespace
 
     def subclasses_of(self, root="", regex=r".*"):
-        try:
-            SubclassesOf = self._namespace.SubclassesOf
-        except AttributeError:
-            return set()
-        else:
-            return set(
-                c.Path_.Class
-                    for c in SubclassesOf(root)
-                    if re.match(regex, c.Path_.Class)
-            )
+        """Return the names of the classes derived from `root` -- or of
+        all the classes if `root` is empty -- which match `regex`. The
+        answer comes from the namespace's :attr:`class_index`.
+        """
+        return self.class_index.subclasses_of(root, regex)
 
     def instances(self, class_name):
         """Return a list of instances of the WMI class. This is
@@ -1042,7 +1683,7 @@ class _wmi_namespace(object):
             wmi.WMI().Win32_LogicalDisk()
         """
         try:
-            return [_wmi_object(obj) for obj in self._namespace.InstancesOf(class_name)]
+            return self._limited(lambda: [_wmi_object(obj) for obj in self._namespace.InstancesOf(class_name)])
         except pywintypes.com_error:
             handle_com_error()
 
@@ -1069,7 +1710,7 @@ class _wmi_namespace(object):
         """Perform an arbitrary query against a WMI object, and return
         a list of _wmi_object representations of the results.
         """
-        return [ _wmi_object(obj, instance_of, fields) for obj in self._raw_query(wql) ]
+        return self._limited(lambda: [_wmi_object(obj, instance_of, fields) for obj in self._raw_query(wql)])
 
     def fetch_as_classes(self, wmi_classname, fields=(), **where_clause):
         """Build and execute a wql query to fetch the specified list of fields from
@@ -1082,7 +1723,17 @@ class _wmi_namespace(object):
         wql = "SELECT %s FROM %s" %(fields and ", ".join(fields) or "*", wmi_classname)
         if where_clause:
             wql += " WHERE " + " AND ".join(["%s = '%s'" %(k, v) for k, v in where_clause.items()])
-        return [_wmi_result(obj, fields) for obj in self._raw_query(wql)]
+        return self._limited(lambda: [_wmi_result(obj, fields) for obj in self._raw_query(wql)])
+
+    def fetch_as(self, record_class, **where_clause):
+        """Query the WMI class of `record_class` -- a class written by
+        :func:`generate_classes` -- for the properties it knows about
+        and return the results as a list of `record_class` instances.
+        """
+        wql = "SELECT %s FROM %s" %(", ".join(record_class.__slots__) or "*", record_class._class_name)
+        if where_clause:
+            wql += " WHERE " + " AND ".join(["%s = '%s'" %(k, v) for k, v in where_clause.items()])
+        return self._limited(lambda: [record_class.from_object(obj) for obj in self._raw_query(wql)])
 
     def fetch_as_lists(self, wmi_classname, fields, **where_clause):
         """Build and execute a wql query to fetch the specified list of fields from
@@ -1092,10 +1743,135 @@ class _wmi_namespace(object):
         wql = "SELECT %s FROM %s" %(", ".join(fields), wmi_classname)
         if where_clause:
             wql += " WHERE " + " AND ".join(["%s = '%s'" %(k, v) for k, v in where_clause.items()])
-        results = []
-        for obj in self._raw_query(wql):
+        def _fetch():
+            results = []
+            for obj in self._raw_query(wql):
                 results.append([obj.Properties_(field).Value for field in fields])
-        return results
+            return results
+        return self._limited(_fetch)
+
+    def stream(self, wmi_class, fields=(), **where_clause):
+        """Query `wmi_class` -- a class name or a :class:`_wmi_class` --
+        for its `fields`, by default all its properties, and yield a tuple
+        of their values, in order, for each instance. Only those fields are
+        asked for, each instance's values are read in one pass, and instances
+        are handed on as WMI delivers them, so any number can be handled
+        without holding them all in memory::
+
+            c = wmi.WMI()
+            for name, pid in c.stream("Win32_Process", ["Name", "ProcessId"]):
+                print(pid, name)
+
+        Since WMI does the work of the query as the instances are read,
+        a slot in the host's limiter (see :data:`host_limits`) is held from
+        the query until the stream is exhausted or closed; only the time
+        spent waiting on WMI counts as the operation's latency. Queries
+        made against the same host from within the loop share the slot.
+        """
+        if isinstance(wmi_class, _wmi_class):
+            class_name = wmi_class._class_name
+        else:
+            class_name = wmi_class
+        fields = list(fields) or list(getattr(self, class_name)._properties)
+        wql = "SELECT %s FROM %s" %(", ".join(fields), class_name)
+        if where_clause:
+            wql += " WHERE " + " AND ".join(["%s = '%s'" %(k, v) for k, v in where_clause.items()])
+        names = [field.lower() for field in fields]
+        limiter = host_limits.for_host(self.host)
+        owner = threading.current_thread()
+
+        def query():
+            limiter.acquire()
+            started = time.time()
+            try:
+                return self._raw_query(wql), time.time() - started
+            except (pywintypes.com_error, x_wmi):
+                limiter.release(time.time() - started, sys.exc_info()[1])
+                raise
+            except:
+                limiter.release(time.time() - started)
+                raise
+
+        results, latency_secs = retry_policy.call(self.host, query)
+        error = None
+        try:
+            enumerator = iter(results)
+            while True:
+                started = time.time()
+                try:
+                    obj = next(enumerator)
+                except StopIteration:
+                    latency_secs += time.time() - started
+                    break
+                values = dict((p.Name.lower(), p.Value) for p in obj.Properties_)
+                latency_secs += time.time() - started
+                yield tuple(values.get(name) for name in names)
+        except pywintypes.com_error:
+            error = sys.exc_info()[1]
+            handle_com_error()
+        finally:
+            limiter.release(latency_secs, error, owner)
+
+    def snapshot(self, manifest, max_concurrent=8, container=None):
+        """Take a snapshot of the instances of each of the classes in
+        `manifest` -- a list of class names or a dictionary mapping class
+        names to the fields wanted, or to None for all of them -- querying
+        up to `max_concurrent` classes at once on worker threads, each
+        with its own connection to the host, so that the snapshot takes
+        about as long as the slowest class rather than as long as all of
+        them together::
+
+            c = wmi.WMI("srv1")
+            snapshot = c.snapshot({
+                "Win32_OperatingSystem" : ["Caption", "Version", "LastBootUpTime"],
+                "Win32_LogicalDisk" : ["DeviceID", "Size", "FreeSpace"],
+                "Win32_Service" : None,
+                "Win32_QuickFixEngineering" : ["HotFixID", "InstalledOn"],
+            })
+            for disk in snapshot.records("Win32_LogicalDisk"):
+                print(disk["DeviceID"], disk["FreeSpace"])
+            print(snapshot.timings, snapshot.counts, snapshot.errors)
+
+        Each class's rows are streamed, as :meth:`stream` yields them, into
+        `container`, by default a new :class:`_wmi_snapshot` held in memory
+        (see :func:`write_snapshot` for a file). Its `timings`
+        and `counts` record how long each class took and how many rows it
+        had; a class which fails has its exception in `errors` and
+        doesn't stop the others.
+
+        :returns: `container`
+        """
+        if isinstance(manifest, dict):
+            manifest = list(manifest.items())
+        else:
+            manifest = [(class_name, None) for class_name in manifest]
+        if container is None:
+            container = _wmi_snapshot()
+        host = self.host
+
+        def collect(namespace, class_name, fields):
+            started = time.time()
+            try:
+                definition = namespace._class_definition(class_name)
+                if not fields:
+                    fields = [p[0] for p in definition["properties"]]
+                return container.add(class_name, fields, namespace.stream(class_name, fields), definition)
+            finally:
+                container.timings[class_name] = time.time() - started
+
+        container.host = host
+        container.taken = time.time()
+        connection = self._connection_info()
+        tasks = [(connection, task) for task in manifest]
+        for _, (class_name, _), n_rows, error in _run_connected({host : tasks}, collect, max_concurrent):
+            if error is None:
+                container.counts[class_name] = n_rows
+            else:
+                if isinstance(error, pywintypes.com_error):
+                    error = _com_exception(error)
+                container.errors[class_name] = error
+        container.elapsed_secs = time.time() - container.taken
+        return container
 
     def watch_for(
         self,
@@ -1104,6 +1880,11 @@ class _wmi_namespace(object):
         wmi_class=None,
         delay_secs=1,
         fields=[],
+        lazy=False,
+        compact=False,
+        group_within=None,
+        group_by=None,
+        having=None,
         **where_clause
     ):
         """Set up an event tracker on a WMI event. This function
@@ -1158,19 +1939,128 @@ class _wmi_namespace(object):
                     pythoncom.PumpWaitingMessages()
                 else:
                     print(warning_log)
+
+        Polling several watchers in turn like this adds up to a lot of
+        latency once there are more than a few of them. :func:`multiplex`
+        waits on all of them at once and returns whichever event comes first::
+
+            events = wmi.multiplex(watcher1, watcher2)
+            while 1:
+                watcher, log = events.next()
+                print(log)
+
+        Wrapping each event reads every property, method and qualifier of
+        the objects involved. If only a few fields are needed, pass them
+        as `fields` together with `lazy=True` and the watcher will return
+        a :class:`_wmi_lazy_event` which reads only those fields::
+
+            watcher = c.Win32_Process.watch_for("creation", fields=["Name"], lazy=True)
+            while 1:
+                process = watcher()
+                print(process.timestamp, process.Name)
+
+        To have WMI count the events rather than sending each one, pass
+        `group_within` -- the number of seconds over which to group them --
+        and optionally `group_by`, a list of the properties whose values
+        distinguish one group from another, and `having`, the number of
+        events a group must exceed to be reported (or a condition on
+        `NumberOfEvents` such as "NumberOfEvents >= 10"). Each event is
+        then the representative of its group with an extra `count`
+        attribute holding the number of events in the group::
+
+            watcher = c.Win32_Process.watch_for(
+                "creation",
+                group_within=60,
+                group_by=["Name"],
+                having=10
+            )
+            while 1:
+                process = watcher()
+                print(process.Name, "started", process.count, "times")
+
+        Extrinsic events can arrive far faster than intrinsic ones. Pass
+        `compact=True` to have each returned as a named tuple of the fields
+        selected (or of all its properties) rather than as a :class:`_wmi_event`.
+        The tuple type and the position of each field are worked out from
+        the first event of each class and reused for the rest::
+
+            watcher = c.watch_for(
+                wmi_class="Win32_ProcessStartTrace",
+                fields=["ProcessName", "ProcessID"],
+                compact=True
+            )
+            while 1:
+                name, pid = watcher()
+        """
+        requested_fields = list(fields or [])
+        wql, is_extrinsic, is_aggregate, fields = self._notification_query(
+            raw_wql, notification_type, wmi_class, delay_secs, fields, where_clause,
+            group_within, group_by, having
+        )
+        if compact:
+            if not is_extrinsic or is_aggregate or lazy:
+                raise x_wmi("Compact events are only available for extrinsic events which are neither lazy nor grouped")
+            #
+            # The fields of a compact event come in the order they were asked for
+            #
+            fields = requested_fields
+        try:
+            return _wmi_watcher(
+                self._namespace.ExecNotificationQuery(wql),
+                is_extrinsic=is_extrinsic,
+                fields=fields,
+                lazy=lazy,
+                is_aggregate=is_aggregate,
+                compact=compact,
+                wql=wql,
+                namespace=self
+            )
+        except pywintypes.com_error:
+            handle_com_error()
+
+    def _notification_query(
+        self,
+        raw_wql,
+        notification_type,
+        wmi_class,
+        delay_secs,
+        fields,
+        where_clause,
+        group_within=None,
+        group_by=None,
+        having=None
+    ):
+        """Build the WQL for :meth:`watch_for` and its variants, returning
+        a tuple of the WQL, whether the events are extrinsic, whether
+        they are aggregated and the fields which will be selected.
         """
         if raw_wql:
             wql = raw_wql
             is_extrinsic = False
+            is_aggregate = bool(self._group_within_re.search(wql))
         else:
             if isinstance(wmi_class, _wmi_class):
                 class_name = wmi_class._class_name
             else:
                 class_name = wmi_class
-                wmi_class = getattr(self, class_name)
-            is_extrinsic = "__ExtrinsicEvent" in wmi_class.derivation()
+                wmi_class = None
+            index = self._known_class_index()
+            if index is not None and class_name in index:
+                is_extrinsic = index.isa(class_name, "__ExtrinsicEvent")
+            else:
+                if wmi_class is None:
+                    wmi_class = getattr(self, class_name)
+                is_extrinsic = "__ExtrinsicEvent" in wmi_class.derivation()
             fields = set(['TargetInstance'] + (fields or ["*"]))
-            field_list = ", ".join(fields)
+            is_aggregate = group_within is not None
+            if is_aggregate:
+                #
+                # Aggregate queries can only select *; the fields
+                # still restrict what's read from the representative
+                #
+                field_list = "*"
+            else:
+                field_list = ", ".join(fields)
             if is_extrinsic:
                 if where_clause:
                     where = " WHERE " + " AND ".join(["%s = '%s'" %(k, v) for k, v in where_clause.items()])
@@ -1185,15 +2075,108 @@ class _wmi_namespace(object):
                 wql = \
                     "SELECT %s FROM __Instance%sEvent WITHIN %d WHERE TargetInstance ISA '%s' %s" % \
                    (field_list, notification_type, delay_secs, class_name, where)
+            if is_aggregate:
+                wql += self._group_clause(group_within, group_by, having, is_extrinsic)
+        return wql, is_extrinsic, is_aggregate, fields
+
+    _group_within_re = re.compile(r"\bGROUP\s+WITHIN\b", re.IGNORECASE)
+
+    @staticmethod
+    def _group_clause(group_within, group_by, having, is_extrinsic):
+        """Build the GROUP clause of an aggregate event query. The `group_by`
+        properties are those of the TargetInstance for intrinsic events;
+        `having` is either a threshold for the number of events or a
+        condition on `NumberOfEvents`.
+        """
+        clause = " GROUP WITHIN %d" % group_within
+        if group_by:
+            if not isinstance(group_by, (list, tuple)):
+                group_by = [group_by]
+            if not is_extrinsic:
+                group_by = [p if "." in p else "TargetInstance." + p for p in group_by]
+            clause += " BY " + ", ".join(group_by)
+        if having is not None:
+            if isinstance(having, numbers.Integral):
+                having = "NumberOfEvents > %d" % having
+            clause += " HAVING " + having
+        return clause
+
+    def watch_for_async(
+        self,
+        raw_wql=None,
+        notification_type="operation",
+        wmi_class=None,
+        delay_secs=1,
+        fields=[],
+        timeout=None,
+        group_within=None,
+        group_by=None,
+        having=None,
+        **where_clause
+    ):
+        """Set up an event subscription which can be consumed from asyncio
+        code with `async for`. Takes the same parameters as :meth:`watch_for`
+        plus an optional `timeout` in seconds::
+
+            async def watch_processes(c):
+                async with c.watch_for_async(
+                    notification_type="Creation",
+                    wmi_class="Win32_Process",
+                    timeout=60
+                ) as processes:
+                    async for process in processes:
+                        print(process.Name)
+
+        The subscription is held by a single background thread shared by
+        all asynchronous watchers, using `ExecNotificationQueryAsync`, so
+        many subscriptions don't need a thread each. If no event arrives
+        within `timeout` seconds, `asyncio.TimeoutError` is raised and the
+        subscription carries on. If the task waiting for an event is
+        cancelled -- including by `asyncio.wait_for` -- the subscription
+        is cancelled too, as it is when the `async with` block exits.
+        """
+        if asyncio is None:
+            raise x_wmi("Asynchronous watchers need the asyncio module")
+        wql, is_extrinsic, is_aggregate, fields = self._notification_query(
+            raw_wql, notification_type, wmi_class, delay_secs, fields, where_clause,
+            group_within, group_by, having
+        )
+        return _wmi_async_watcher(
+            self._connection_info()[0], wql, is_extrinsic, fields, timeout, is_aggregate=is_aggregate
+        )
 
-        try:
-            return _wmi_watcher(
-                self._namespace.ExecNotificationQuery(wql),
-                is_extrinsic=is_extrinsic,
-                fields=fields
+    def watch_for_adaptive(
+        self,
+        notification_type="operation",
+        wmi_class=None,
+        min_delay_secs=1,
+        max_delay_secs=30,
+        fields=[],
+        lazy=False,
+        **where_clause
+    ):
+        """Set up an event tracker on an intrinsic WMI event whose polling
+        interval adapts to the rate at which events arrive, between
+        `min_delay_secs` and `max_delay_secs`. Takes the same parameters
+        as :meth:`watch_for` and returns an :class:`_wmi_adaptive_watcher`
+        whose :meth:`_wmi_adaptive_watcher.metrics` show the interval in
+        force and the cost of polling::
+
+            watcher = c.watch_for_adaptive("modification", "Win32_Service", max_delay_secs=60)
+            while 1:
+                service = watcher()
+                print(service.Name, service.State)
+        """
+        def subscribe(delay_secs):
+            return self.watch_for(
+                notification_type=notification_type,
+                wmi_class=wmi_class,
+                delay_secs=delay_secs,
+                fields=fields,
+                lazy=lazy,
+                **where_clause
             )
-        except pywintypes.com_error:
-            handle_com_error()
+        return _wmi_adaptive_watcher(subscribe, min_delay_secs, max_delay_secs)
 
     def __getattr__(self, attribute):
         """Offer WMI classes as simple attributes. Pass through any untrapped
@@ -1203,11 +2186,16 @@ class _wmi_namespace(object):
         #
         # Don't try to match against known classes as was previously
         # done since the list may not have been requested
-        # (find_classes=False).
+        # (find_classes=False). But remember the names which WMI has
+        # said are not classes so as not to ask again.
         #
+        if attribute in self._not_classes:
+            return getattr(self._namespace, attribute)
         try:
             return self._cached_classes(attribute)
         except pywintypes.com_error:
+            if set(_com_error_codes(sys.exc_info()[1])) & self.NOT_A_CLASS:
+                self._not_classes.add(attribute)
             return getattr(self._namespace, attribute)
 
     def _cached_classes(self, class_name):
@@ -1217,47 +2205,3345 @@ class _wmi_namespace(object):
         pass it back
         """
         if class_name not in self._classes_map:
-            self._classes_map[class_name] = _wmi_class(self, self._namespace.Get(class_name))
+            definition = self._schema.get(class_name) if self._schema is not None else None
+            if definition:
+                self._classes_map[class_name] = _wmi_class(self, None, definition)
+            else:
+                self._classes_map[class_name] = _wmi_class(self, self._namespace.Get(class_name))
         return self._classes_map[class_name]
 
-    def _getAttributeNames(self):
-        """Return list of classes for IPython completion engine"""
-        return [x for x in self.classes if not x.startswith('__')]
+    def _getAttributeNames(self):
+        """Return list of classes for IPython completion engine"""
+        return [x for x in self.classes if not x.startswith('__')]
+
+#
+# class _wmi_watcher
+#
+class _wmi_watcher(object):
+    """Helper class for WMI.watch_for below(qv)"""
+
+    _event_property_map = {
+        "TargetInstance" : _wmi_object,
+        "PreviousInstance" : _wmi_object
+    }
+    def __init__(
+        self,
+        wmi_event,
+        is_extrinsic,
+        fields=[],
+        lazy=False,
+        is_aggregate=False,
+        compact=False,
+        wql=None,
+        namespace=None
+    ):
+        self.wmi_event = wmi_event
+        self.wql = wql
+        self._namespace = namespace
+        self.is_extrinsic = is_extrinsic
+        self.fields = fields
+        self.lazy = lazy
+        self.is_aggregate = is_aggregate
+        self.compact = compact
+        self._compact_layouts = {}
+
+    def __call__(self, timeout_ms=-1):
+        """When called, return the instance which caused the event. Supports
+         timeout in milliseconds (defaulting to infinite). If the watcher
+         times out, :exc:`x_wmi_timed_out` is raised. This makes it easy to support
+         watching for multiple objects.
+        """
+        try:
+            return self._wrap(self.wmi_event.NextEvent(timeout_ms))
+        except pywintypes.com_error:
+            handle_com_error()
+
+    def next_batch(self, max_events=100, max_wait_ms=-1):
+        """Return a list of up to `max_events` events: wait up to
+        `max_wait_ms` milliseconds (defaulting to infinite) for the first
+        and then take whatever others are already waiting without waiting
+        any further. If nothing arrives in time the list is empty.
+
+        The events are not wrapped until they're used, so that taking
+        a large batch costs little more than taking a single event; a
+        compact watcher's events come back as their named tuples::
+
+            watcher = c.Win32_Process.watch_for("creation")
+            while True:
+                for process in watcher.next_batch(1000, 500):
+                    print(process.Name)
+        """
+        timed_out = signed_to_unsigned(wbemErrTimedout)
+        events = []
+        wait_ms = max_wait_ms
+        while len(events) < max_events:
+            try:
+                event = self.wmi_event.NextEvent(wait_ms)
+            except pywintypes.com_error:
+                if timed_out in _com_error_codes(sys.exc_info()[1]):
+                    break
+                handle_com_error()
+            if self.compact:
+                events.append(self._wrap(event))
+            else:
+                events.append(_wmi_lazy_event(self, event))
+            wait_ms = 0
+        return events
+
+    def coalesced(self, window_ms=1000):
+        """Return a :class:`_wmi_coalescing_watcher` which merges this
+        watcher's events for the same instance arriving within `window_ms`
+        milliseconds of each other, delivering only the latest state of
+        each instance along with the names of the properties which changed.
+        """
+        return _wmi_coalescing_watcher(self, window_ms)
+
+    def record(self, path, compress=None):
+        """Return a :class:`_wmi_event_recorder` which passes on this
+        watcher's events while appending them to the file at `path`,
+        gzipped if `compress` is true or, by default, if `path` ends
+        with ".gz". The recording can be played back with :func:`replay`.
+        """
+        return _wmi_event_recorder(self, path, compress)
+
+    def pump(self, maxsize=1000, overflow="block", lag_ms=1000):
+        """Start waiting for this watcher's events on a thread of their
+        own, returning a :class:`_wmi_event_pump` which holds up to
+        `maxsize` of them for the consumer, dealing with any overflow
+        according to `overflow`: "block", "drop-oldest", "drop-newest"
+        or "coalesce". The events then come only through the pump,
+        not by calling the watcher.
+        """
+        return _wmi_event_pump(self, maxsize, overflow, lag_ms)
+
+    def _wrap(self, event):
+        """Wrap a raw event object as returned by `NextEvent`: as a
+        :class:`_wmi_lazy_event` if the watcher is lazy, otherwise
+        as a :class:`_wmi_event`.
+        """
+        if self.compact:
+            return self._wrap_compact(event)
+        elif self.lazy:
+            return _wmi_lazy_event(self, event)
+        else:
+            return self._wrap_event(event)
+
+    def _wrap_compact(self, event):
+        """Wrap an extrinsic event as a named tuple of its selected fields.
+        The tuple type, and the position of each field among the event's
+        properties, are cached per class from the first event of that class
+        so that later events only need one pass over their properties.
+        """
+        properties = list(event.Properties_)
+        class_name = event.Path_.Class
+        layout = self._compact_layouts.get(class_name)
+        if layout is None or layout[2] != len(properties):
+            names = [p.Name for p in properties]
+            fields = [f for f in self.fields or [] if f not in ("*", "TargetInstance")] or names
+            positions = dict((name.lower(), i) for i, name in enumerate(names))
+            try:
+                index = [positions[f.lower()] for f in fields]
+            except KeyError:
+                raise x_wmi("%s has no property %s" % (class_name, sys.exc_info()[1]))
+            layout = self._compact_layouts[class_name] = (
+                collections.namedtuple(class_name, fields),
+                index,
+                len(properties)
+            )
+        record_type, index, _ = layout
+        return record_type(*[properties[i].Value for i in index])
+
+    def _wrap_event(self, event):
+        """Wrap a raw event object as a :class:`_wmi_event`. An aggregate
+        event is wrapped as its representative event with a `count`.
+        """
+        event, count = self._representative(event)
+        wrapped = self._wrap_representative(event)
+        if count is not None:
+            _set(wrapped, "count", count)
+        return wrapped
+
+    def _representative(self, event):
+        """Return the event which represents a raw event, and the number
+        of events it represents: for an `__AggregateEvent` that's its
+        Representative and NumberOfEvents; otherwise it's the event itself
+        and None.
+        """
+        if self.is_aggregate:
+            return (
+                event.Properties_("Representative").Value,
+                event.Properties_("NumberOfEvents").Value
+            )
+        else:
+            return event, None
+
+    def _wrap_representative(self, event):
+        if self.is_extrinsic:
+            return _wmi_event(event, None, self.fields)
+        else:
+            return _wmi_event(
+                event.Properties_("TargetInstance").Value,
+                _wmi_object(event, property_map=self._event_property_map),
+                self.fields
+            )
+
+#
+# class _wmi_coalescing_watcher
+#
+class _wmi_coalescing_watcher(object):
+    """Sit in front of a :class:`_wmi_watcher` and merge the events which
+    arrive for the same instance -- identified by the event class and the
+    path of its TargetInstance -- within a window of time. It's most
+    useful for modification events on busy classes which would otherwise
+    produce a stream of near-identical events::
+
+        watcher = c.Win32_Service.watch_for("modification", delay_secs=1)
+        services = watcher.coalesced(window_ms=5000)
+        while True:
+            service = services()
+            print(service.Name, service.changed, service.coalesced)
+
+    Each event delivered is the latest one for its instance with two
+    extra attributes: `changed`, the names of the properties which
+    differed between `previous` and `TargetInstance` in any of the
+    merged events; and `coalesced`, the number of events merged. Events
+    without a TargetInstance (eg extrinsic events) are passed through.
+
+    Calling the coalescing watcher waits up to `timeout_ms` for the first
+    event, as a watcher would, and then gathers any others which arrive
+    within the window before handing back the merged events one at a time.
+    """
+
+    def __init__(self, watcher, window_ms=1000):
+        self.watcher = watcher
+        self.window_ms = window_ms
+        self.received = 0
+        self.delivered = 0
+        self._ready = collections.deque()
+
+    def __repr__(self):
+        return "<_wmi_coalescing_watcher: %d ms; %d received, %d delivered>" % (
+            self.window_ms, self.received, self.delivered
+        )
+
+    def __call__(self, timeout_ms=-1):
+        if not self._ready:
+            self._gather(timeout_ms)
+        self.delivered += 1
+        return self._ready.popleft()
+
+    @staticmethod
+    def _changed(event):
+        """Return the names of the properties which differ between an
+        intrinsic event's PreviousInstance and its TargetInstance
+        """
+        try:
+            previous = event.Properties_("PreviousInstance").Value
+        except pywintypes.com_error:
+            return []
+        if previous is None:
+            return []
+        previous_values = dict((p.Name, p.Value) for p in previous.Properties_)
+        target = event.Properties_("TargetInstance").Value
+        return [p.Name for p in target.Properties_ if p.Value != previous_values.get(p.Name)]
+
+    def _merge(self, pending, event):
+        self.received += 1
+        try:
+            key = (event.Path_.Class, event.Properties_("TargetInstance").Value.Path_.RelPath)
+        except (pywintypes.com_error, AttributeError):
+            key = self.received
+        entry = pending.get(key)
+        if entry is None:
+            pending[key] = entry = [event, set(), 0]
+        entry[0] = event
+        entry[1].update(self._changed(event))
+        entry[2] += 1
+
+    def _gather(self, timeout_ms):
+        timed_out = signed_to_unsigned(wbemErrTimedout)
+        pending = collections.OrderedDict()
+        try:
+            self._merge(pending, self.watcher.wmi_event.NextEvent(timeout_ms))
+            deadline = time.time() + self.window_ms / 1000.0
+            while True:
+                remaining_ms = int((deadline - time.time()) * 1000)
+                if remaining_ms <= 0:
+                    break
+                try:
+                    event = self.watcher.wmi_event.NextEvent(remaining_ms)
+                except pywintypes.com_error:
+                    if timed_out in _com_error_codes(sys.exc_info()[1]):
+                        break
+                    raise
+                self._merge(pending, event)
+
+            for event, changed, count in pending.values():
+                wrapped = self.watcher._wrap_event(event)
+                _set(wrapped, "changed", sorted(changed))
+                _set(wrapped, "coalesced", count)
+                self._ready.append(wrapped)
+        except pywintypes.com_error:
+            handle_com_error()
+
+#
+# class _wmi_adaptive_watcher
+#
+class _wmi_adaptive_watcher(object):
+    """Watch for intrinsic events with a polling interval which follows
+    the rate at which they arrive. An intrinsic event query with a
+    `WITHIN` clause has the WMI service poll the provider at that interval
+    for the life of the subscription: a short interval costs a lot of
+    polling when nothing is happening; a long one holds events back when
+    a lot is. Returned by :meth:`_wmi_namespace.watch_for_adaptive`::
+
+        watcher = c.watch_for_adaptive("creation", "Win32_Process", min_delay_secs=1, max_delay_secs=30)
+        while True:
+            process = watcher()
+            print(process.Name, watcher.metrics()["interval_secs"])
+
+    Every `evaluate_intervals` polling intervals, the events seen are
+    counted. If there were none, or the consumer is lagging by more than
+    `max_lag_secs` behind the events' creation, the interval is doubled;
+    if there was at least one event per interval on average, it is halved.
+    The interval stays between `min_delay_secs` and `max_delay_secs`.
+
+    WMI can't change the interval of an existing subscription, so a new
+    one is made and the old one drained of the events it has already
+    detected before it's released. An event which happens while the
+    subscriptions are swapped may be seen by both.
+
+    `subscribe` is called with an interval in seconds and returns a
+    :class:`_wmi_watcher` for that interval; `clock` can be replaced
+    by a test.
+    """
+
+    def __init__(
+        self,
+        subscribe,
+        min_delay_secs=1,
+        max_delay_secs=30,
+        evaluate_intervals=5,
+        max_lag_secs=None,
+        clock=time.time
+    ):
+        if not 1 <= min_delay_secs <= max_delay_secs:
+            raise x_wmi("min_delay_secs must be at least 1 and no more than max_delay_secs")
+        self._subscribe = subscribe
+        self.min_delay_secs = int(min_delay_secs)
+        self.max_delay_secs = int(max_delay_secs)
+        self.evaluate_intervals = evaluate_intervals
+        if max_lag_secs is None:
+            max_lag_secs = 2 * self.max_delay_secs
+        self.max_lag_secs = max_lag_secs
+        self._clock = clock
+        self._pending = collections.deque()
+        self.interval_secs = self.min_delay_secs
+        self.watcher = subscribe(self.interval_secs)
+        if self.watcher.is_extrinsic:
+            raise x_wmi("Only intrinsic events are polled; extrinsic events have no interval to adapt")
+        now = clock()
+        self._window_start = self._last_tick = now
+        self._window_events = 0
+        self._window_lag = 0.0
+        self.events = 0
+        self.resubscriptions = 0
+        self.polls = 0.0
+        self.lag_secs = 0.0
+
+    def __repr__(self):
+        return "<_wmi_adaptive_watcher: %d secs (%d-%d); %d events>" % (
+            self.interval_secs, self.min_delay_secs, self.max_delay_secs, self.events
+        )
+
+    def __call__(self, timeout_ms=-1):
+        """Return the next event, waiting up to `timeout_ms` milliseconds
+        (defaulting to infinite) before raising :exc:`x_wmi_timed_out`.
+        While waiting, the interval is re-evaluated so that an idle
+        subscription backs off.
+        """
+        if self._pending:
+            return self.watcher._wrap(self._pending.popleft())
+
+        timed_out = signed_to_unsigned(wbemErrTimedout)
+        if timeout_ms >= 0:
+            deadline = self._clock() + timeout_ms / 1000.0
+        else:
+            deadline = None
+        while True:
+            wait_ms = self.interval_secs * 1000
+            if deadline is not None:
+                wait_ms = max(0, min(wait_ms, int((deadline - self._clock()) * 1000)))
+            try:
+                event = self.watcher.wmi_event.NextEvent(wait_ms)
+            except pywintypes.com_error:
+                err = sys.exc_info()[1]
+                if timed_out not in _com_error_codes(err):
+                    handle_com_error(err)
+                self._evaluate()
+                if deadline is not None and self._clock() >= deadline:
+                    handle_com_error(err)
+                continue
+            self._observe(event)
+            watcher = self.watcher
+            self._evaluate()
+            return watcher._wrap(event)
+
+    def _observe(self, event):
+        self.events += 1
+        self._window_events += 1
+        try:
+            created = from_1601(event.Properties_("TIME_CREATED").Value)
+        except pywintypes.com_error:
+            return
+        #
+        # An event may be up to one interval old before WMI even sees it;
+        # only what's left beyond that is down to the consumer.
+        #
+        delta = datetime.datetime.utcnow() - created
+        lag = delta.days * 86400 + delta.seconds + delta.microseconds / 1000000.0 - self.interval_secs
+        self._window_lag = max(self._window_lag, lag)
+
+    def _tick(self):
+        now = self._clock()
+        self.polls += (now - self._last_tick) / self.interval_secs
+        self._last_tick = now
+        return now
+
+    def _evaluate(self):
+        now = self._tick()
+        if now - self._window_start < self.evaluate_intervals * self.interval_secs:
+            return
+        self.lag_secs = max(0.0, self._window_lag)
+        if self._window_events == 0 or self.lag_secs > self.max_lag_secs:
+            interval_secs = self.interval_secs * 2
+        elif self._window_events >= self.evaluate_intervals:
+            interval_secs = self.interval_secs // 2
+        else:
+            interval_secs = self.interval_secs
+        interval_secs = max(self.min_delay_secs, min(self.max_delay_secs, interval_secs))
+        self._window_start = now
+        self._window_events = 0
+        self._window_lag = 0.0
+        if interval_secs != self.interval_secs:
+            self._resubscribe(interval_secs)
+
+    def _resubscribe(self, interval_secs):
+        timed_out = signed_to_unsigned(wbemErrTimedout)
+        old_watcher = self.watcher
+        self.watcher = self._subscribe(interval_secs)
+        self.interval_secs = interval_secs
+        self.resubscriptions += 1
+        while True:
+            try:
+                self._pending.append(old_watcher.wmi_event.NextEvent(0))
+            except pywintypes.com_error:
+                if timed_out not in _com_error_codes(sys.exc_info()[1]):
+                    handle_com_error()
+                break
+
+    def metrics(self):
+        """Return the current polling interval and the cost of polling:
+        the number of provider polls since the watcher started, as
+        estimated from the intervals in force, and the current rate
+        of polls per minute.
+        """
+        self._tick()
+        return dict(
+            interval_secs=self.interval_secs,
+            min_delay_secs=self.min_delay_secs,
+            max_delay_secs=self.max_delay_secs,
+            polls=int(self.polls),
+            polls_per_minute=60.0 / self.interval_secs,
+            events=self.events,
+            lag_secs=self.lag_secs,
+            resubscriptions=self.resubscriptions,
+        )
+
+#
+# class _wmi_lazy_event
+#
+class _wmi_lazy_event(object):
+    """Lightweight record standing in for the :class:`_wmi_event` which
+    a watcher would return for a raw event. The event type and timestamp
+    are decoded from the event when the record is made; the fields the
+    watcher was asked for (or all the fields, if none was specified) are
+    read from the TargetInstance in one pass when the first is used.
+    The full :class:`_wmi_event` -- which enumerates all the properties,
+    methods and qualifiers of the objects involved -- is only built if
+    something else is asked for, and is also available as :attr:`event`.
+    For an aggregated event the record stands for the representative of
+    the group and `count` is the number of events in the group; otherwise
+    `count` is None.
+
+    Returned by :meth:`_wmi_watcher.next_batch`, and by the watcher
+    itself if :meth:`_wmi_namespace.watch_for` was called with `lazy=True`::
+
+        watcher = c.Win32_Process.watch_for("creation", fields=["Name", "ProcessId"], lazy=True)
+        while True:
+            process = watcher()
+            print(process.event_type, process.timestamp, process.Name, process.ProcessId)
+    """
+
+    __slots__ = ("_watcher", "_raw_event", "_event", "_values", "event_type", "timestamp", "count")
+
+    def __init__(self, watcher, raw_event):
+        self._watcher = watcher
+        self._event = None
+        self._values = None
+        self.event_type = None
+        self.timestamp = None
+        self.count = None
+        try:
+            raw_event, self.count = watcher._representative(raw_event)
+        except pywintypes.com_error:
+            handle_com_error()
+        self._raw_event = raw_event
+        try:
+            match = _wmi_event.event_type_re.match(raw_event.Path_.Class)
+            if match:
+                self.event_type = match.group(1).lower()
+            self.timestamp = from_1601(raw_event.Properties_("TIME_CREATED").Value)
+        except pywintypes.com_error:
+            pass
+
+    def _target(self):
+        if self._watcher.is_extrinsic:
+            return self._raw_event
+        else:
+            return self._raw_event.Properties_("TargetInstance").Value
+
+    def _get_values(self):
+        if self._values is None:
+            try:
+                target = self._target()
+                fields = [f for f in self._watcher.fields or [] if f not in ("*", "TargetInstance")]
+                if fields:
+                    properties = target.Properties_
+                    self._values = dict((f, properties(f).Value) for f in fields)
+                else:
+                    self._values = dict((p.Name, p.Value) for p in target.Properties_)
+            except pywintypes.com_error:
+                handle_com_error()
+        return self._values
+
+    def _get_event(self):
+        if self._event is None:
+            try:
+                self._event = self._watcher._wrap_representative(self._raw_event)
+                if self.count is not None:
+                    _set(self._event, "count", self.count)
+            except pywintypes.com_error:
+                handle_com_error()
+        return self._event
+    event = property(_get_event)
+
+    def _get_previous(self):
+        if self._watcher.is_extrinsic:
+            return None
+        try:
+            previous = self._raw_event.Properties_("PreviousInstance").Value
+        except pywintypes.com_error:
+            return None
+        return None if previous is None else _wmi_object(previous)
+    previous = property(_get_previous)
+
+    def __getattr__(self, attribute):
+        values = self._get_values()
+        if attribute in values:
+            return values[attribute]
+        return getattr(self._get_event(), attribute)
+
+    def __str__(self):
+        return str(self._get_event())
+
+    def __repr__(self):
+        return "<_wmi_lazy_event: %s %s>" % (self.event_type or "extrinsic", self._raw_event.Path_.Class)
+
+    def __eq__(self, other):
+        return self._get_event() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._get_event())
+
+#
+# class _wmi_event_recorder
+#
+RECORDING_VERSION = 1
+
+def _recordable(value):
+    """Return a property value in a form which JSON can hold: arrays
+    become lists and anything JSON doesn't know about (eg an embedded
+    object) becomes its string representation.
+    """
+    if value is None or isinstance(value, (bool, numbers.Number)):
+        return value
+    elif isinstance(value, (list, tuple)):
+        return [_recordable(v) for v in value]
+    else:
+        return "%s" % (value,)
+
+def _open_recording(path, mode, compress=None):
+    if compress is None:
+        if "r" in mode:
+            with open(path, "rb") as f:
+                compress = f.read(2) == b"\x1f\x8b"
+        else:
+            compress = path.lower().endswith(".gz")
+    if compress:
+        return gzip.open(path, mode)
+    else:
+        return open(path, mode)
+
+class _wmi_event_recorder(object):
+    """Pass on the events from a :class:`_wmi_watcher` while appending
+    each of them to a file -- one line of JSON per event, gzipped if
+    asked for -- so that they can be played back later with :func:`replay`
+    eg to load-test the code which consumes them, without needing
+    Windows or the events which produced them::
+
+        watcher = c.Win32_Process.watch_for("creation")
+        with watcher.record("processes.jsonl.gz") as recorder:
+            while True:
+                process = recorder()
+                print(process.Name)
+
+    For each event the recording holds the event type, the time WMI
+    created it and the time it arrived, the class of its TargetInstance
+    and the values of its properties, and the values of the properties of
+    the PreviousInstance if there is one. Recordings are only appended to,
+    so a recording can be carried on across several runs.
+    """
+
+    def __init__(self, watcher, path, compress=None):
+        self.watcher = watcher
+        self.path = path
+        self.recorded = 0
+        is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = _open_recording(path, "ab", compress)
+        if is_new:
+            self._write(dict(
+                wmi_events=RECORDING_VERSION,
+                is_extrinsic=self.watcher.is_extrinsic,
+                fields=sorted(self.watcher.fields or [])
+            ))
+
+    def __repr__(self):
+        return "<_wmi_event_recorder: %s; %d recorded>" % (self.path, self.recorded)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __call__(self, timeout_ms=-1):
+        """Return the watcher's next event, as the watcher would, having
+        first added it to the recording.
+        """
+        try:
+            event = self.watcher.wmi_event.NextEvent(timeout_ms)
+            self.record(event)
+        except pywintypes.com_error:
+            handle_com_error()
+        return self.watcher._wrap(event)
+
+    def record(self, event):
+        """Add a raw event, as returned by `NextEvent`, to the recording"""
+        arrived = time.time()
+        event, count = self.watcher._representative(event)
+        match = _wmi_event.event_type_re.match(event.Path_.Class)
+        event_type = match.group(1).lower() if match else None
+        try:
+            created = int(event.Properties_("TIME_CREATED").Value)
+        except pywintypes.com_error:
+            created = None
+        previous = None
+        if self.watcher.is_extrinsic:
+            target = event
+        else:
+            target = event.Properties_("TargetInstance").Value
+            try:
+                previous = event.Properties_("PreviousInstance").Value
+            except pywintypes.com_error:
+                pass
+        record = dict(
+            type=event_type,
+            created=created,
+            arrived=arrived,
+            cls=target.Path_.Class,
+            target=self._values(target),
+        )
+        if previous is not None:
+            record["previous"] = self._values(previous)
+        if count is not None:
+            record["count"] = count
+        self._write(record)
+        self.recorded += 1
+
+    @staticmethod
+    def _values(obj):
+        return dict((p.Name, _recordable(p.Value)) for p in obj.Properties_)
+
+    def _write(self, record):
+        self._file.write(json.dumps(record, separators=(",", ":")).encode("utf-8") + b"\n")
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+#
+# class _wmi_replay_watcher
+#
+class _wmi_replayed_object(object):
+    """The recorded state of an object, offering its property values
+    as attributes as a :class:`_wmi_object` would.
+    """
+
+    def __init__(self, class_name, properties):
+        _set(self, "_class_name", class_name)
+        _set(self, "properties", properties)
+
+    def __getattr__(self, attribute):
+        try:
+            return self.properties[attribute]
+        except KeyError:
+            raise AttributeError(attribute)
+
+    def __setattr__(self, attribute, value):
+        raise AttributeError("Replayed objects are read-only")
+
+    def __eq__(self, other):
+        return isinstance(other, _wmi_replayed_object) and \
+            (self._class_name, self.properties) == (other._class_name, other.properties)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "<_wmi_replayed_object: %s>" % self._class_name
+
+    def __str__(self):
+        return "instance of %s\n{\n%s};" % (
+            self._class_name,
+            "".join("\t%s = %r;\n" % item for item in sorted(self.properties.items()))
+        )
+
+class _wmi_replayed_event(_wmi_replayed_object):
+    """A recorded event, with the `event_type`, `timestamp` and `previous`
+    attributes of a :class:`_wmi_event` and, for an aggregated event,
+    its `count`.
+    """
+
+    def __init__(self, record):
+        _wmi_replayed_object.__init__(self, record["cls"], record["target"])
+        created = record.get("created")
+        previous = record.get("previous")
+        _set(self, "event_type", record.get("type"))
+        _set(self, "timestamp", None if created is None else from_1601(created))
+        _set(self, "previous", None if previous is None else _wmi_replayed_object(record["cls"], previous))
+        if "count" in record:
+            _set(self, "count", record["count"])
+
+    def __repr__(self):
+        return "<_wmi_replayed_event: %s %s>" % (self.event_type or "extrinsic", self._class_name)
+
+class _wmi_replay_watcher(object):
+    """Play back a recording made by :class:`_wmi_event_recorder`
+    through the same interface as a :class:`_wmi_watcher`: calling it
+    returns the next event or raises :exc:`x_wmi_timed_out` if none
+    is due within the timeout, and :meth:`next_batch` returns the
+    events which are due. Returned by :func:`replay`.
+
+    With a `speed` of 1, events are due at the same intervals as they
+    originally arrived; a speed of 2 replays them twice as fast, 0.5 at
+    half the speed; a speed of None replays them as fast as they can
+    be consumed. Once the recording is exhausted, the watcher behaves
+    as one which receives no more events -- except that calling it
+    without a timeout raises :exc:`x_wmi` rather than waiting for ever --
+    and :attr:`exhausted` is set.
+
+    `sleep` and `clock` can be replaced, eg by a test.
+    """
+
+    def __init__(self, path, speed=1.0, sleep=time.sleep, clock=time.time):
+        if speed is not None and speed <= 0:
+            raise x_wmi("speed must be positive or None")
+        self.path = path
+        self.speed = speed
+        self.replayed = 0
+        self.exhausted = False
+        self._sleep = sleep
+        self._clock = clock
+        self._file = _open_recording(path, "rb")
+        self._records = self._read()
+        self._next = None
+        self._started = None
+        self._first_arrived = None
+
+    def __repr__(self):
+        return "<_wmi_replay_watcher: %s at %s; %d replayed>" % (
+            self.path, "full speed" if self.speed is None else "%sx" % self.speed, self.replayed
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        """Iterate over all the remaining events, paced by `speed`"""
+        while True:
+            record = self._peek()
+            if record is None:
+                return
+            self._wait_until(self._due(record))
+            yield self._take()
+
+    def __call__(self, timeout_ms=-1):
+        record = self._peek()
+        if record is None:
+            if timeout_ms < 0:
+                raise x_wmi("The recording %s has no more events" % self.path)
+            self._sleep(timeout_ms / 1000.0)
+            raise x_wmi_timed_out()
+
+        due = self._due(record)
+        if timeout_ms >= 0 and due - self._clock() > timeout_ms / 1000.0:
+            self._sleep(timeout_ms / 1000.0)
+            raise x_wmi_timed_out()
+        self._wait_until(due)
+        return self._take()
+
+    def next_batch(self, max_events=100, max_wait_ms=-1):
+        """Return up to `max_events` events: wait up to `max_wait_ms` for
+        the first, as :meth:`_wmi_watcher.next_batch` does, and then take
+        any others which are already due.
+        """
+        try:
+            events = [self(max_wait_ms)]
+        except x_wmi_timed_out:
+            return []
+        while len(events) < max_events:
+            record = self._peek()
+            if record is None or self._due(record) > self._clock():
+                break
+            events.append(self._take())
+        return events
+
+    def _read(self):
+        for line in self._file:
+            record = json.loads(line.decode("utf-8"))
+            if "wmi_events" in record:
+                if record["wmi_events"] > RECORDING_VERSION:
+                    raise x_wmi("%s was recorded in a later format (%s)" % (self.path, record["wmi_events"]))
+                continue
+            yield record
+
+    def _peek(self):
+        if self._next is None:
+            self._next = next(self._records, None)
+            if self._next is None:
+                self.exhausted = True
+        return self._next
+
+    def _take(self):
+        record, self._next = self._next, None
+        self.replayed += 1
+        return _wmi_replayed_event(record)
+
+    def _due(self, record):
+        now = self._clock()
+        if self._started is None:
+            self._started = now
+            self._first_arrived = record["arrived"]
+        if self.speed is None:
+            return now
+        return self._started + (record["arrived"] - self._first_arrived) / self.speed
+
+    def _wait_until(self, due):
+        delay = due - self._clock()
+        if delay > 0:
+            self._sleep(delay)
+
+    def close(self):
+        self._file.close()
+
+def replay(path, speed=1.0):
+    """Play back the events in a recording made by :meth:`_wmi_watcher.record`,
+    returning a :class:`_wmi_replay_watcher` which can be used as
+    the original watcher was. `speed` is the multiple of the original
+    speed at which to replay, or None to replay as fast as possible.
+    This doesn't need WMI or even Windows::
+
+        import wmi
+
+        watcher = wmi.replay("processes.jsonl.gz", speed=10)
+        while not watcher.exhausted:
+            for process in watcher.next_batch(1000, 500):
+                handle(process)
+    """
+    return _wmi_replay_watcher(path, speed)
+
+def _marshal(com_object):
+    """Marshal a COM object into a stream from which another thread
+    can pick it up with :func:`_unmarshal`. COM objects belong to the
+    apartment of the thread which created them and can't simply be
+    handed across to another thread.
+    """
+    return pythoncom.CoMarshalInterThreadInterfaceInStream(
+        pythoncom.IID_IDispatch, getattr(com_object, "_oleobj_", com_object)
+    )
+
+def _unmarshal(stream):
+    """Unpack, in the current thread, a COM object marshalled by :func:`_marshal`.
+    Each stream can only be unmarshalled once.
+    """
+    return Dispatch(pythoncom.CoGetInterfaceAndReleaseStream(stream, pythoncom.IID_IDispatch))
+
+def _com_exception(err):
+    """Return -- rather than raise -- the :exc:`x_wmi` corresponding to a COM error"""
+    try:
+        handle_com_error(err)
+    except x_wmi:
+        return sys.exc_info()[1]
+
+def _path_connection(server, namespace):
+    """Return the arguments for :func:`connect` to reach `namespace` on
+    `server`, as they're named in a WMI object's path
+    """
+    if _server_host_key(server) == ".":
+        server = ""
+    return dict(computer=server, namespace=namespace)
+
+def _object_connection(obj):
+    """Return the connection, as :meth:`_wmi_namespace._connection_info`
+    gives it, to the namespace which a :class:`_wmi_object` came from
+    """
+    if isinstance(obj, _wmi_class):
+        namespace = obj._namespace
+    elif obj._instance_of is not None:
+        namespace = obj._instance_of._namespace
+    else:
+        namespace = None
+    if namespace is not None:
+        return namespace._connection_info()
+    try:
+        path = obj.ole_object.Path_
+        return _path_connection(path.Server, path.Namespace), None
+    except pywintypes.com_error:
+        handle_com_error()
+
+def _run_connected(groups, function, threads_per_group):
+    """Call `function(namespace, *task)` for each of the tasks in `groups`
+    -- a dictionary mapping a key, such as a host, to a list of pairs of a
+    connection, as :meth:`_wmi_namespace._connection_info` gives it, and a
+    task -- on up to `threads_per_group` threads per group. Each thread is
+    initialised for COM and makes its own connections, with :func:`connect`
+    and so within :data:`host_limits`, and `namespace` is the thread's
+    connection for the task; so the threads' calls go straight to WMI
+    rather than through the calling thread. Yield `(key, task, result, error)`
+    on the calling thread as each task finishes, where `error` is the
+    exception the task raised, if any. Tasks mustn't hold COM objects.
+    """
+    results = queue.Queue()
+
+    def work(tasks):
+        pythoncom.CoInitialize()
+        try:
+            namespaces = {}
+            while True:
+                try:
+                    key, (connection, task) = tasks.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    arguments, schema = connection
+                    connection_key = repr(sorted(arguments.items())), id(schema)
+                    namespace = namespaces.get(connection_key)
+                    if namespace is None:
+                        namespace = namespaces[connection_key] = connect(**arguments)
+                        namespace._schema = schema
+                    results.put((key, task, function(namespace, *task), None))
+                except Exception:
+                    results.put((key, task, None, sys.exc_info()[1]))
+            namespaces.clear()
+        finally:
+            pythoncom.CoUninitialize()
+
+    n_tasks = 0
+    for key, group in groups.items():
+        tasks = queue.Queue()
+        for item in group:
+            tasks.put((key, item))
+        n_tasks += len(group)
+        for i in range(min(threads_per_group, len(group))):
+            thread = threading.Thread(target=work, args=(tasks,))
+            thread.daemon = True
+            thread.start()
+
+    for i in range(n_tasks):
+        yield results.get()
+
+def call_many(objects, method, max_per_host=8, progress=None, **params):
+    """Call the WMI method `method` on each of `objects` with the same
+    keyword `params`, running up to `max_per_host` calls at once against
+    each host (and within the host's limit in :data:`host_limits`).
+    Return a list, in the same order as `objects`, of tuples of the object
+    and either the method's out parameters, as calling the method on the
+    object would return them, or the exception raised calling it::
+
+        c = wmi.WMI()
+        stopped = wmi.call_many(c.Win32_Service(State="Running", StartMode="Manual"), "StopService")
+        for service, result in stopped:
+            if isinstance(result, Exception) or result[0] != 0:
+                print(service.Name, "did not stop:", result)
+
+    Each thread making the calls has its own connection to the host, made
+    as the objects' namespace was, and calls the method by the objects'
+    paths. The method's signature is read once from the first object and
+    the parameters checked against it before anything is called. If given,
+    `progress` is called on the calling thread as each call finishes,
+    as `progress(n_finished, n_objects, object, result)`.
+    """
+    objects = list(objects)
+    if not objects:
+        return []
+    signature = getattr(objects[0], method)
+    if not isinstance(signature, _wmi_method):
+        raise x_wmi("%s is not a method of %s" % (method, objects[0]))
+    if signature.in_parameters:
+        try:
+            signature._set_parameters(signature.in_parameters.SpawnInstance_(), (), params)
+        except pywintypes.com_error:
+            handle_com_error()
+
+    def call(namespace, n_object, path, class_name):
+        try:
+            arguments = [path, method]
+            if signature.in_parameters:
+                wmi_class = getattr(namespace, class_name)
+                parameters = wmi_class.ole_object.Methods_(method).InParameters.SpawnInstance_()
+                signature._set_parameters(parameters, (), params)
+                arguments.append(parameters)
+            result = host_limits.for_host(namespace.host).call(
+                namespace._namespace.ExecMethod, *arguments
+            )
+            return signature._out_values(result)
+        except pywintypes.com_error:
+            raise _com_exception(sys.exc_info()[1])
+
+    groups = {}
+    try:
+        for n_object, obj in enumerate(objects):
+            path = obj.ole_object.Path_
+            groups.setdefault(_server_host_key(path.Server), []).append(
+                (_object_connection(obj), (n_object, path.Path, path.Class))
+            )
+    except pywintypes.com_error:
+        handle_com_error()
+
+    results = [None] * len(objects)
+    n_finished = 0
+    for host, (n_object, _, _), result, error in _run_connected(groups, call, max_per_host):
+        results[n_object] = (objects[n_object], result if error is None else error)
+        n_finished += 1
+        if progress:
+            progress(n_finished, len(objects), objects[n_object], results[n_object][1])
+    return results
+
+_wmi_time_re = re.compile(r"(\d{4})(\d\d)(\d\d)(\d\d)(\d\d)(\d\d)\.(\d{6})([+-])(\d{3})$")
+def _iso_time(wmi_time):
+    """Return a WMI datetime as an ISO 8601 string, or unchanged if
+    it's an interval or has placeholder stars.
+    """
+    match = _wmi_time_re.match(wmi_time)
+    if not match:
+        return wmi_time
+    year, month, day, hours, minutes, seconds, microseconds, sign, offset = match.groups()
+    offset = int(offset)
+    return "%s-%s-%sT%s:%s:%s.%s%s%02d:%02d" % (
+        year, month, day, hours, minutes, seconds, microseconds, sign, offset // 60, offset % 60
+    )
+
+#
+# JSON encoder for each CIMTYPE whose value WMI returns in a form
+# JSON can't carry as it is. The rest are passed through.
+#
+_json_types = {
+    "datetime" : _iso_time,
+    "sint64" : int,
+    "uint64" : int,
+    "object" : _recordable,
+}
+
+def _json_encoders(definition, fields):
+    """Return a list of the encoders for `fields` of the class defined by
+    `definition` -- a function, or None where the value can be used as it is
+    """
+    properties = dict((name.lower(), (cimtype, is_array)) for name, cimtype, is_array in definition["properties"])
+    encoders = []
+    for field in fields:
+        cimtype, is_array = properties.get(field.lower(), (None, False))
+        encoder = _json_types.get((cimtype or "").split(":")[0])
+        if is_array:
+            encoder = _array_of(encoder) if encoder else list
+        encoders.append(encoder)
+    return encoders
+
+def _json_lines(namespace, class_name, fields=None):
+    """Stream the instances of `class_name` from `namespace` and yield
+    each as a line of JSON with its class and server and its `fields`,
+    by default all its properties, encoded according to their CIMTYPEs
+    """
+    definition = namespace._class_definition(class_name)
+    fields = list(fields or [p[0] for p in definition["properties"]])
+    encoders = list(zip(fields, _json_encoders(definition, fields)))
+    host = namespace.host
+    dumps = json.dumps
+    for values in namespace.stream(class_name, fields):
+        record = {"__CLASS" : class_name, "__SERVER" : host}
+        for (field, encoder), value in zip(encoders, values):
+            record[field] = value if encoder is None or value is None else encoder(value)
+        yield dumps(record, separators=(",", ":")) + "\n"
+
+def export_jsonl(namespaces, class_names, filepath, fields=None, compress=None, max_per_host=4):
+    """Write the instances of each of the WMI classes in `class_names`
+    from each of `namespaces` -- a :class:`_wmi_namespace` or a list of them --
+    to a file of JSON lines, one line per instance, gzipped if `compress` is
+    true or, when it's None, if `filepath` ends in `.gz`::
+
+        hosts = [wmi.WMI(host) for host in ("srv1", "srv2", "srv3")]
+        wmi.export_jsonl(hosts, ["Win32_Service", "Win32_QuickFixEngineering"], "inventory.jsonl.gz")
+
+    Each line is an object holding the instance's `__CLASS`, the `__SERVER`
+    it came from and its properties -- `fields`, which can be a list for every
+    class or a dictionary mapping class names to lists, or by default all of
+    them. The properties' CIMTYPEs, from the schema cache if the namespace
+    has one, decide how they're encoded: datetimes as ISO 8601 strings,
+    64-bit integers as numbers and arrays as lists.
+
+    Up to `max_per_host` classes are read at once from each host, by threads
+    with their own connections, and streamed straight to the file, so memory
+    use doesn't grow with the number of instances. The first error from any
+    class is raised once the rest have finished.
+
+    :returns: a dictionary mapping each `(host, class name)` to its number of lines
+    """
+    if isinstance(namespaces, _wmi_namespace):
+        namespaces = [namespaces]
+    f = _open_recording(filepath, "wb", compress)
+    lock = threading.Lock()
+
+    def export(namespace, class_name):
+        if isinstance(fields, dict):
+            class_fields = fields.get(class_name)
+        else:
+            class_fields = fields
+        n_lines = 0
+        for line in _json_lines(namespace, class_name, class_fields):
+            line = line.encode("utf-8")
+            with lock:
+                f.write(line)
+            n_lines += 1
+        return n_lines
+
+    counts = {}
+    error = None
+    try:
+        groups = {}
+        try:
+            for namespace in namespaces:
+                connection = namespace._connection_info()
+                for class_name in class_names:
+                    groups.setdefault(namespace.host, []).append((connection, (class_name,)))
+        except pywintypes.com_error:
+            handle_com_error()
+        for host, (class_name,), n_lines, task_error in _run_connected(groups, export, max_per_host):
+            if task_error is None:
+                counts[host, class_name] = n_lines
+            elif error is None:
+                error = task_error
+    finally:
+        f.close()
+    if error is not None:
+        if isinstance(error, pywintypes.com_error):
+            error = _com_exception(error)
+        raise error
+    return counts
+
+#
+# class _wmi_snapshot
+#
+class _wmi_snapshot(object):
+    """The instances of several classes on one host, taken at much the
+    same time by :meth:`_wmi_namespace.snapshot`, held in memory. For each
+    class it has its `definitions`, the `fields` queried, the `rows` of
+    their values, as :meth:`_wmi_namespace.stream` yields them, and the
+    `timings`, `counts` and `errors` of taking them. The snapshot as a
+    whole records the `host`, the time it was `taken` and its `elapsed_secs`.
+    """
+
+    def __init__(self):
+        self.host = None
+        self.taken = None
+        self.elapsed_secs = None
+        self.definitions = {}
+        self.fields = {}
+        self.rows = {}
+        self.timings = {}
+        self.counts = {}
+        self.errors = {}
+
+    def __repr__(self):
+        return "<_wmi_snapshot: %s; %d classes; %d rows>" % (
+            self.host, len(self.counts), sum(self.counts.values())
+        )
+
+    def __contains__(self, class_name):
+        return class_name in self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def add(self, class_name, fields, rows, definition=None):
+        """Take all of `rows`, tuples of the values of `fields`, as the
+        instances of `class_name`, returning the number of them. Each
+        class is added from its own thread. `definition` is the class's
+        definition as :meth:`_wmi_schema.definition` gives it.
+        """
+        self.definitions[class_name] = definition
+        self.fields[class_name] = list(fields)
+        self.rows[class_name] = class_rows = []
+        class_rows.extend(rows)
+        return len(class_rows)
+
+    def records(self, class_name):
+        """Return the instances of `class_name` as dictionaries mapping fields to values"""
+        fields = self.fields[class_name]
+        return [dict(zip(fields, row)) for row in self.rows[class_name]]
+
+#
+# Binary snapshots
+#
+# A snapshot file is a header, a segment for each host and class, a string
+# table and a JSON directory, followed by a trailer giving the directory's
+# position. A segment holds one column per field -- a null bitmap then one
+# fixed-width value per row: a 64-bit integer, a double, a byte for a boolean
+# or the index in the string table of a string or, for arrays, of their JSON
+# -- and, if the class's keys are among its fields, a key index of (string,
+# row) pairs sorted by the string. Everything is little-endian and aligned
+# to 8 bytes so that a reader can map the file and read just the segment
+# it needs.
+#
+SNAPSHOT_VERSION = 1
+_SNAPSHOT_MAGIC = b"WMISNAP\0"
+_snapshot_header = struct.Struct("<8sII")
+_snapshot_trailer = struct.Struct("<QQ8s")
+
+#
+# Column type, and struct format, for each CIMTYPE whose values can be held
+# as numbers. Values of any other CIMTYPE are held as strings.
+#
+_snapshot_types = {
+    "boolean" : "b",
+    "char16" : "q",
+    "sint8" : "q",
+    "sint16" : "q",
+    "sint32" : "q",
+    "sint64" : "q",
+    "uint8" : "q",
+    "uint16" : "q",
+    "uint32" : "q",
+    "uint64" : "Q",
+    "real32" : "d",
+    "real64" : "d",
+}
+
+def _snapshot_text(value):
+    """Return the text under which a value is held in the string table"""
+    if isinstance(value, (list, tuple)):
+        return json.dumps(_recordable(value))
+    elif isinstance(value, str):
+        return value
+    else:
+        return "%s" % (value,)
+
+def _snapshot_key(values):
+    return "\x1f".join("" if value is None else _snapshot_text(value) for value in values)
+
+def _utf8(text):
+    if isinstance(text, bytes):
+        return text
+    return text.encode("utf-8")
+
+def _padding(n_bytes):
+    return b"\0" * (-n_bytes % 8)
+
+class _wmi_snapshot_writer(object):
+    """Write the results of queries to a binary snapshot file which can be
+    read with :func:`read_snapshot`. It can be the `container` for
+    :meth:`_wmi_namespace.snapshot` -- as :func:`write_snapshot` uses it --
+    or be given the rows from :meth:`_wmi_namespace.stream` directly::
+
+        c = wmi.WMI()
+        with wmi._wmi_snapshot_writer("inventory.wmisnap") as writer:
+            fields = ["Name", "State", "StartMode"]
+            writer.add("Win32_Service", fields, c.stream("Win32_Service", fields), host=c.host)
+
+    Each class's rows are gathered into columns and written as a segment
+    once the last has arrived, so memory use is bounded by the largest class
+    rather than the whole snapshot. Each column's type comes from its
+    CIMTYPE in the class `definition`, if given, or else from its values.
+    The string table and directory are written by :meth:`close`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.host = None
+        self.taken = None
+        self.elapsed_secs = None
+        self.timings = {}
+        self.counts = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+        self._strings = {}
+        self._segments = []
+        self._file = open(path, "wb")
+        self._file.write(_snapshot_header.pack(_SNAPSHOT_MAGIC, SNAPSHOT_VERSION, 0))
+        self._position = _snapshot_header.size
+
+    def __repr__(self):
+        return "<_wmi_snapshot_writer: %s; %d segments>" % (self.path, len(self._segments))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _string(self, text):
+        """Return the index of `text` in the string table, adding it if needed"""
+        index = self._strings.get(text)
+        if index is None:
+            index = self._strings[text] = len(self._strings)
+        return index
+
+    def _column(self, values, cimtype):
+        """Return the type and the packed values of a column. Without a
+        CIMTYPE, integers are held as signed unless they only fit unsigned.
+        """
+        column_type = _snapshot_types.get((cimtype or "").split(":")[0])
+        if cimtype is None:
+            present = [value for value in values if value is not None]
+            if present and all(isinstance(value, bool) for value in present):
+                column_type = "b"
+            elif present and all(isinstance(value, numbers.Integral) and not isinstance(value, bool) for value in present):
+                low, high = min(present), max(present)
+                if -2 ** 63 <= low and high < 2 ** 63:
+                    column_type = "q"
+                elif 0 <= low and high < 2 ** 64:
+                    column_type = "Q"
+                else:
+                    raise x_wmi("Integers from %d to %d can't be held in one 64-bit column" % (low, high))
+            elif present and all(isinstance(value, numbers.Real) and not isinstance(value, bool) for value in present):
+                column_type = "d"
+        if column_type is not None:
+            try:
+                if column_type == "d":
+                    numeric = [0.0 if value is None else float(value) for value in values]
+                else:
+                    numeric = [0 if value is None else int(value) for value in values]
+                return column_type, struct.pack("<%d%s" % (len(values), column_type), *numeric)
+            except (ValueError, TypeError, struct.error):
+                pass
+        if any(isinstance(value, (list, tuple)) for value in values):
+            column_type, text = "j", lambda value: json.dumps(_recordable(value))
+        else:
+            column_type, text = "s", _snapshot_text
+        with self._lock:
+            indexes = [0 if value is None else self._string(text(value)) for value in values]
+        return column_type, struct.pack("<%dI" % len(values), *indexes)
+
+    def _write(self, data):
+        """Append `data`, padded to 8 bytes, returning its position"""
+        position = self._position
+        self._file.write(data + _padding(len(data)))
+        self._position += len(data) + len(_padding(len(data)))
+        return position
+
+    def add(self, class_name, fields, rows, definition=None, host=None):
+        """Take all of `rows`, tuples of the values of `fields`, as the
+        instances of `class_name` on `host`, by default :attr:`host`,
+        returning the number of them. `definition` is the class's definition
+        as :meth:`_wmi_schema.definition` gives it.
+        """
+        fields = list(fields)
+        columns = [[] for field in fields]
+        for row in rows:
+            for column, value in zip(columns, row):
+                column.append(value)
+        n_rows = len(columns[0]) if columns else 0
+
+        cimtypes = {}
+        keys = []
+        if definition:
+            cimtypes = dict((name.lower(), cimtype) for (name, cimtype, is_array) in definition["properties"])
+            keys = list(definition["keys"])
+        lower_fields = [field.lower() for field in fields]
+        packed = []
+        for field, column in zip(lower_fields, columns):
+            nulls = bytearray(-(-n_rows // 8))
+            for n_row, value in enumerate(column):
+                if value is None:
+                    nulls[n_row // 8] |= 1 << (n_row % 8)
+            column_type, values = self._column(column, cimtypes.get(field))
+            packed.append((column_type, bytes(nulls), values))
+
+        key_index = None
+        if keys and all(key.lower() in lower_fields for key in keys):
+            key_columns = [columns[lower_fields.index(key.lower())] for key in keys]
+            key_texts = [_snapshot_key(values) for values in zip(*key_columns)]
+            with self._lock:
+                pairs = sorted(
+                    (_utf8(text), self._string(text), n_row) for (n_row, text) in enumerate(key_texts)
+                )
+            key_index = b"".join(struct.pack("<II", index, n_row) for (_, index, n_row) in pairs)
+
+        with self._lock:
+            segment = dict(
+                host=host or self.host,
+                cls=class_name,
+                fields=fields,
+                keys=keys if key_index is not None else [],
+                rows=n_rows,
+                columns=[],
+                key_index=None,
+            )
+            for column_type, nulls, values in packed:
+                segment["columns"].append([column_type, self._write(nulls), self._write(values)])
+            if key_index is not None:
+                segment["key_index"] = self._write(key_index)
+            self._segments.append(segment)
+        return n_rows
+
+    def close(self):
+        """Write the string table, the directory and the trailer"""
+        if self._file.closed:
+            return
+        with self._lock:
+            texts = [None] * len(self._strings)
+            for text, index in self._strings.items():
+                texts[index] = _utf8(text)
+            offsets = [0]
+            for text in texts:
+                offsets.append(offsets[-1] + len(text))
+            strings = self._write(
+                struct.pack("<I", len(texts)) + _padding(4) +
+                struct.pack("<%dQ" % len(offsets), *offsets) +
+                b"".join(texts)
+            )
+            directory = _utf8(json.dumps(dict(
+                wmi_snapshot=SNAPSHOT_VERSION,
+                taken=self.taken,
+                strings=strings,
+                segments=self._segments,
+            )))
+            position = self._write(directory)
+            self._file.write(_snapshot_trailer.pack(position, len(directory), _SNAPSHOT_MAGIC))
+            self._file.close()
+
+class _wmi_snapshot_file(object):
+    """A binary snapshot file, written by :class:`_wmi_snapshot_writer`,
+    mapped into memory so that only the parts which are asked for are
+    read. Returned by :func:`read_snapshot`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, _ = _snapshot_header.unpack_from(self._map, 0)
+            position, length, trailer_magic = _snapshot_trailer.unpack_from(self._map, len(self._map) - _snapshot_trailer.size)
+        except (ValueError, struct.error):
+            magic = None
+        if magic != _SNAPSHOT_MAGIC or trailer_magic != _SNAPSHOT_MAGIC:
+            self._file.close()
+            raise x_wmi("%s is not a WMI snapshot" % path)
+        if version > SNAPSHOT_VERSION:
+            self.close()
+            raise x_wmi("%s was written in a later format (%s)" % (path, version))
+        directory = json.loads(self._map[position:position + length].decode("utf-8"))
+        self.taken = directory["taken"]
+        self._strings = directory["strings"]
+        self._n_strings, = struct.unpack_from("<I", self._map, self._strings)
+        self._segments = dict(((s["host"], s["cls"]), s) for s in directory["segments"])
+
+    def __repr__(self):
+        return "<_wmi_snapshot_file: %s; %d segments>" % (self.path, len(self._segments))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def hosts(self):
+        return sorted(set(host for (host, class_name) in self._segments))
+
+    def classes(self, host=None):
+        return sorted(set(class_name for (h, class_name) in self._segments if host is None or h == host))
+
+    def _segment(self, class_name, host):
+        if host is None:
+            matching = [s for ((h, c), s) in self._segments.items() if c == class_name]
+            if not matching:
+                raise x_wmi("No %s in this snapshot" % class_name)
+            elif len(matching) > 1:
+                raise x_wmi("%d hosts have %s in this snapshot: say which one" % (len(matching), class_name))
+            return matching[0]
+        try:
+            return self._segments[host, class_name]
+        except KeyError:
+            raise x_wmi("No %s from %s in this snapshot" % (class_name, host))
+
+    def _text(self, index):
+        start, end = struct.unpack_from("<QQ", self._map, self._strings + 8 + 8 * index)
+        base = self._strings + 8 + 8 * (self._n_strings + 1)
+        return self._map[base + start:base + end].decode("utf-8")
+
+    def _decode(self, column_type, value):
+        if column_type == "s":
+            return self._text(value)
+        elif column_type == "j":
+            return json.loads(self._text(value))
+        elif column_type == "b":
+            return bool(value)
+        else:
+            return value
+
+    def fields(self, class_name, host=None):
+        return list(self._segment(class_name, host)["fields"])
+
+    def count(self, class_name, host=None):
+        return self._segment(class_name, host)["rows"]
+
+    def rows(self, class_name, host=None):
+        """Yield a tuple of the values of the fields for each instance of
+        `class_name` from `host`, which can be left out if only one host has
+        the class. Only that class's segment of the file is read.
+        """
+        segment = self._segment(class_name, host)
+        n_rows = segment["rows"]
+        columns = []
+        for column_type, nulls, values in segment["columns"]:
+            fmt = "<%d%s" % (n_rows, "I" if column_type in "sj" else column_type)
+            columns.append((
+                column_type,
+                bytearray(self._map[nulls:nulls + -(-n_rows // 8)]),
+                struct.unpack_from(fmt, self._map, values),
+            ))
+        for n_row in range(n_rows):
+            yield tuple(
+                None if nulls[n_row // 8] & (1 << (n_row % 8)) else self._decode(column_type, values[n_row])
+                    for (column_type, nulls, values) in columns
+            )
+
+    def records(self, class_name, host=None):
+        """Yield each instance of `class_name` as a dictionary mapping fields to values"""
+        fields = self.fields(class_name, host)
+        for row in self.rows(class_name, host):
+            yield dict(zip(fields, row))
+
+    def _row(self, segment, n_row):
+        values = []
+        for column_type, nulls, offset in segment["columns"]:
+            if bytearray(self._map[nulls + n_row // 8:nulls + n_row // 8 + 1])[0] & (1 << (n_row % 8)):
+                values.append(None)
+            else:
+                fmt = "<I" if column_type in "sj" else "<" + column_type
+                value, = struct.unpack_from(fmt, self._map, offset + struct.calcsize(fmt) * n_row)
+                values.append(self._decode(column_type, value))
+        return tuple(values)
+
+    def get(self, class_name, key, host=None):
+        """Return the values of the instance of `class_name` whose key is
+        `key` -- a value or, for a class with several keys, a tuple of them in
+        the order of the class's keys -- or None if there isn't one. The
+        instance is found by a binary search of the class's key index.
+        """
+        segment = self._segment(class_name, host)
+        if segment["key_index"] is None:
+            raise x_wmi("%s has no key index in this snapshot" % class_name)
+        if not isinstance(key, tuple):
+            key = (key,)
+        wanted = _utf8(_snapshot_key(key))
+        offset = segment["key_index"]
+        lo, hi = 0, segment["rows"]
+        while lo < hi:
+            middle = (lo + hi) // 2
+            index, n_row = struct.unpack_from("<II", self._map, offset + 8 * middle)
+            text = _utf8(self._text(index))
+            if text < wanted:
+                lo = middle + 1
+            elif text > wanted:
+                hi = middle
+            else:
+                return self._row(segment, n_row)
+        return None
+
+def write_snapshot(namespaces, manifest, path, max_concurrent=8):
+    """Take a snapshot, with :meth:`_wmi_namespace.snapshot`, of the classes
+    in `manifest` from each of `namespaces` -- a :class:`_wmi_namespace` or a
+    list of them -- and write it to a binary snapshot file at `path` which
+    :func:`read_snapshot` can read::
+
+        hosts = [wmi.WMI(host) for host in ("srv1", "srv2", "srv3")]
+        wmi.write_snapshot(hosts, {"Win32_Service" : ["Name", "State"], "Win32_LogicalDisk" : None}, "fleet.wmisnap")
+
+    :returns: a dictionary mapping each host to a dictionary mapping each
+        class which couldn't be read to its exception
+    """
+    if isinstance(namespaces, _wmi_namespace):
+        namespaces = [namespaces]
+    errors = {}
+    with _wmi_snapshot_writer(path) as writer:
+        for namespace in namespaces:
+            namespace.snapshot(manifest, max_concurrent, writer)
+            errors[writer.host] = dict(writer.errors)
+            writer.errors.clear()
+    return errors
+
+def read_snapshot(path):
+    """Open a binary snapshot file written by :func:`write_snapshot` and
+    return a :class:`_wmi_snapshot_file` which reads only the parts of it
+    which are asked for::
+
+        with wmi.read_snapshot("fleet.wmisnap") as snapshot:
+            print(snapshot.get("Win32_Service", "Spooler", host="srv2"))
+            for name, state in snapshot.rows("Win32_Service", host="srv1"):
+                print(name, state)
+    """
+    return _wmi_snapshot_file(path)
+
+#
+# class _wmi_write_batch
+#
+_write_batches = threading.local()
+
+def _write_batch():
+    """Return the :class:`_wmi_write_batch` collecting this thread's writes, if any"""
+    return getattr(_write_batches, "batch", None)
+
+class _wmi_write_batch(object):
+    """Collect the objects whose properties are changed while the batch
+    is in force on the current thread and write each of them once,
+    concurrently, when it's flushed. Returned by :func:`deferred_writes`.
+
+    `mode` is one of "create-or-update" (the default), "update-only"
+    or "create-only", corresponding to the `wbemChangeFlag` passed to
+    `Put_`; up to `max_per_host` objects are written at once to any
+    one host.
+
+    The writes are made by threads with their own connections to the
+    hosts, so each object is read again there, from its path, and the
+    properties which were set on it are copied across before it's
+    written; where that isn't known (after :meth:`_wmi_object.put`) every
+    property whose value differs is. An object with no path, or in
+    "create-only" mode, is written as a new instance of its class.
+    """
+
+    modes = {
+        "create-or-update" : wbemChangeFlagCreateOrUpdate,
+        "update-only" : wbemChangeFlagUpdateOnly,
+        "create-only" : wbemChangeFlagCreateOnly,
+    }
+
+    def __init__(self, mode="create-or-update", max_per_host=8):
+        if mode not in self.modes:
+            raise x_wmi("mode must be one of %s" % ", ".join(sorted(self.modes)))
+        self.mode = mode
+        self.max_per_host = max_per_host
+        self._objects = collections.OrderedDict()
+        self._changed = {}
+        self._previous = None
+
+    def __repr__(self):
+        return "<_wmi_write_batch: %s; %d pending>" % (self.mode, len(self._objects))
+
+    def __len__(self):
+        return len(self._objects)
+
+    def __enter__(self):
+        self._previous = _write_batch()
+        _write_batches.batch = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _write_batches.batch = self._previous
+        if exc_type is None:
+            failures = self.flush()
+            if failures:
+                raise x_wmi_write_failed(
+                    "%d of the objects could not be written" % len(failures),
+                    failures=failures
+                )
+        else:
+            self.discard()
+
+    def add(self, obj, attributes=None):
+        """Add a :class:`_wmi_object` to be written when the batch is flushed,
+        noting which of its `attributes` have been set: None if it's not known
+        """
+        key = id(obj)
+        if key not in self._objects:
+            self._objects[key] = obj
+            self._changed[key] = set()
+        if attributes is None:
+            self._changed[key] = None
+        elif self._changed[key] is not None:
+            self._changed[key].update(attributes)
+
+    def discard(self):
+        """Forget the objects waiting to be written"""
+        self._objects.clear()
+        self._changed.clear()
+
+    def flush(self):
+        """Write every object waiting to be written, returning a list
+        of `(object, exception)` for those which failed.
+        """
+        changed = [self._changed[key] for key in self._objects]
+        objects = list(self._objects.values())
+        self.discard()
+        flags = self.modes[self.mode]
+        not_found = signed_to_unsigned(wbemErrNotFound)
+
+        def put(namespace, n_object, path, class_name, values, changed):
+            services = namespace._namespace
+            try:
+                target = None
+                if path and flags != wbemChangeFlagCreateOnly:
+                    try:
+                        target = services.Get(path)
+                    except pywintypes.com_error:
+                        if flags == wbemChangeFlagUpdateOnly or not_found not in _com_error_codes(sys.exc_info()[1]):
+                            raise
+                if target is None:
+                    target = getattr(namespace, class_name).ole_object.SpawnInstance_()
+                    changed = None
+                for name in (values if changed is None else changed):
+                    property = target.Properties_(name)
+                    if property.Value != values[name]:
+                        property.Value = values[name]
+                host_limits.for_host(namespace.host).call(target.Put_, flags)
+            except pywintypes.com_error:
+                raise _com_exception(sys.exc_info()[1])
+
+        groups = {}
+        try:
+            for n_object, obj in enumerate(objects):
+                path = obj.ole_object.Path_
+                values = dict((p.Name, p.Value) for p in obj.ole_object.Properties_)
+                groups.setdefault(_server_host_key(path.Server), []).append((
+                    _object_connection(obj),
+                    (n_object, path.Path, path.Class, values, changed[n_object])
+                ))
+        except pywintypes.com_error:
+            handle_com_error()
+
+        failures = []
+        for host, (n_object, _, _, _, _), result, error in _run_connected(groups, put, self.max_per_host):
+            if error is not None:
+                failures.append((n_object, error))
+        return [(objects[n_object], error) for n_object, error in sorted(failures)]
+
+def deferred_writes(mode="create-or-update", max_per_host=8):
+    """Return a :class:`_wmi_write_batch` which, used as a context
+    manager, holds back the writes which setting properties would
+    otherwise make at once, and makes them when the block ends: each
+    object once, however many of its properties were set, and up to
+    `max_per_host` objects at a time per host::
+
+        c = wmi.WMI()
+        with wmi.deferred_writes(mode="update-only"):
+            for variable in c.Win32_Environment(UserName="<SYSTEM>"):
+                variable.VariableValue = variable.VariableValue.strip()
+
+    If any object can't be written, :exc:`x_wmi_write_failed` is raised
+    once the others have been, listing the failures. If the block
+    raises an exception, nothing is written.
+    """
+    return _wmi_write_batch(mode, max_per_host)
+
+#
+# class _wmi_event_thread
+#
+class _wmi_event_thread(threading.Thread):
+    """Wait for the events of one :class:`_wmi_watcher` on a thread of
+    its own, passing each raw event to `callback` as
+    `callback(watcher, event, error)`. The thread connects to the
+    watcher's namespace itself and runs the watcher's notification
+    query on that connection, so that waiting for events doesn't go
+    through the thread which made the watcher. Once it has subscribed,
+    :meth:`start` releases the watcher's own subscription, as nothing
+    would take its events. If
+    connecting or waiting fails with anything other than a timeout,
+    `callback` is called with the corresponding :exc:`x_wmi` as its
+    `error` and the thread finishes.
+
+    The thread is in COM's multithreaded apartment so that the events
+    it hands on can be used from other threads without its having to
+    pump messages for them, but the callback runs on this thread and
+    must :func:`_marshal` the event if it is to be used by another.
+
+    `NextEvent` is called with a timeout of `poll_ms` so that
+    :meth:`stop` is noticed reasonably promptly. Once the thread
+    finishes, its reference to the event source is released which
+    cancels the underlying notification query.
+    """
+
+    def __init__(self, watcher, callback, poll_ms=500):
+        threading.Thread.__init__(self)
+        if watcher.wql is None or watcher._namespace is None:
+            raise x_wmi("Only a watcher from watch_for can be waited on by another thread")
+        self.daemon = True
+        self.watcher = watcher
+        self.callback = callback
+        self.poll_ms = poll_ms
+        self._connection = watcher._namespace._connection_info()
+        self._subscribed = threading.Event()
+        self._stopping = threading.Event()
+
+    def start(self):
+        threading.Thread.start(self)
+        self._subscribed.wait()
+        self.watcher.wmi_event = None
+
+    def run(self):
+        timed_out = signed_to_unsigned(wbemErrTimedout)
+        pythoncom.CoInitializeEx(pythoncom.COINIT_MULTITHREADED)
+        try:
+            event_source = None
+            try:
+                arguments, schema = self._connection
+                namespace = connect(**arguments)
+                namespace._schema = schema
+                event_source = namespace._namespace.ExecNotificationQuery(self.watcher.wql)
+            except pywintypes.com_error:
+                self.callback(self.watcher, None, _com_exception(sys.exc_info()[1]))
+            except x_wmi:
+                self.callback(self.watcher, None, sys.exc_info()[1])
+            finally:
+                self._subscribed.set()
+            try:
+                while event_source is not None and not self._stopping.is_set():
+                    try:
+                        event = event_source.NextEvent(self.poll_ms)
+                    except pywintypes.com_error:
+                        err = sys.exc_info()[1]
+                        if timed_out in _com_error_codes(err):
+                            continue
+                        self.callback(self.watcher, None, _com_exception(err))
+                        break
+                    self.callback(self.watcher, event, None)
+            finally:
+                namespace = event_source = event = None
+        finally:
+            pythoncom.CoUninitialize()
+
+    def stop(self, wait=True):
+        self._stopping.set()
+        if wait and self.is_alive() and self is not threading.current_thread():
+            self.join()
+
+#
+# class _wmi_multiplexer
+#
+class _wmi_multiplexer(object):
+    """Deliver the events of many watchers, in the order they arrive,
+    through one blocking call rather than polling each watcher in turn.
+    Each watcher is waited on by a :class:`_wmi_event_thread` of its
+    own, with its own connection, all of which feed a single queue; the
+    watchers shouldn't then be called directly. Raw notification queries
+    can be added too, with the namespace to run them against. Returned
+    by :func:`multiplex`::
+
+        c = wmi.WMI(privileges=["Security"])
+        errors = c.Win32_NTLogEvent.watch_for("creation", Type="error")
+        warnings = c.Win32_NTLogEvent.watch_for("creation", Type="warning")
+        with wmi.multiplex(errors, warnings) as events:
+            for watcher, log in events:
+                print(watcher is errors, log)
+
+    Events are wrapped by the watcher they came from, in the thread
+    which calls :meth:`next`. If waiting on one of the watchers fails,
+    :meth:`next` raises the error when it gets to it; the other
+    watchers carry on.
+    """
+
+    def __init__(self, watchers=(), poll_ms=500):
+        self.poll_ms = poll_ms
+        self._queue = queue.Queue()
+        self._threads = []
+        for watcher in watchers:
+            self.add(watcher)
+
+    def __repr__(self):
+        return "<_wmi_multiplexer: %d watchers>" % len(self._threads)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        while True:
+            yield self.next()
+
+    def add(self, watcher, namespace=None):
+        """Start waiting on `watcher`: a :class:`_wmi_watcher` or a raw
+        notification query to be set up against `namespace`. Returns
+        the watcher, which will be paired with each of its events.
+        """
+        if not isinstance(watcher, _wmi_watcher):
+            if namespace is None:
+                raise x_wmi_no_namespace("A raw notification query needs a namespace to run against")
+            watcher = namespace.watch_for(raw_wql=watcher)
+        thread = _wmi_event_thread(watcher, self._deliver, self.poll_ms)
+        self._threads.append(thread)
+        thread.start()
+        return watcher
+
+    def _deliver(self, watcher, event, error):
+        if event is None:
+            self._queue.put((watcher, None, error))
+        else:
+            self._queue.put((watcher, _marshal(event), error))
+
+    def next(self, timeout_ms=-1):
+        """Return `(watcher, event)` for the next event from any of the
+        watchers, waiting up to `timeout_ms` milliseconds (defaulting to
+        infinite). If none arrives, :exc:`x_wmi_timed_out` is raised.
+        """
+        try:
+            if timeout_ms < 0:
+                watcher, stream, error = self._queue.get()
+            else:
+                watcher, stream, error = self._queue.get(True, timeout_ms / 1000.0)
+        except queue.Empty:
+            raise x_wmi_timed_out("No event within %d ms" % timeout_ms)
+        if error is not None:
+            raise error
+        try:
+            return watcher, watcher._wrap(_unmarshal(stream))
+        except pywintypes.com_error:
+            handle_com_error()
+
+    __call__ = next
+
+    def close(self):
+        """Stop waiting on all the watchers"""
+        for thread in self._threads:
+            thread.stop(wait=False)
+        for thread in self._threads:
+            thread.stop()
+        self._threads = []
+
+#
+# class _wmi_event_pump
+#
+class _wmi_event_pump(object):
+    """A managed subscription: wait for a watcher's events on a
+    :class:`_wmi_event_thread`, which has its own connection and
+    subscription, and hold them in a bounded queue from which the
+    consumer takes them at its own pace, without having to pump
+    messages for the thread. Returned by :meth:`_wmi_watcher.pump`::
+
+        watcher = c.Win32_Process.watch_for("creation")
+        with watcher.pump(maxsize=10000, overflow="drop-oldest") as events:
+            for process in events:
+                handle(process)
+
+    What happens when the queue is full is set by `overflow`:
+
+    * "block" - stop taking events from WMI until there's room. The
+      events back up inside WMI which may itself start to drop them.
+    * "drop-oldest" - discard the oldest waiting event to make room.
+    * "drop-newest" - discard the new event.
+    * "coalesce" - if an event for the same instance (by its
+      TargetInstance path) is already waiting, replace it with the
+      new one so that only the latest state is delivered; otherwise
+      discard the oldest waiting event.
+
+    :meth:`stats` reports how many events were received, delivered,
+    dropped and coalesced, and how many were `lagged`: delivered
+    more than `lag_ms` milliseconds after they arrived.
+    """
+
+    OVERFLOW_POLICIES = ("block", "drop-oldest", "drop-newest", "coalesce")
+
+    def __init__(self, watcher, maxsize=1000, overflow="block", lag_ms=1000, poll_ms=500):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise x_wmi("overflow must be one of %s" % ", ".join(self.OVERFLOW_POLICIES))
+        self.watcher = watcher
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.lag_ms = lag_ms
+        self.received = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.lagged = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        #
+        # Each entry is [key, marshalled event or None, error or None, arrival time]
+        #
+        self._entries = collections.deque()
+        self._entries_by_key = {}
+        self._thread = _wmi_event_thread(watcher, self._receive, poll_ms)
+        self._thread.start()
+
+    def __repr__(self):
+        return "<_wmi_event_pump: %d/%d queued, %s>" % (len(self._entries), self.maxsize, self.overflow)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        while True:
+            try:
+                event = self.get()
+            except x_wmi:
+                if self._closed:
+                    return
+                raise
+            yield event
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _discard(stream):
+        """Release a marshalled event which is not going to be delivered"""
+        try:
+            _unmarshal(stream)
+        except pywintypes.com_error:
+            pass
+
+    @staticmethod
+    def _key(event):
+        try:
+            return event.Properties_("TargetInstance").Value.Path_.RelPath
+        except (pywintypes.com_error, AttributeError):
+            return None
+
+    def _pop_oldest(self):
+        entry = self._entries.popleft()
+        if self._entries_by_key.get(entry[0]) is entry:
+            del self._entries_by_key[entry[0]]
+        return entry
+
+    def _receive(self, watcher, event, error):
+        """Called on the pump's thread for each event as it arrives"""
+        now = time.time()
+        if error is not None:
+            with self._condition:
+                self._entries.append([None, None, error, now])
+                self._condition.notify_all()
+            return
+
+        key = None
+        if self.overflow == "coalesce":
+            key = self._key(event)
+        stream = _marshal(event)
+        with self._condition:
+            self.received += 1
+            if len(self._entries) >= self.maxsize:
+                if self.overflow == "block":
+                    while len(self._entries) >= self.maxsize and not self._closed:
+                        self._condition.wait(0.5)
+                    if self._closed:
+                        self._discard(stream)
+                        return
+                elif self.overflow == "drop-newest":
+                    self.dropped += 1
+                    self._discard(stream)
+                    return
+                elif self.overflow == "coalesce" and key is not None and key in self._entries_by_key:
+                    entry = self._entries_by_key[key]
+                    self._discard(entry[1])
+                    entry[1] = stream
+                    self.coalesced += 1
+                    return
+                else:
+                    self.dropped += 1
+                    self._discard(self._pop_oldest()[1])
+
+            entry = [key, stream, None, now]
+            self._entries.append(entry)
+            if key is not None:
+                self._entries_by_key[key] = entry
+            self._condition.notify_all()
+
+    def get(self, timeout_ms=-1):
+        """Return the next event, waiting up to `timeout_ms` milliseconds
+        (defaulting to infinite) for one to arrive. If none does,
+        :exc:`x_wmi_timed_out` is raised. If waiting for events failed,
+        the error is raised once the events before it have been delivered.
+        Once the pump is closed, including while waiting, :exc:`x_wmi`
+        is raised; iterating over the pump simply stops.
+        """
+        if timeout_ms >= 0:
+            deadline = time.time() + timeout_ms / 1000.0
+        with self._condition:
+            while not self._entries:
+                if self._closed:
+                    raise x_wmi("The event pump has been closed")
+                if timeout_ms < 0:
+                    self._condition.wait(0.5)
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise x_wmi_timed_out("No event within %d ms" % timeout_ms)
+                    self._condition.wait(remaining)
+            key, stream, error, arrived = self._pop_oldest()
+            self._condition.notify_all()
+            if error is not None:
+                raise error
+            self.delivered += 1
+            if (time.time() - arrived) * 1000 > self.lag_ms:
+                self.lagged += 1
+        try:
+            return self.watcher._wrap(_unmarshal(stream))
+        except pywintypes.com_error:
+            handle_com_error()
+
+    __call__ = get
+
+    def stats(self):
+        """Return a dictionary of the pump's counters"""
+        with self._condition:
+            return dict(
+                received=self.received,
+                delivered=self.delivered,
+                dropped=self.dropped,
+                coalesced=self.coalesced,
+                lagged=self.lagged,
+                queued=len(self._entries),
+            )
+
+    def close(self):
+        """Stop waiting for events and release any which haven't been delivered"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.stop()
+        with self._condition:
+            while self._entries:
+                stream = self._pop_oldest()[1]
+                if stream is not None:
+                    self._discard(stream)
+
+def multiplex(*watchers, **kwargs):
+    """Return a :class:`_wmi_multiplexer` delivering the events of all
+    the `watchers` in the order they arrive. `poll_ms` sets how often
+    the waiting threads check whether they've been stopped.
+    """
+    return _wmi_multiplexer(watchers, **kwargs)
 
 #
-# class _wmi_watcher
+# class _wmi_sink_thread
 #
-class _wmi_watcher(object):
-    """Helper class for WMI.watch_for below(qv)"""
+class _wmi_sink_events(object):
+    """Event handlers for the `SWbemSink` objects created by
+    :class:`_wmi_sink_thread`. Each sink is told which subscriber
+    it's working for by having a `_wmi_subscriber` attribute set.
+    """
 
-    _event_property_map = {
-        "TargetInstance" : _wmi_object,
-        "PreviousInstance" : _wmi_object
-    }
-    def __init__(self, wmi_event, is_extrinsic, fields=[]):
-        self.wmi_event = wmi_event
-        self.is_extrinsic = is_extrinsic
-        self.fields = fields
+    def OnObjectReady(self, event, context):
+        subscriber = self.__dict__.get("_wmi_subscriber")
+        if subscriber is not None:
+            subscriber._sink_event(event, None)
 
-    def __call__(self, timeout_ms=-1):
-        """When called, return the instance which caused the event. Supports
-         timeout in milliseconds (defaulting to infinite). If the watcher
-         times out, :exc:`x_wmi_timed_out` is raised. This makes it easy to support
-         watching for multiple objects.
+    def OnCompleted(self, hresult, error_object, context):
+        subscriber = self.__dict__.get("_wmi_subscriber")
+        if subscriber is not None and hresult:
+            subscriber._sink_event(
+                None, x_wmi("Notification query ended with error %08X" % signed_to_unsigned(hresult))
+            )
+
+class _wmi_sink_thread(threading.Thread):
+    """One thread, initialised for COM, holding any number of
+    asynchronous notification queries (`ExecNotificationQueryAsync`)
+    and pumping the messages which deliver their events to the
+    subscribers' sinks. The queries run on the thread's own connections,
+    made as they're needed, so that nothing waits on the subscribers'
+    threads. Other threads hand it work via :meth:`call`. There is only
+    ever one of these: see :func:`_get_sink_thread`.
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._calls = queue.Queue()
+        self._wakeup = win32event.CreateEvent(None, 0, 0, None)
+        self._sinks = {}
+        self._namespaces = {}
+
+    def call(self, function, *args):
+        """Arrange for `function(*args)` to run on the sink thread. If it
+        raises an exception, a warning is given and the thread carries on.
         """
+        self._calls.put((function, args))
+        win32event.SetEvent(self._wakeup)
+
+    def run(self):
+        pythoncom.CoInitialize()
         try:
-            event = self.wmi_event.NextEvent(timeout_ms)
-            if self.is_extrinsic:
-                return _wmi_event(event, None, self.fields)
-            else:
-                return _wmi_event(
-                    event.Properties_("TargetInstance").Value,
-                    _wmi_object(event, property_map=self._event_property_map),
-                    self.fields
+            while True:
+                result = win32event.MsgWaitForMultipleObjects(
+                    [self._wakeup], False, win32event.INFINITE, win32event.QS_ALLINPUT
                 )
+                if result == win32event.WAIT_OBJECT_0:
+                    while True:
+                        try:
+                            function, args = self._calls.get_nowait()
+                        except queue.Empty:
+                            break
+                        try:
+                            function(*args)
+                        except Exception:
+                            warnings.warn("Error on the WMI sink thread: %s" % sys.exc_info()[1])
+                else:
+                    pythoncom.PumpWaitingMessages()
+        finally:
+            self._sinks.clear()
+            self._namespaces.clear()
+            pythoncom.CoUninitialize()
+
+    def subscribe(self, subscriber, connection, wql):
+        """Start the notification query `wql` against the namespace which
+        `connection` -- the arguments to :func:`connect` -- describes,
+        passing each event or error to the subscriber's `_sink_event`
+        method, called on the sink thread.
+        """
+        self.call(self._subscribe, subscriber, connection, wql)
+
+    def _subscribe(self, subscriber, connection, wql):
+        try:
+            key = repr(sorted(connection.items()))
+            namespace = self._namespaces.get(key)
+            if namespace is None:
+                namespace = self._namespaces[key] = connect(**connection)
+            sink = DispatchWithEvents("WbemScripting.SWbemSink", _wmi_sink_events)
+            sink._wmi_subscriber = subscriber
+            namespace._namespace.ExecNotificationQueryAsync(sink, wql)
+        except pywintypes.com_error:
+            subscriber._sink_event(None, _com_exception(sys.exc_info()[1]))
+        except x_wmi:
+            subscriber._sink_event(None, sys.exc_info()[1])
+        else:
+            self._sinks[id(subscriber)] = sink
+
+    def unsubscribe(self, subscriber, callback=None):
+        """Cancel the subscriber's notification query and then, if it's
+        given, call `callback()` on the sink thread.
+        """
+        self.call(self._unsubscribe, subscriber, callback)
+
+    def _unsubscribe(self, subscriber, callback):
+        sink = self._sinks.pop(id(subscriber), None)
+        if sink is not None:
+            sink._wmi_subscriber = None
+            try:
+                sink.Cancel()
+            except pywintypes.com_error:
+                pass
+        if callback is not None:
+            callback()
+
+_sink_thread = None
+_sink_thread_lock = threading.Lock()
+def _get_sink_thread():
+    """Return the module's one :class:`_wmi_sink_thread`, starting it --
+    or starting it again, if it has died -- if needed
+    """
+    global _sink_thread
+    with _sink_thread_lock:
+        if _sink_thread is None or not _sink_thread.is_alive():
+            _sink_thread = _wmi_sink_thread()
+            _sink_thread.start()
+        return _sink_thread
+
+#
+# class _wmi_async_watcher
+#
+class _wmi_async_watcher(object):
+    """Asynchronous iterator over the events of a notification query,
+    for use with asyncio. Returned by :meth:`_wmi_namespace.watch_for_async`.
+
+    Events arrive on the shared :class:`_wmi_sink_thread` and are passed
+    over to the event loop's thread, where they are wrapped as a
+    :class:`_wmi_watcher` would wrap them and either handed to the
+    waiting `__anext__` or buffered until it's called.
+    """
+
+    def __init__(self, connection, wql, is_extrinsic, fields=[], timeout=None, loop=None, is_aggregate=False):
+        self.wql = wql
+        self.timeout = timeout
+        self._wrapper = _wmi_watcher(None, is_extrinsic, fields, is_aggregate=is_aggregate)
+        self._loop = loop or asyncio.get_event_loop()
+        self._buffer = collections.deque()
+        self._waiter = None
+        self._timer = None
+        self._closed = False
+        self._sink_thread = _get_sink_thread()
+        self._sink_thread.subscribe(self, connection, wql)
+
+    def __repr__(self):
+        return "<_wmi_async_watcher: %s>" % self.wql
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        future = self._loop.create_future()
+        if self._waiter is not None:
+            future.set_exception(RuntimeError("Another task is already waiting for the next event"))
+        elif self._buffer:
+            self._resolve(future, *self._buffer.popleft())
+        elif self._closed:
+            future.set_exception(StopAsyncIteration())
+        else:
+            self._waiter = future
+            future.add_done_callback(self._waiter_done)
+            if self.timeout is not None:
+                self._timer = self._loop.call_later(self.timeout, self._time_out, future)
+        return future
+
+    def __aenter__(self):
+        future = self._loop.create_future()
+        future.set_result(self)
+        return future
+
+    def __aexit__(self, *args):
+        return self.aclose()
+
+    def _resolve(self, future, stream, error):
+        if error is not None:
+            future.set_exception(error)
+        else:
+            try:
+                future.set_result(self._wrapper._wrap(_unmarshal(stream)))
+            except pywintypes.com_error:
+                future.set_exception(_com_exception(sys.exc_info()[1]))
+
+    def _sink_event(self, event, error):
+        """Called on the sink thread for each event"""
+        stream = None if event is None else _marshal(event)
+        try:
+            self._loop.call_soon_threadsafe(self._on_event, stream, error)
+        except RuntimeError:
+            #
+            # The loop has been closed: nobody is listening
+            #
+            self._sink_thread.unsubscribe(self)
+
+    def _on_event(self, stream, error):
+        """Called on the event loop's thread for each event"""
+        if self._closed:
+            if stream is not None:
+                _wmi_event_pump._discard(stream)
+        elif self._waiter is not None and not self._waiter.done():
+            waiter, self._waiter = self._waiter, None
+            self._cancel_timer()
+            self._resolve(waiter, stream, error)
+        else:
+            self._buffer.append((stream, error))
+
+    def _time_out(self, future):
+        if not future.done():
+            self._waiter = None
+            future.set_exception(asyncio.TimeoutError())
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _waiter_done(self, future):
+        if future.cancelled():
+            self._waiter = None
+            self.close()
+
+    def close(self):
+        """Cancel the notification query. Any events already buffered are released."""
+        if not self._closed:
+            self._closed = True
+            self._cancel_timer()
+            self._sink_thread.unsubscribe(self)
+            while self._buffer:
+                stream, error = self._buffer.popleft()
+                if stream is not None:
+                    _wmi_event_pump._discard(stream)
+            if self._waiter is not None and not self._waiter.done():
+                self._waiter.set_exception(StopAsyncIteration())
+            self._waiter = None
+
+    def aclose(self):
+        """Cancel the notification query, returning a future which is
+        done once the cancellation has gone through on the sink thread.
+        """
+        future = self._loop.create_future()
+        def _done():
+            if not future.done():
+                future.set_result(None)
+        if self._closed:
+            future.set_result(None)
+        else:
+            self.close()
+            self._sink_thread.call(self._loop.call_soon_threadsafe, _done)
+        return future
+
+#
+# class _wmi_schema
+#
+SCHEMA_VERSION = 1
+
+class _wmi_schema(object):
+    """The definitions of the classes in one namespace: for each class,
+    its superclass and derivation, its properties with their CIMTYPE
+    and arrayness, its keys, its methods with their parameters, and
+    its qualifiers. A namespace with a schema -- see :func:`connect`
+    with `cache_schema=True` -- answers :meth:`_wmi_namespace.subclasses_of`
+    and builds its :class:`_wmi_class` objects from the schema without
+    asking WMI, only fetching a class from WMI when it's really needed,
+    eg to call a method or to spawn an instance.
+    """
+
+    def __init__(self, definitions=None, fingerprint=None, saved=None):
+        self.definitions = definitions or {}
+        self.fingerprint = fingerprint
+        self.saved = saved
+
+    def __repr__(self):
+        return "<_wmi_schema: %d classes>" % len(self.definitions)
+
+    def __contains__(self, class_name):
+        return class_name in self.definitions
+
+    def get(self, class_name):
+        """Return the definition of a class, or None if it's not known"""
+        return self.definitions.get(class_name)
+
+    def subclasses_of(self, root=""):
+        """Return the names of all the classes derived, however indirectly,
+        from `root` or, if `root` is empty, of all the classes.
+        """
+        if not root:
+            return set(self.definitions)
+        return set(name for name, definition in self.definitions.items() if root in definition["derivation"])
+
+    @staticmethod
+    def _parameters(parameters):
+        if parameters is None:
+            return []
+        return [
+            [p.Name, p.Qualifiers_("CIMTYPE").Value, p.IsArray]
+                for p in parameters.Properties_
+        ]
+
+    @classmethod
+    def definition(cls, wmi_class):
+        """Return the definition of a class, given its raw COM object,
+        as a dictionary which can be stored as JSON.
+        """
+        properties = []
+        keys = []
+        for p in wmi_class.Properties_:
+            cimtype = None
+            for q in p.Qualifiers_:
+                if q.Name == "CIMTYPE":
+                    cimtype = q.Value
+                elif q.Name == "key" and q.Value:
+                    keys.append(p.Name)
+            properties.append([p.Name, cimtype, p.IsArray])
+        methods = {}
+        for m in wmi_class.Methods_:
+            methods[m.Name] = dict(
+                in_parameters=cls._parameters(m.InParameters),
+                out_parameters=cls._parameters(m.OutParameters),
+                qualifiers=dict((q.Name, _recordable(q.Value)) for q in m.Qualifiers_)
+            )
+        derivation = list(wmi_class.Derivation_)
+        return dict(
+            name=wmi_class.Path_.Class,
+            path=wmi_class.Path_.DisplayName,
+            superclass=derivation[0] if derivation else None,
+            derivation=derivation,
+            properties=properties,
+            keys=keys,
+            methods=methods,
+            qualifiers=dict((q.Name, _recordable(q.Value)) for q in wmi_class.Qualifiers_)
+        )
+
+    @classmethod
+    def build(cls, services, fingerprint=None):
+        """Read the definitions of every class in the namespace
+        represented by `services`, a raw `SWbemServices` object.
+        """
+        try:
+            definitions = dict(
+                (c.Path_.Class, cls.definition(c)) for c in services.SubclassesOf("")
+            )
+        except pywintypes.com_error:
+            handle_com_error()
+        return cls(definitions, fingerprint, time.time())
+
+    @staticmethod
+    def fingerprint(services):
+        """Return a value which changes when the schema of the namespace
+        represented by `services` is likely to have changed: a hash of
+        the names and CLSIDs of its providers, which change when
+        the software which adds classes is installed or removed.
+        """
+        providers = sorted(
+            (p.Properties_("Name").Value or "", p.Properties_("CLSID").Value or "")
+                for p in services.ExecQuery("SELECT Name, CLSID FROM __Win32Provider")
+        )
+        digest = hashlib.sha1()
+        for name, clsid in providers:
+            digest.update(("%s=%s\n" % (name, clsid)).encode("utf-8"))
+        return digest.hexdigest()
+
+    def to_dict(self):
+        return dict(
+            version=SCHEMA_VERSION,
+            fingerprint=self.fingerprint,
+            saved=self.saved,
+            classes=self.definitions
+        )
+
+    @classmethod
+    def from_dict(cls, data):
+        """Return the schema stored in `data` by :meth:`to_dict`, or
+        None if it was stored by a different version of the module.
+        """
+        if data.get("version") != SCHEMA_VERSION:
+            return None
+        return cls(data["classes"], data.get("fingerprint"), data.get("saved"))
+
+#
+# class _wmi_class_index
+#
+class _wmi_class_index(object):
+    """The derivation tree of the classes in one namespace, held in memory
+    so that questions about subclasses and ancestors don't need WMI. Class
+    names are matched without regard to case, as WMI matches them. Each
+    namespace has one as its :attr:`_wmi_namespace.class_index`::
+
+        c = wmi.WMI()
+        index = c.class_index
+        print(index.children("CIM_LogicalDisk"))
+        print(index.isa("Win32_ProcessStartTrace", "__ExtrinsicEvent"))
+        print(index.with_prefix("Win32_Net"))
+    """
+
+    def __init__(self, derivations):
+        """
+        :param derivations: a dictionary mapping each class name to its
+            derivation, the tuple of its ancestors with the nearest first
+        """
+        self._derivations = dict((name, tuple(derivation)) for name, derivation in derivations.items())
+        self._names = dict((name.lower(), name) for name in self._derivations)
+        self._sorted_names = sorted(self._names)
+        self._children = {}
+        for name, derivation in self._derivations.items():
+            parent = derivation[0].lower() if derivation else ""
+            self._children.setdefault(parent, []).append(name)
+        for children in self._children.values():
+            children.sort()
+
+    @classmethod
+    def from_schema(cls, schema):
+        return cls(dict(
+            (name, definition["derivation"]) for name, definition in schema.definitions.items()
+        ))
+
+    @classmethod
+    def from_services(cls, services):
+        """Build the index from one enumeration of the classes in the
+        namespace represented by `services`, a raw `SWbemServices` object.
+        A namespace which can't list its classes has an empty index.
+        """
+        try:
+            SubclassesOf = services.SubclassesOf
+        except AttributeError:
+            return cls({})
+        try:
+            return cls(dict((c.Path_.Class, c.Derivation_) for c in SubclassesOf("")))
         except pywintypes.com_error:
             handle_com_error()
 
+    def __repr__(self):
+        return "<_wmi_class_index: %d classes>" % len(self._derivations)
+
+    def __contains__(self, class_name):
+        return class_name.lower() in self._names
+
+    def __len__(self):
+        return len(self._derivations)
+
+    def __iter__(self):
+        return iter(self._derivations)
+
+    def _name(self, class_name):
+        try:
+            return self._names[class_name.lower()]
+        except KeyError:
+            raise x_wmi("No class %s in this namespace" % class_name)
+
+    def ancestors(self, class_name):
+        """Return the ancestors of a class, nearest first, as
+        :meth:`_wmi_object.derivation` does
+        """
+        return self._derivations[self._name(class_name)]
+
+    def children(self, class_name=""):
+        """Return the names of the classes derived directly from a class
+        or, if `class_name` is empty, of the classes with no superclass
+        """
+        if class_name:
+            class_name = self._name(class_name)
+        return list(self._children.get(class_name.lower(), []))
+
+    def subclasses_of(self, root="", regex=r".*"):
+        """Return the names of the classes derived, however indirectly,
+        from `root` -- or of all the classes if `root` is empty --
+        which match `regex`.
+        """
+        if root:
+            names = set()
+            pending = self.children(root)
+            while pending:
+                name = pending.pop()
+                names.add(name)
+                pending.extend(self._children.get(name.lower(), []))
+        else:
+            names = set(self._derivations)
+        if regex and regex != r".*":
+            match = re.compile(regex).match
+            names = set(name for name in names if match(name))
+        return names
+
+    def isa(self, class_name, ancestor):
+        """Return whether a class is `ancestor` or derived from it,
+        as `ISA` does in WQL
+        """
+        ancestor = ancestor.lower()
+        return class_name.lower() == ancestor or \
+            ancestor in (a.lower() for a in self.ancestors(class_name))
+
+    def with_prefix(self, prefix):
+        """Return the names of the classes starting with `prefix`"""
+        prefix = prefix.lower()
+        names = []
+        for lower_name in self._sorted_names[bisect.bisect_left(self._sorted_names, prefix):]:
+            if not lower_name.startswith(prefix):
+                break
+            names.append(self._names[lower_name])
+        return names
+
+#
+# class _wmi_schema_cache
+#
+class _wmi_schema_cache(object):
+    """Keep the :class:`_wmi_schema` of each namespace on each host in
+    a file of its own in `directory` (by default `wmi-schema` under the
+    user's local application data) so that a new process can pick up
+    the class definitions rather than reading them from WMI again. Used
+    by :func:`connect` when it is called with `cache_schema=True`::
+
+        wmi.schema_cache.max_age_secs = 24 * 60 * 60
+        c = wmi.WMI("remote", cache_schema=True)
+
+    Before a cached schema is used its fingerprint (see
+    :meth:`_wmi_schema.fingerprint`) is checked against the namespace's;
+    a schema which doesn't match, or which is older than `max_age_secs`,
+    is read again from WMI and saved. Schemas already loaded by this
+    process are kept in memory.
+    """
+
+    def __init__(self, directory=None, max_age_secs=7 * 24 * 60 * 60):
+        if directory is None:
+            directory = os.path.join(
+                os.environ.get("LOCALAPPDATA") or os.path.expanduser("~"), "wmi-schema"
+            )
+        self.directory = directory
+        self.max_age_secs = max_age_secs
+        self._schemas = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<_wmi_schema_cache: %s; %d loaded>" % (self.directory, len(self._schemas))
+
+    def path(self, server, namespace):
+        """Return the name of the file holding the schema of `namespace` on `server`"""
+        name = "%s-%s" % (server, namespace)
+        return os.path.join(self.directory, re.sub(r"[^\w.-]", "_", name.lower()) + ".json")
+
+    def _fresh(self, schema, fingerprint):
+        return schema is not None and \
+            schema.fingerprint == fingerprint and \
+            time.time() - (schema.saved or 0) < self.max_age_secs
+
+    def schema(self, services):
+        """Return the :class:`_wmi_schema` for the namespace represented
+        by `services`, a raw `SWbemServices` object, from memory or from
+        disk if it's still fresh and otherwise from WMI.
+        """
+        try:
+            path = services.Get("__SystemClass").Path_
+            server, namespace = path.Server, path.Namespace
+            fingerprint = _wmi_schema.fingerprint(services)
+        except pywintypes.com_error:
+            handle_com_error()
+        filepath = self.path(server, namespace)
+
+        with self._lock:
+            schema = self._schemas.get(filepath)
+        if not self._fresh(schema, fingerprint):
+            schema = self.load(filepath)
+        if not self._fresh(schema, fingerprint):
+            schema = _wmi_schema.build(services, fingerprint)
+            self.save(filepath, schema)
+        with self._lock:
+            self._schemas[filepath] = schema
+        return schema
+
+    def load(self, filepath):
+        """Return the schema saved in `filepath`, or None if there's
+        no usable schema there.
+        """
+        try:
+            with open(filepath, "rb") as f:
+                return _wmi_schema.from_dict(json.loads(f.read().decode("utf-8")))
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+    def save(self, filepath, schema):
+        """Save a schema to `filepath`, replacing what's there only once
+        it's completely written. A schema which can't be saved will be
+        read again from WMI next time.
+        """
+        temporary = "%s.%d.tmp" % (filepath, os.getpid())
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            with open(temporary, "wb") as f:
+                f.write(json.dumps(schema.to_dict(), separators=(",", ":")).encode("utf-8"))
+            if os.path.exists(filepath):
+                os.remove(filepath)
+            os.rename(temporary, filepath)
+        except (IOError, OSError):
+            warnings.warn("Unable to save the WMI schema to %s" % filepath)
+
+    def clear(self):
+        """Forget the schemas loaded by this process; the files are left"""
+        with self._lock:
+            self._schemas.clear()
+
+schema_cache = _wmi_schema_cache()
+
+#
+# class _wmi_connection_pool
+#
+class _wmi_connection_pool(object):
+    """Keep hold of the :class:`_wmi_namespace` objects returned by
+    :func:`connect` so that a later call with the same connection
+    parameters reuses the existing connection rather than going through
+    the moniker / authentication handshake again. Used by :func:`connect`
+    when it is called with `pooled=True`::
+
+        import wmi
+        wmi.connection_pool.max_size = 100
+        for i in range(10):
+            c = wmi.WMI("remote", pooled=True) # only the first call connects
+
+    COM objects belong to the thread which created them so each
+    connection is owned by the thread which made it and is only handed
+    out again to that same thread. A connection which has been idle for
+    more than `max_idle_secs` is discarded; one which has been idle for
+    more than `probe_after_secs` is checked with a cheap call before
+    it's handed out. No more than `max_size` connections are kept, the
+    least recently used being dropped first.
+
+    A thread which is about to call `CoUninitialize` should first call
+    :meth:`release_thread` so its connections are released while its
+    COM apartment still exists.
+    """
+
+    def __init__(self, max_size=32, max_idle_secs=300, probe_after_secs=30):
+        self.max_size = max_size
+        self.max_idle_secs = max_idle_secs
+        self.probe_after_secs = probe_after_secs
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        #
+        # key => [namespace, owning thread, last used]
+        #
+        self._connections = {}
+
+    def __len__(self):
+        return len(self._connections)
+
+    def __repr__(self):
+        return "<_wmi_connection_pool: %d connections; %d hits, %d misses>" % (
+            len(self), self.hits, self.misses
+        )
+
+    @staticmethod
+    def key(
+        computer="",
+        impersonation_level="",
+        authentication_level="",
+        authority="",
+        privileges="",
+        moniker="",
+        namespace="",
+        suffix="",
+        user="",
+        password=""
+    ):
+        """Return the key under which a connection made with these
+        parameters by the current thread is pooled. Case and the
+        different ways of specifying the local machine and the
+        namespace separators are normalised away. The password
+        is only held as a hash.
+        """
+        computer = (computer or "").lower()
+        if computer in (".", "localhost"):
+            computer = ""
+        namespace = (namespace or "").lower()
+        if namespace:
+            parts = re.split(r"[/\\]", namespace)
+            if parts[0] != "root":
+                parts.insert(0, "root")
+            namespace = "/".join(parts)
+        return (
+            threading.current_thread().ident,
+            computer,
+            namespace,
+            (user or "").lower(),
+            hashlib.sha1((password or "").encode("utf-8")).hexdigest(),
+            (impersonation_level or "").lower(),
+            (authentication_level or "").lower(),
+            (authority or "").lower(),
+            tuple(sorted(p.lower() for p in (privileges or []))),
+            (suffix or "").lower(),
+            moniker or ""
+        )
+
+    def _is_alive(self, namespace):
+        """Probe a connection with a cheap call which goes all the way
+        to the WMI service: fetch the definition of the root system class.
+        """
+        try:
+            namespace._namespace.Get("__SystemClass")
+        except pywintypes.com_error:
+            return False
+        else:
+            return True
+
+    def get(self, key):
+        """Return the pooled namespace for `key` or None if there isn't
+        one, or if it has been idle too long, or if it fails its probe.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._connections.get(key)
+            if entry is not None and entry[1] is not threading.current_thread():
+                #
+                # The thread id has been reused by a new thread; the
+                # connection belongs to the old thread's apartment
+                #
+                del self._connections[key]
+                entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+
+        namespace, _, last_used = entry
+        idle_secs = now - last_used
+        if idle_secs > self.max_idle_secs or \
+          (idle_secs > self.probe_after_secs and not self._is_alive(namespace)):
+            self.discard(key)
+            self.misses += 1
+            return None
+
+        entry[2] = now
+        self.hits += 1
+        return namespace
+
+    def put(self, key, namespace):
+        """Add a newly-made connection to the pool, dropping expired
+        and then least recently used connections to make room.
+        """
+        now = time.time()
+        with self._lock:
+            for k, (_, thread, last_used) in list(self._connections.items()):
+                if now - last_used > self.max_idle_secs or not thread.is_alive():
+                    del self._connections[k]
+                    self.evictions += 1
+            while self._connections and len(self._connections) >= self.max_size:
+                oldest = min(self._connections, key=lambda k: self._connections[k][2])
+                del self._connections[oldest]
+                self.evictions += 1
+            self._connections[key] = [namespace, threading.current_thread(), now]
+
+    def discard(self, key):
+        """Drop one connection from the pool"""
+        with self._lock:
+            if self._connections.pop(key, None) is not None:
+                self.evictions += 1
+
+    def release_thread(self):
+        """Drop all the connections owned by the current thread"""
+        this_thread = threading.current_thread()
+        with self._lock:
+            for k, (_, thread, _) in list(self._connections.items()):
+                if thread is this_thread:
+                    del self._connections[k]
+
+    def clear(self):
+        """Drop all pooled connections"""
+        with self._lock:
+            self._connections.clear()
+
+connection_pool = _wmi_connection_pool()
+
+def _host_key(computer):
+    """Normalise a computer name so that the different ways of
+    specifying the local machine all come out the same.
+    """
+    computer = (computer or "").lower()
+    if computer in ("", ".", "localhost"):
+        return "."
+    else:
+        return computer
+
+def _server_host_key(server):
+    """As :func:`_host_key` for the server named in a WMI object's path,
+    where the local machine appears under its own name.
+    """
+    if server.lower() == os.environ.get("COMPUTERNAME", "").lower():
+        server = ""
+    return _host_key(server)
+
+#
+# class _wmi_host_limiter
+#
+class _wmi_host_limiter(object):
+    """Cap the number of WMI operations in flight against one host, so
+    that many threads -- or a fan-out across many namespaces -- don't
+    overwhelm the WMI providers on the target machine. Callers beyond
+    the cap wait their turn.
+
+    The cap adjusts itself in the style of TCP's AIMD: each operation
+    which completes within `target_latency_secs` raises it by a fraction
+    (roughly one per cap's worth of operations); one which runs slower,
+    or which fails with a quota / server-too-busy error, multiplies it by
+    `decrease_factor`. Decreases happen at most once per target latency
+    so that a burst of slow completions doesn't collapse the cap to nothing.
+
+    The time spent waiting for a slot is recorded separately from the
+    time spent in WMI itself so the two can be told apart: see :meth:`metrics`.
+
+    A thread which already holds a slot -- as it does while iterating
+    over a :meth:`_wmi_namespace.stream` -- shares it with any operations
+    it starts meanwhile rather than waiting for another, so that querying
+    the host for each row of a stream can't deadlock against itself.
+    """
+
+    QUOTA_ERRORS = set([
+        signed_to_unsigned(wbemErrQuotaViolation),
+        signed_to_unsigned(wbemErrServerTooBusy),
+    ])
+
+    def __init__(
+        self,
+        host,
+        initial_limit=8,
+        min_limit=1,
+        max_limit=64,
+        target_latency_secs=2.0,
+        decrease_factor=0.5
+    ):
+        self.host = host
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency_secs = target_latency_secs
+        self.decrease_factor = decrease_factor
+        self.in_flight = 0
+        self.queued = 0
+        self.operations = 0
+        self.quota_errors = 0
+        self.slow_operations = 0
+        self.waits = 0
+        self.wait_secs = 0.0
+        self.max_wait_secs = 0.0
+        self.latency_secs = 0.0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+        #
+        # The number of slots each holding thread has taken, nested
+        #
+        self._holders = {}
+
+    def __repr__(self):
+        return "<_wmi_host_limiter: %s %d/%d in flight>" % (self.host, self.in_flight, int(self.limit))
+
+    def acquire(self):
+        """Wait for a slot to become free and take it or, if the current
+        thread already holds one, share that one.
+        """
+        thread = threading.current_thread()
+        started = time.time()
+        with self._condition:
+            if thread in self._holders:
+                self._holders[thread] += 1
+                return
+            if self.in_flight >= int(self.limit):
+                self.queued += 1
+                try:
+                    while self.in_flight >= int(self.limit):
+                        self._condition.wait()
+                finally:
+                    self.queued -= 1
+                waited = time.time() - started
+                self.waits += 1
+                self.wait_secs += waited
+                self.max_wait_secs = max(self.max_wait_secs, waited)
+            self.in_flight += 1
+            self._holders[thread] = 1
+
+    def release(self, latency_secs, error=None, thread=None):
+        """Give up a slot taken by `thread`, by default the current thread,
+        adjusting the cap according to how long the operation took and
+        whether it failed because the host was busy.
+        """
+        if thread is None:
+            thread = threading.current_thread()
+        with self._condition:
+            depth = self._holders.pop(thread, 1)
+            if depth > 1:
+                self._holders[thread] = depth - 1
+            else:
+                self.in_flight -= 1
+            self.operations += 1
+            self.latency_secs += latency_secs
+            is_quota_error = bool(self.QUOTA_ERRORS.intersection(_com_error_codes(error)))
+            if is_quota_error:
+                self.quota_errors += 1
+            is_slow = latency_secs > self.target_latency_secs
+            if is_slow:
+                self.slow_operations += 1
+
+            now = time.time()
+            if is_quota_error or is_slow:
+                if now - self._last_decrease > self.target_latency_secs:
+                    self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+                    self._last_decrease = now
+            elif error is None:
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            self._condition.notify_all()
+
+    def call(self, function, *args, **kwargs):
+        """Call `function` once a slot is free, returning its result"""
+        self.acquire()
+        started = time.time()
+        try:
+            result = function(*args, **kwargs)
+        except (pywintypes.com_error, x_wmi):
+            self.release(time.time() - started, sys.exc_info()[1])
+            raise
+        except:
+            self.release(time.time() - started)
+            raise
+        else:
+            self.release(time.time() - started)
+            return result
+
+    def metrics(self):
+        """Return a dictionary of the limiter's counters. `wait_secs`
+        is the time callers spent queueing on this side; `latency_secs`
+        the time spent in WMI once a slot was granted.
+        """
+        with self._condition:
+            return dict(
+                host=self.host,
+                limit=int(self.limit),
+                in_flight=self.in_flight,
+                queued=self.queued,
+                operations=self.operations,
+                quota_errors=self.quota_errors,
+                slow_operations=self.slow_operations,
+                waits=self.waits,
+                wait_secs=self.wait_secs,
+                max_wait_secs=self.max_wait_secs,
+                mean_wait_secs=self.wait_secs / (self.operations or 1),
+                latency_secs=self.latency_secs,
+                mean_latency_secs=self.latency_secs / (self.operations or 1),
+            )
+
+class _wmi_host_limits(object):
+    """Hand out one :class:`_wmi_host_limiter` per host, creating it on
+    first use with the keyword arguments held in :attr:`defaults`. Used
+    by :func:`connect` and by the query methods of :class:`_wmi_namespace`::
+
+        import wmi
+        wmi.host_limits.defaults["max_limit"] = 4
+        c = wmi.WMI("remote")
+        ...
+        print(wmi.host_limits.metrics()["remote"]["mean_wait_secs"])
+    """
+
+    def __init__(self, **defaults):
+        self.defaults = defaults
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, computer):
+        return self.for_host(computer)
+
+    def for_host(self, computer):
+        host = _host_key(computer)
+        with self._lock:
+            limiter = self._limiters.get(host)
+            if limiter is None:
+                limiter = self._limiters[host] = _wmi_host_limiter(host, **self.defaults)
+            return limiter
+
+    def metrics(self):
+        """Return a dictionary mapping each host to its limiter's metrics"""
+        with self._lock:
+            limiters = list(self._limiters.values())
+        return dict((limiter.host, limiter.metrics()) for limiter in limiters)
+
+    def clear(self):
+        with self._lock:
+            self._limiters.clear()
+
+host_limits = _wmi_host_limits()
+
+#
+# class _wmi_circuit_breaker
+#
+class _wmi_circuit_breaker(object):
+    """Track consecutive transient failures against one host. Once
+    there have been `failure_threshold` of them the breaker opens and
+    calls fail at once rather than each waiting for a connection
+    timeout. After `reset_after_secs` one trial call is let through
+    (the breaker is "half-open"): if it succeeds the breaker closes;
+    if it fails the breaker opens again for another period.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half-open"
+
+    def __init__(self, host, failure_threshold=5, reset_after_secs=30.0, clock=time.time):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_after_secs = reset_after_secs
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<_wmi_circuit_breaker: %s %s>" % (self.host, self.state)
+
+    def allow(self):
+        """Return True if a call to the host should be attempted"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            elif self.state == self.OPEN and self.clock() - self.opened_at >= self.reset_after_secs:
+                self.state = self.HALF_OPEN
+                return True
+            else:
+                return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = self.clock()
+
+    def record_abandoned(self):
+        """A call ended in a way which says nothing about the host -- eg
+        it was interrupted or the function had a bug. If it was the
+        half-open trial, let the next call be the trial instead.
+        """
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+#
+# class _wmi_retry_policy
+#
+class _wmi_retry_policy(object):
+    """Decide which COM errors are worth retrying; retry them with
+    jittered exponential backoff; and keep a :class:`_wmi_circuit_breaker`
+    per host so that a host which keeps failing is not tried again
+    until it's had time to recover. Errors which are not in
+    :attr:`retryable_errors` (access denied, invalid query etc.) are
+    raised at once and don't count against the host.
+
+    `sleep`, `clock` and `random` can be replaced, eg by a test which
+    wants to inject failures without waiting for the backoff::
+
+        policy = wmi._wmi_retry_policy(sleep=lambda secs: None)
+        policy.call("remote", function_which_fails_twice)
+    """
+
+    retryable_errors = set([
+        0x800706BA, # RPC server unavailable
+        0x800706BE, # Remote procedure call failed
+        0x800706BF, # Remote procedure call failed and did not execute
+        0x80010108, # Object invoked has disconnected from its clients
+        signed_to_unsigned(wbemErrTimedout),
+        signed_to_unsigned(wbemErrProviderLoadFailure),
+        signed_to_unsigned(wbemErrTransportFailure),
+        signed_to_unsigned(wbemErrShuttingDown),
+        signed_to_unsigned(wbemErrServerTooBusy),
+        signed_to_unsigned(wbemErrQuotaViolation),
+    ])
+
+    def __init__(
+        self,
+        max_attempts=3,
+        base_delay_secs=0.5,
+        max_delay_secs=10.0,
+        failure_threshold=5,
+        reset_after_secs=30.0,
+        sleep=time.sleep,
+        clock=time.time,
+        random=random.random
+    ):
+        self.max_attempts = max_attempts
+        self.base_delay_secs = base_delay_secs
+        self.max_delay_secs = max_delay_secs
+        self.failure_threshold = failure_threshold
+        self.reset_after_secs = reset_after_secs
+        self.sleep = sleep
+        self.clock = clock
+        self.random = random
+        self.retryable_errors = set(self.retryable_errors)
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def is_retryable(self, err):
+        """Return True if `err` -- a `pywintypes.com_error` or an
+        :exc:`x_wmi` wrapping one -- is likely to be transient
+        """
+        return bool(self.retryable_errors.intersection(_com_error_codes(err)))
+
+    def delay_secs(self, attempt):
+        """Return how long to wait before retry number `attempt` (from 1):
+        a random fraction of a doubling delay, capped at `max_delay_secs`
+        """
+        return self.random() * min(self.max_delay_secs, self.base_delay_secs * (2 ** (attempt - 1)))
+
+    def breaker(self, computer):
+        host = _host_key(computer)
+        with self._lock:
+            breaker = self._breakers.get(host)
+            if breaker is None:
+                breaker = self._breakers[host] = _wmi_circuit_breaker(
+                    host, self.failure_threshold, self.reset_after_secs, self.clock
+                )
+            return breaker
+
+    def call(self, computer, function, *args, **kwargs):
+        """Call `function`, retrying transient COM failures, unless the
+        circuit breaker for `computer` is open in which case raise
+        :exc:`x_wmi_circuit_open` without calling it at all.
+        """
+        breaker = self.breaker(computer)
+        attempt = 1
+        while True:
+            if not breaker.allow():
+                raise x_wmi_circuit_open(
+                    "%d consecutive failures against %s; not retrying for %s secs" % (
+                        breaker.failures, breaker.host, breaker.reset_after_secs
+                    )
+                )
+            try:
+                result = function(*args, **kwargs)
+            except (pywintypes.com_error, x_wmi):
+                err = sys.exc_info()[1]
+                if not self.is_retryable(err):
+                    #
+                    # The host answered, even if only to refuse
+                    #
+                    breaker.record_success()
+                    raise
+                breaker.record_failure()
+                if attempt >= self.max_attempts:
+                    raise
+                self.sleep(self.delay_secs(attempt))
+                attempt += 1
+            except:
+                breaker.record_abandoned()
+                raise
+            else:
+                breaker.record_success()
+                return result
+
+    def clear(self):
+        with self._lock:
+            self._breakers.clear()
+
+retry_policy = _wmi_retry_policy()
+
+def _call_host(computer, function, *args, **kwargs):
+    """Call `function` against `computer` under the module's
+    :data:`retry_policy` and within its :data:`host_limits`. The
+    backoff between retries is spent outside the limiter so that
+    it doesn't hold a slot which another caller could use.
+    """
+    return retry_policy.call(
+        computer, host_limits.for_host(computer).call, function, *args, **kwargs
+    )
+
 PROTOCOL = "winmgmts:"
 def connect(
     computer="",
@@ -1272,7 +5558,9 @@ def connect(
     user="",
     password="",
     find_classes=False,
-    debug=False
+    debug=False,
+    pooled=False,
+    cache_schema=False
 ):
     """The WMI constructor can either take a ready-made moniker or as many
     parts of one as are necessary. Eg::
@@ -1296,19 +5584,55 @@ def connect(
     name.
 
     If the `wmi` parameter is supplied, all other parameters are ignored.
+
+    If `pooled` is True, a namespace connection is kept in the module's
+    :data:`connection_pool` and a later call with the same parameters
+    from the same thread will return it rather than connecting again::
+
+        c = wmi.WMI("remote", pooled=True)
+
+    If `cache_schema` is True, the definitions of the namespace's classes
+    are read from the module's :data:`schema_cache` if they're still
+    current, rather than from WMI as each class is used. A pooled
+    connection made without it is given the cached schema when it's
+    asked for again with it.
     """
     global _DEBUG
     _DEBUG = debug
 
+    pool_key = None
+    if pooled and not wmi:
+        pool_key = connection_pool.key(
+            computer=computer,
+            impersonation_level=impersonation_level,
+            authentication_level=authentication_level,
+            authority=authority,
+            privileges=privileges,
+            moniker=moniker,
+            namespace=namespace,
+            suffix=suffix,
+            user=user,
+            password=password
+        )
+        pooled_namespace = connection_pool.get(pool_key)
+        if pooled_namespace is not None:
+            if cache_schema and pooled_namespace._schema is None:
+                pooled_namespace._schema = schema_cache.schema(pooled_namespace._namespace)
+            if find_classes:
+                _ = pooled_namespace.classes
+            return pooled_namespace
+
     try:
         try:
             if wmi:
+                host = None
                 obj = wmi
 
             elif moniker:
                 if not moniker.startswith(PROTOCOL):
                     moniker = PROTOCOL + moniker
-                obj = GetObject(moniker)
+                host = _host_key(moniker_computer(moniker))
+                obj = _call_host(host, GetObject, moniker)
 
             else:
                 if user:
@@ -1317,7 +5641,10 @@ def connect(
                     elif computer in(None, '', '.'):
                         raise x_wmi_authentication("You can only specify user/password for a remote connection")
                     else:
-                        obj = connect_server(
+                        host = _host_key(computer)
+                        obj = _call_host(
+                            host,
+                            connect_server,
                             server=computer,
                             namespace=namespace,
                             user=user,
@@ -1337,12 +5664,30 @@ def connect(
                         namespace=namespace,
                         suffix=suffix
                     )
-                    obj = GetObject(moniker)
+                    host = _host_key(computer)
+                    obj = _call_host(host, GetObject, moniker)
 
             wmi_type = get_wmi_type(obj)
 
             if wmi_type == "namespace":
-                return _wmi_namespace(obj, find_classes)
+                schema = schema_cache.schema(obj) if cache_schema else None
+                wmi_namespace = _wmi_namespace(obj, find_classes, host, schema)
+                if not wmi:
+                    wmi_namespace._connection = dict(
+                        computer=computer,
+                        impersonation_level=impersonation_level,
+                        authentication_level=authentication_level,
+                        authority=authority,
+                        privileges=privileges,
+                        moniker=moniker,
+                        namespace=namespace,
+                        suffix=suffix,
+                        user=user,
+                        password=password
+                    )
+                if pool_key is not None:
+                    connection_pool.put(pool_key, wmi_namespace)
+                return wmi_namespace
             elif wmi_type == "class":
                 return _wmi_class(None, obj)
             elif wmi_type == "instance":
@@ -1387,6 +5732,18 @@ def construct_moniker(
     if suffix: moniker.append(":%s" % suffix)
     return "".join(moniker)
 
+def moniker_computer(moniker):
+    """Return the computer named in a moniker, or an empty string
+    if it names none (ie refers to the local machine)::
+
+        print(wmi.moniker_computer("winmgmts:{impersonationLevel=Delegate}//remote/root/cimv2"))
+    """
+    match = re.search(r"[/\\]{2}([^/\\]+)", moniker)
+    if match:
+        return match.group(1)
+    else:
+        return ""
+
 def get_wmi_type(obj):
     try:
         path = obj.Path_
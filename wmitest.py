@@ -15,12 +15,17 @@ logical drives. These may get left behind.
 #
 
 import os, sys
+import shutil
 import datetime
+import gzip
+import json
 try:
     import ConfigParser
 except ImportError:
     import configparser as ConfigParser
+import numbers
 import operator
+import re
 try:
     import Queue
 except ImportError:
@@ -41,6 +46,7 @@ except ImportError:
     import winreg as _winreg
 
 import pythoncom
+import pywintypes
 import win32api
 import win32con
 import win32file
@@ -218,6 +224,13 @@ class TestBasicConnections(unittest.TestCase):
     def test_classes_acts_as_dict(self):
         self.assert_(wmi.WMI().classes.keys)
 
+    def test_classes_built_once(self):
+        "Check that the classes view is built once and answers membership from its set"
+        connection = wmi.WMI()
+        self.assert_(connection.classes is connection.classes)
+        self.assert_("Win32_ComputerSystem" in connection.classes)
+        self.assertEquals(list(connection.classes), sorted(connection.classes))
+
 class TestThreadedConnection(unittest.TestCase):
 
 
@@ -259,6 +272,204 @@ class TestThreadedConnection(unittest.TestCase):
         threading.Thread(target=f, args=(q,)).start()
         self.assert_(q.get())
 
+class TestConnectionPool(unittest.TestCase):
+
+    def tearDown(self):
+        wmi.connection_pool.clear()
+
+    def test_pooled_connection_reused(self):
+        "Check that a pooled connection is returned again for the same parameters"
+        self.assert_(wmi.WMI(pooled=True) is wmi.WMI(pooled=True))
+        self.assert_(wmi.WMI(computer=".", pooled=True) is wmi.WMI(pooled=True))
+
+    def test_unpooled_connection_not_reused(self):
+        "Check that connections are only shared when asked for"
+        self.assert_(wmi.WMI(pooled=True) is not wmi.WMI())
+
+    def test_different_parameters_not_shared(self):
+        "Check that a different namespace gives a different connection"
+        self.assert_(wmi.WMI(pooled=True) is not wmi.WMI(namespace="default", pooled=True))
+
+    def test_pooled_connection_gets_schema(self):
+        "Check that a pooled connection asked for again with cache_schema has a schema"
+        c = wmi.WMI(pooled=True)
+        self.assert_(c._schema is None)
+        self.assert_(wmi.WMI(pooled=True, cache_schema=True) is c)
+        self.assert_(c._schema is not None)
+
+    def test_connection_owned_by_thread(self):
+        "Check that a pooled connection is not handed out to another thread"
+        def f(q):
+            pythoncom.CoInitialize()
+            try:
+                q.put(id(wmi.WMI(pooled=True)))
+                wmi.connection_pool.release_thread()
+            finally:
+                pythoncom.CoUninitialize()
+
+        c = wmi.WMI(pooled=True)
+        q = Queue.Queue()
+        t = threading.Thread(target=f, args=(q,))
+        t.start()
+        t.join()
+        self.assertNotEqual(q.get(), id(c))
+
+    def test_idle_connection_expires(self):
+        "Check that a connection idle for longer than the expiry is not reused"
+        pool = wmi._wmi_connection_pool(max_idle_secs=0)
+        key = pool.key()
+        pool.put(key, wmi.WMI())
+        time.sleep(0.1)
+        self.assert_(pool.get(key) is None)
+
+    def test_max_size(self):
+        "Check that the pool drops the least recently used connection when full"
+        pool = wmi._wmi_connection_pool(max_size=1)
+        pool.put(pool.key(namespace="cimv2"), wmi.WMI())
+        pool.put(pool.key(namespace="default"), wmi.WMI(namespace="default"))
+        self.assertEqual(len(pool), 1)
+        self.assert_(pool.get(pool.key(namespace="cimv2")) is None)
+
+class TestHostLimiter(unittest.TestCase):
+
+    def test_cap_in_flight(self):
+        "Check that no more than the limit of operations run at once"
+        limiter = wmi._wmi_host_limiter("test", initial_limit=2, max_limit=2)
+        in_flight = []
+        def op():
+            in_flight.append(limiter.in_flight)
+            time.sleep(0.1)
+        threads = [threading.Thread(target=limiter.call, args=(op,)) for i in range(6)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        self.assertEqual(max(in_flight), 2)
+        self.assert_(limiter.metrics()["waits"] > 0)
+
+    def test_slot_shared_by_holding_thread(self):
+        "Check that a thread holding a slot doesn't wait for another"
+        limiter = wmi._wmi_host_limiter("test", initial_limit=1, max_limit=1)
+        limiter.acquire()
+        try:
+            self.assertEqual(limiter.call(lambda: limiter.in_flight), 1)
+        finally:
+            limiter.release(0)
+        self.assertEqual(limiter.in_flight, 0)
+        self.assertEqual(limiter.metrics()["waits"], 0)
+
+    def test_additive_increase(self):
+        "Check that fast operations raise the limit"
+        limiter = wmi._wmi_host_limiter("test", initial_limit=2)
+        for i in range(10):
+            limiter.call(lambda: None)
+        self.assert_(limiter.metrics()["limit"] > 2)
+
+    def test_multiplicative_decrease_on_slow_operation(self):
+        "Check that an operation slower than the target halves the limit"
+        limiter = wmi._wmi_host_limiter("test", initial_limit=8, target_latency_secs=0.01)
+        limiter.call(time.sleep, 0.05)
+        self.assertEqual(limiter.metrics()["limit"], 4)
+
+    def test_multiplicative_decrease_on_quota_error(self):
+        "Check that a server-too-busy error halves the limit"
+        limiter = wmi._wmi_host_limiter("test", initial_limit=8)
+        def op():
+            raise pywintypes.com_error(wmi.wbemErrServerTooBusy, "Busy", None, None)
+        self.assertRaises(pywintypes.com_error, limiter.call, op)
+        self.assertEqual(limiter.metrics()["limit"], 4)
+        self.assertEqual(limiter.metrics()["quota_errors"], 1)
+
+    def test_one_limiter_per_host(self):
+        "Check that the local machine is one host however it's named"
+        limits = wmi._wmi_host_limits()
+        self.assert_(limits.for_host("") is limits.for_host("."))
+        self.assert_(limits.for_host("localhost") is limits.for_host("."))
+        self.assert_(limits.for_host("remote") is not limits.for_host("."))
+
+    def test_query_is_limited(self):
+        "Check that queries are counted against their host's limiter"
+        c = wmi.WMI()
+        operations = wmi.host_limits.for_host(c.host).operations
+        c.Win32_ComputerSystem()
+        self.assertEqual(wmi.host_limits.for_host(c.host).operations, operations + 1)
+
+class FakeBackend(object):
+    """Stand in for a COM call, raising each of a scripted series of
+    HRESULTs in turn and then succeeding.
+    """
+    def __init__(self, *hresults):
+        self.hresults = list(hresults)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.hresults:
+            raise pywintypes.com_error(self.hresults.pop(0), "Injected error", None, None)
+        return "OK"
+
+RPC_SERVER_UNAVAILABLE = -2147023174
+ACCESS_DENIED = -2147024891
+
+class TestRetryPolicy(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.delays = []
+        self.policy = wmi._wmi_retry_policy(
+            max_attempts=3,
+            failure_threshold=3,
+            reset_after_secs=30,
+            sleep=self.delays.append,
+            clock=lambda: self.now
+        )
+
+    def test_transient_error_retried(self):
+        "Check that a transient error is retried until it succeeds"
+        backend = FakeBackend(RPC_SERVER_UNAVAILABLE, wmi.wbemErrTimedout)
+        self.assertEqual(self.policy.call("remote", backend), "OK")
+        self.assertEqual(backend.calls, 3)
+        self.assertEqual(len(self.delays), 2)
+
+    def test_fatal_error_not_retried(self):
+        "Check that a non-transient error is raised at once"
+        backend = FakeBackend(ACCESS_DENIED)
+        self.assertRaises(pywintypes.com_error, self.policy.call, "remote", backend)
+        self.assertEqual(backend.calls, 1)
+
+    def test_backoff_is_bounded(self):
+        "Check that the jittered backoff never exceeds the doubling delay or the cap"
+        for attempt in range(1, 10):
+            self.assert_(0 <= self.policy.delay_secs(attempt) <= min(self.policy.max_delay_secs, 0.5 * 2 ** (attempt - 1)))
+
+    def test_circuit_opens(self):
+        "Check that repeated failures open the circuit so calls fail fast"
+        backend = FakeBackend(*[RPC_SERVER_UNAVAILABLE] * 10)
+        self.assertRaises(pywintypes.com_error, self.policy.call, "remote", backend)
+        self.assertRaises(wmi.x_wmi_circuit_open, self.policy.call, "remote", backend)
+        self.assertEqual(backend.calls, 3)
+
+    def test_circuit_is_per_host(self):
+        "Check that an open circuit on one host doesn't affect another"
+        self.assertRaises(pywintypes.com_error, self.policy.call, "remote", FakeBackend(*[RPC_SERVER_UNAVAILABLE] * 3))
+        self.assertEqual(self.policy.call("other", FakeBackend()), "OK")
+
+    def test_circuit_half_opens(self):
+        "Check that the circuit lets a trial call through once the reset period is over"
+        self.assertRaises(pywintypes.com_error, self.policy.call, "remote", FakeBackend(*[RPC_SERVER_UNAVAILABLE] * 3))
+        self.now += 31
+        self.assertEqual(self.policy.call("remote", FakeBackend()), "OK")
+        self.assertEqual(self.policy.breaker("remote").state, "closed")
+
+    def test_circuit_leaves_half_open_after_other_error(self):
+        "Check that a non-COM error in the trial call doesn't leave the circuit half-open"
+        self.assertRaises(pywintypes.com_error, self.policy.call, "remote", FakeBackend(*[RPC_SERVER_UNAVAILABLE] * 3))
+        self.now += 31
+        def broken():
+            raise TypeError("broken")
+        self.assertRaises(TypeError, self.policy.call, "remote", broken)
+        self.assertNotEqual(self.policy.breaker("remote").state, "half-open")
+        self.assertEqual(self.policy.call("remote", FakeBackend()), "OK")
+        self.assertEqual(self.policy.breaker("remote").state, "closed")
+
 class TestMoniker(unittest.TestCase):
 
     def test_moniker(self):
@@ -354,6 +565,21 @@ class TestNamespace(TestWMI):
     def test_subclasses_of_pattern(self):
         self.assert_(set(["Win32_LogicalDisk", "Win32_MappedLogicalDisk"]) <= set(self.connection.subclasses_of("CIM_LogicalDevice", "Win32_.*Disk")))
 
+    def test_class_index(self):
+        "Check that the class index agrees with WMI's own view of the class hierarchy"
+        index = self.connection.class_index
+        self.assertEquals(index.ancestors("Win32_LogicalDisk"), self.connection.Win32_LogicalDisk.derivation())
+        self.assert_("Win32_LogicalDisk" in index.children("CIM_LogicalDisk"))
+        self.assert_(index.isa("win32_processstarttrace", "__ExtrinsicEvent"))
+        self.assert_(not index.isa("Win32_Process", "__ExtrinsicEvent"))
+        self.assert_("Win32_ComputerSystem" in index.with_prefix("Win32_Computer"))
+
+    def test_not_classes_remembered(self):
+        "Check that a name which WMI says isn't a class is only looked up as a class once"
+        self.connection.ExecQuery
+        self.assert_("ExecQuery" in self.connection._not_classes)
+        self.assert_(self.connection.ExecQuery)
+
     def test_instances(self):
         self.assertEquals(self.logical_disks, set(self.connection.instances("Win32_LogicalDisk")))
 
@@ -376,6 +602,145 @@ class TestNamespace(TestWMI):
             self.assert_(isinstance(wmi_class, wmi._wmi_class))
             self.assertEquals(wmi_class._class_name, c)
 
+    def test_generate_classes(self):
+        "Check that generated classes can be bound to the results of a query"
+        source = wmi.generate_classes(self.connection, ["Win32_LogicalDisk"])
+        module = {}
+        exec(compile(source, "<generated>", "exec"), module)
+        Win32_LogicalDisk = module["Win32_LogicalDisk"]
+        self.assertEqual(Win32_LogicalDisk._keys, ("DeviceID",))
+        disks = self.connection.fetch_as(Win32_LogicalDisk)
+        self.assertEqual(
+            sorted(d.DeviceID for d in disks),
+            sorted(d.DeviceID for d in self.logical_disks)
+        )
+        for d in disks:
+            self.assert_(d.Size is None or isinstance(d.Size, numbers.Integral))
+
+    def test_stream(self):
+        "Check that streaming a class yields its instances' fields in the order asked for"
+        self.assertEqual(
+            sorted(self.connection.stream("Win32_LogicalDisk", ["DeviceID", "DriveType"])),
+            sorted((d.DeviceID, d.DriveType) for d in self.logical_disks)
+        )
+
+    def test_stream_holds_host_slot(self):
+        "Check that a stream holds a slot in its host's limiter until it's closed"
+        limiter = wmi.host_limits.for_host(self.connection.host)
+        in_flight = limiter.in_flight
+        rows = self.connection.stream("Win32_Process", ["Name"])
+        next(rows)
+        self.assertEqual(limiter.in_flight, in_flight + 1)
+        next(rows)
+        self.assertEqual(limiter.in_flight, in_flight + 1)
+        rows.close()
+        self.assertEqual(limiter.in_flight, in_flight)
+        list(self.connection.stream("Win32_LogicalDisk", ["DeviceID"]))
+        self.assertEqual(limiter.in_flight, in_flight)
+
+    def test_stream_nested_query(self):
+        "Check that a query of the same host within a stream doesn't wait for the stream's slot"
+        limiter = wmi.host_limits.for_host(self.connection.host)
+        limits = limiter.limit, limiter.min_limit, limiter.max_limit
+        limiter.limit = limiter.min_limit = limiter.max_limit = 1
+        try:
+            for device_id, in self.connection.stream("Win32_LogicalDisk", ["DeviceID"]):
+                disks = self.connection.fetch_as_lists("Win32_LogicalDisk", ["DeviceID"], DeviceID=device_id)
+                self.assertEqual(len(disks), 1)
+        finally:
+            limiter.limit, limiter.min_limit, limiter.max_limit = limits
+
+    def test_export_csv(self):
+        "Check that a gzipped CSV export has a header and a row per instance"
+        dir = tempfile.mkdtemp()
+        try:
+            filepath = os.path.join(dir, "%(class)s.csv.gz")
+            counts = wmi.export_csv(self.connection, ["Win32_LogicalDisk"], filepath, fields=["DeviceID"])
+            path = filepath % {"class" : "Win32_LogicalDisk"}
+            self.assertEqual(counts, {path : len(self.logical_disks)})
+            f = gzip.open(path, "rb")
+            try:
+                lines = f.read().decode("utf-8").splitlines()
+            finally:
+                f.close()
+            self.assertEqual(lines[0], "DeviceID")
+            self.assertEqual(sorted(lines[1:]), sorted(d.DeviceID for d in self.logical_disks))
+        finally:
+            shutil.rmtree(dir)
+
+    def test_snapshot(self):
+        "Check that a snapshot holds each class's rows with its timing and count"
+        snapshot = self.connection.snapshot({
+            "Win32_LogicalDisk" : ["DeviceID", "Size"],
+            "Win32_OperatingSystem" : None,
+            "Win32_NoSuchClass" : None,
+        })
+        self.assertEqual(
+            sorted(r["DeviceID"] for r in snapshot.records("Win32_LogicalDisk")),
+            sorted(d.DeviceID for d in self.logical_disks)
+        )
+        self.assertEqual(snapshot.counts["Win32_LogicalDisk"], len(self.logical_disks))
+        self.assertEqual(snapshot.counts["Win32_OperatingSystem"], 1)
+        self.assert_(isinstance(snapshot.errors["Win32_NoSuchClass"], wmi.x_wmi))
+        self.assert_(snapshot.elapsed_secs <= sum(snapshot.timings.values()) + 1)
+
+    def test_binary_snapshot(self):
+        "Check that a binary snapshot reads back by class and by key"
+        handle, path = tempfile.mkstemp(suffix=".wmisnap")
+        os.close(handle)
+        try:
+            errors = wmi.write_snapshot(self.connection, {"Win32_LogicalDisk" : ["DeviceID", "Size", "DriveType"]}, path)
+            self.assertEqual(errors, {self.connection.host : {}})
+            snapshot = wmi.read_snapshot(path)
+            try:
+                rows = list(snapshot.rows("Win32_LogicalDisk"))
+                self.assertEqual(
+                    sorted(rows),
+                    sorted((d.DeviceID, d.Size and int(d.Size), d.DriveType) for d in self.logical_disks)
+                )
+                disk = next(iter(self.logical_disks))
+                self.assertEqual(snapshot.get("Win32_LogicalDisk", disk.DeviceID)[0], disk.DeviceID)
+                self.assert_(snapshot.get("Win32_LogicalDisk", "no-such-disk") is None)
+            finally:
+                snapshot.close()
+        finally:
+            os.remove(path)
+
+    def test_binary_snapshot_unsigned(self):
+        "Check that integers which only fit unsigned keep their type in a binary snapshot"
+        handle, path = tempfile.mkstemp(suffix=".wmisnap")
+        os.close(handle)
+        try:
+            writer = wmi._wmi_snapshot_writer(path)
+            writer.host = "."
+            writer.add("Test", ["Counter"], [(1,), (2 ** 63,)])
+            writer.close()
+            snapshot = wmi.read_snapshot(path)
+            try:
+                self.assertEqual(list(snapshot.rows("Test")), [(1,), (2 ** 63,)])
+            finally:
+                snapshot.close()
+        finally:
+            os.remove(path)
+
+    def test_export_jsonl(self):
+        "Check that a JSON lines export encodes each property according to its CIMTYPE"
+        handle, path = tempfile.mkstemp(suffix=".jsonl")
+        os.close(handle)
+        try:
+            counts = wmi.export_jsonl(self.connection, ["Win32_LogicalDisk", "Win32_OperatingSystem"], path)
+            self.assertEqual(counts[self.connection.host, "Win32_LogicalDisk"], len(self.logical_disks))
+            with open(path) as f:
+                records = [json.loads(line) for line in f]
+            self.assertEqual(len(records), sum(counts.values()))
+            for record in records:
+                if record["__CLASS"] == "Win32_LogicalDisk":
+                    self.assert_(record["Size"] is None or isinstance(record["Size"], numbers.Integral))
+                else:
+                    self.assert_(re.match(r"\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d", record["LastBootUpTime"]))
+        finally:
+            os.remove(path)
+
     def test_watch_for(self):
         """Check that the watch_for method returns a watcher. The watcher itself
         will be tested elsewhere.
@@ -385,6 +750,41 @@ class TestNamespace(TestWMI):
         )
         self.assert_(isinstance(watcher, wmi._wmi_watcher))
 
+class TestSchemaCache(TestWMI):
+
+    def setUp(self):
+        TestWMI.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.cache = wmi._wmi_schema_cache(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_saved(self):
+        "Check that a schema is read from WMI and saved"
+        schema = self.cache.schema(self.connection._namespace)
+        self.assert_("Win32_Process" in schema)
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+        self.cache.clear()
+        self.assertEqual(self.cache.schema(self.connection._namespace).definitions, schema.definitions)
+
+    def test_classes_from_schema(self):
+        "Check that classes built from a schema match those read from WMI"
+        schema = self.cache.schema(self.connection._namespace)
+        connection = wmi._wmi_namespace(self.connection._namespace, False, schema=schema)
+        cached, live = connection.Win32_LogicalDisk, self.connection.Win32_LogicalDisk
+        self.assertEqual(cached.keys, live.keys)
+        self.assertEqual(cached.derivation(), live.derivation())
+        self.assertEqual(sorted(cached.properties), sorted(live.properties))
+        self.assertEqual(set(cached()), self.logical_disks)
+        self.assert_("Win32_Desktop" in connection.subclasses_of("CIM_Setting"))
+
+    def test_stale(self):
+        "Check that a schema with a different fingerprint is read again"
+        schema = self.cache.schema(self.connection._namespace)
+        schema.fingerprint = "***"
+        self.assertNotEqual(self.cache.schema(self.connection._namespace).fingerprint, "***")
+
 class TestClass(TestWMI):
 
     def test_class_from_namespace(self):
@@ -493,6 +893,313 @@ class TestWatcher(TestWMI):
         self.assertEqual(found_disk.path().Class, "Win32_LogicalDisk")
         t.join()
 
+    def test_next_batch(self):
+        "Check that a batch returns the waiting events, wrapped when used"
+        try:
+            new_letter = self.new_letter()
+        except KeyError:
+            warnings.warn("Unable to find a spare drive letter to map.")
+            return
+
+        watcher = self.connection.Win32_LogicalDisk.watch_for(
+            notification_type="Creation",
+            DeviceID=new_letter
+        )
+        t = threading.Timer(2, self.create,(new_letter,))
+        t.start()
+        found_disks = watcher.next_batch(max_events=10, max_wait_ms=20000)
+        self.assertEqual(len(found_disks), 1)
+        self.assertEqual(found_disks[0].Caption, new_letter)
+        self.assert_(isinstance(found_disks[0].event, wmi._wmi_event))
+        t.join()
+
+    def test_next_batch_timeout(self):
+        "Check that a batch with no events is empty rather than raising"
+        watcher = self.connection.Win32_LogicalDisk.watch_for(
+            notification_type="Creation",
+            DeviceID="***"
+        )
+        self.assertEqual(watcher.next_batch(max_events=10, max_wait_ms=500), [])
+
+    def test_lazy(self):
+        "Check that a lazy watcher decodes the type, timestamp and fields of its events"
+        try:
+            new_letter = self.new_letter()
+        except KeyError:
+            warnings.warn("Unable to find a spare drive letter to map.")
+            return
+
+        watcher = self.connection.Win32_LogicalDisk.watch_for(
+            notification_type="Creation",
+            lazy=True,
+            DeviceID=new_letter
+        )
+        t = threading.Timer(2, self.create,(new_letter,))
+        t.start()
+        found_disk = watcher(timeout_ms=20000)
+        self.assert_(isinstance(found_disk, wmi._wmi_lazy_event))
+        self.assertEqual(found_disk.event_type, "creation")
+        self.assert_(isinstance(found_disk.timestamp, datetime.datetime))
+        self.assertEqual(found_disk.DeviceID, new_letter)
+        self.assert_(found_disk.previous is None)
+        self.assert_(isinstance(found_disk.event, wmi._wmi_event))
+        t.join()
+
+    def test_aggregate(self):
+        "Check that grouped events arrive as a representative with a count"
+        try:
+            new_letter = self.new_letter()
+        except KeyError:
+            warnings.warn("Unable to find a spare drive letter to map.")
+            return
+
+        watcher = self.connection.Win32_LogicalDisk.watch_for(
+            notification_type="Creation",
+            group_within=5,
+            group_by=["DeviceID"],
+            having=0,
+            DeviceID=new_letter
+        )
+        t = threading.Timer(2, self.create,(new_letter,))
+        t.start()
+        found_disk = watcher(timeout_ms=20000)
+        self.assert_(isinstance(found_disk, wmi._wmi_object))
+        self.assertEqual(found_disk.Caption, new_letter)
+        self.assertEqual(found_disk.count, 1)
+        t.join()
+
+    def test_adaptive(self):
+        "Check that an adaptive watcher delivers events and reports its interval"
+        try:
+            new_letter = self.new_letter()
+        except KeyError:
+            warnings.warn("Unable to find a spare drive letter to map.")
+            return
+
+        watcher = self.connection.watch_for_adaptive(
+            notification_type="Creation",
+            wmi_class="Win32_LogicalDisk",
+            min_delay_secs=1,
+            max_delay_secs=8,
+            DeviceID=new_letter
+        )
+        t = threading.Timer(2, self.create,(new_letter,))
+        t.start()
+        found_disk = watcher(timeout_ms=20000)
+        self.assertEqual(found_disk.Caption, new_letter)
+        metrics = watcher.metrics()
+        self.assertEqual(metrics["events"], 1)
+        self.assert_(1 <= metrics["interval_secs"] <= 8)
+        t.join()
+
+    def test_adaptive_extrinsic(self):
+        self.assertRaises(
+            wmi.x_wmi,
+            self.connection.watch_for_adaptive,
+            notification_type="Creation",
+            wmi_class="Win32_VolumeChangeEvent"
+        )
+
+    def test_record_and_replay(self):
+        "Check that recorded events are played back with their values"
+        try:
+            new_letter = self.new_letter()
+        except KeyError:
+            warnings.warn("Unable to find a spare drive letter to map.")
+            return
+
+        watcher = self.connection.Win32_LogicalDisk.watch_for(
+            notification_type="Creation",
+            DeviceID=new_letter
+        )
+        handle, path = tempfile.mkstemp(suffix=".jsonl.gz")
+        os.close(handle)
+        try:
+            t = threading.Timer(2, self.create,(new_letter,))
+            t.start()
+            with watcher.record(path) as recorder:
+                found_disk = recorder(timeout_ms=20000)
+            t.join()
+            self.assertEqual(recorder.recorded, 1)
+
+            with wmi.replay(path, speed=None) as replayer:
+                replayed_disk = replayer(timeout_ms=0)
+                self.assertEqual(replayed_disk.event_type, "creation")
+                self.assertEqual(replayed_disk.Caption, found_disk.Caption)
+                self.assertEqual(replayed_disk.timestamp, found_disk.timestamp)
+                self.assertRaises(wmi.x_wmi_timed_out, replayer, timeout_ms=0)
+                self.assert_(replayer.exhausted)
+        finally:
+            os.remove(path)
+
+    def test_pump(self):
+        "Check that a pump delivers events from its own thread"
+        try:
+            new_letter = self.new_letter()
+        except KeyError:
+            warnings.warn("Unable to find a spare drive letter to map.")
+            return
+
+        watcher = self.connection.Win32_LogicalDisk.watch_for(
+            notification_type="Creation",
+            DeviceID=new_letter
+        )
+        with watcher.pump(maxsize=10) as events:
+            t = threading.Timer(2, self.create,(new_letter,))
+            t.start()
+            found_disk = events.get(timeout_ms=20000)
+            self.assertEqual(found_disk.Caption, new_letter)
+            self.assertEqual(events.stats()["delivered"], 1)
+            self.assertEqual(events.stats()["dropped"], 0)
+            t.join()
+
+    def test_pump_close_wakes_waiter(self):
+        "Check that closing a pump wakes a consumer waiting without a timeout"
+        watcher = self.connection.Win32_LogicalDisk.watch_for(
+            notification_type="Creation",
+            DeviceID="***"
+        )
+        events = watcher.pump()
+        t = threading.Timer(1, events.close)
+        t.start()
+        self.assertRaises(wmi.x_wmi, events.get)
+        self.assertEqual(list(events), [])
+        t.join()
+
+    def test_pump_invalid_overflow(self):
+        watcher = self.connection.Win32_LogicalDisk.watch_for()
+        self.assertRaises(wmi.x_wmi, watcher.pump, overflow="***")
+
+    def test_coalesced(self):
+        "Check that a coalescing watcher marks its events with the merge count and changes"
+        try:
+            new_letter = self.new_letter()
+        except KeyError:
+            warnings.warn("Unable to find a spare drive letter to map.")
+            return
+
+        watcher = self.connection.Win32_LogicalDisk.watch_for(
+            notification_type="Creation",
+            DeviceID=new_letter
+        ).coalesced(window_ms=1000)
+        t = threading.Timer(2, self.create,(new_letter,))
+        t.start()
+        found_disk = watcher(timeout_ms=20000)
+        self.assertEqual(found_disk.Caption, new_letter)
+        self.assertEqual(found_disk.coalesced, 1)
+        self.assertEqual(found_disk.changed, [])
+        t.join()
+
+    def test_coalesced_timeout(self):
+        watcher = self.connection.Win32_LogicalDisk.watch_for(
+            notification_type="Modification",
+            DeviceID="***"
+        ).coalesced()
+        self.assertRaises(wmi.x_wmi_timed_out, watcher, 500)
+
+    def test_multiplex(self):
+        "Check that events from several watchers come through one multiplexer"
+        try:
+            new_letter = self.new_letter()
+        except KeyError:
+            warnings.warn("Unable to find a spare drive letter to map.")
+            return
+
+        creation = self.connection.Win32_LogicalDisk.watch_for(
+            notification_type="Creation",
+            DeviceID=new_letter
+        )
+        deletion = self.connection.Win32_LogicalDisk.watch_for(
+            notification_type="Deletion",
+            DeviceID=new_letter
+        )
+        with wmi.multiplex(creation, deletion) as events:
+            t = threading.Timer(2, self.create,(new_letter,))
+            t.start()
+            watcher, found_disk = events.next(timeout_ms=20000)
+            self.assert_(watcher is creation)
+            self.assertEqual(found_disk.Caption, new_letter)
+            watcher, found_disk = events.next(timeout_ms=20000)
+            self.assert_(watcher is deletion)
+            t.join()
+
+    def test_multiplex_timeout(self):
+        "Check that a multiplexer with no events times out"
+        watcher = self.connection.Win32_LogicalDisk.watch_for(
+            notification_type="Creation",
+            DeviceID="***"
+        )
+        with wmi.multiplex(watcher) as events:
+            self.assertRaises(wmi.x_wmi_timed_out, events.next, 500)
+
+    def test_sink_thread_survives_errors(self):
+        "Check that an error in work handed to the sink thread doesn't stop it"
+        sink_thread = wmi._get_sink_thread()
+        done = threading.Event()
+        def fail():
+            raise RuntimeError("Event loop is closed")
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            sink_thread.call(fail)
+            sink_thread.call(done.set)
+            done.wait(5)
+        self.assert_(done.is_set())
+        self.assert_(caught)
+        self.assert_(wmi._get_sink_thread() is sink_thread)
+
+    def test_watch_for_async(self):
+        "Check that an asynchronous watcher delivers events to the event loop"
+        try:
+            import asyncio
+        except ImportError:
+            warnings.warn("Skipping test_watch_for_async because there's no asyncio")
+            return
+        try:
+            new_letter = self.new_letter()
+        except KeyError:
+            warnings.warn("Unable to find a spare drive letter to map.")
+            return
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            watcher = self.connection.Win32_LogicalDisk.watch_for_async(
+                notification_type="Creation",
+                DeviceID=new_letter,
+                timeout=20
+            )
+            t = threading.Timer(2, self.create,(new_letter,))
+            t.start()
+            found_disk = loop.run_until_complete(watcher.__anext__())
+            self.assertEqual(found_disk.Caption, new_letter)
+            loop.run_until_complete(watcher.aclose())
+            t.join()
+        finally:
+            loop.close()
+
+    def test_watch_for_async_timeout(self):
+        "Check that an asynchronous watcher raises an asyncio timeout and carries on"
+        try:
+            import asyncio
+        except ImportError:
+            warnings.warn("Skipping test_watch_for_async_timeout because there's no asyncio")
+            return
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            watcher = self.connection.Win32_LogicalDisk.watch_for_async(
+                notification_type="Creation",
+                DeviceID="***",
+                timeout=0.5
+            )
+            self.assertRaises(asyncio.TimeoutError, loop.run_until_complete, watcher.__anext__())
+            self.assertFalse(watcher._closed)
+            loop.run_until_complete(watcher.aclose())
+            self.assert_(watcher._closed)
+        finally:
+            loop.close()
+
     def test_valid_notification_types(self):
         for notification_type in ['operation', 'modification', 'creation', 'deletion']:
             self.assert_(self.connection.Win32_LogicalDisk.watch_for(notification_type=notification_type))
@@ -500,6 +1207,35 @@ class TestWatcher(TestWMI):
     def test_invalid_notification_types(self):
         self.assertRaises(wmi.x_wmi, self.connection.Win32_LogicalDisk.watch_for, notification_type="***")
 
+    def test_compact_intrinsic(self):
+        "Check that compact events are refused for intrinsic events"
+        self.assertRaises(wmi.x_wmi, self.connection.Win32_LogicalDisk.watch_for, compact=True)
+
+    def test_compact_next_batch(self):
+        "Check that a compact watcher's batch holds tuples of the fields asked for"
+        def _create(queue):
+            queue.put(subprocess.Popen([sys.executable, "-c", "import time; time.sleep(10)"]))
+
+        watcher = self.connection.Win32_ProcessStartTrace.watch_for(
+            fields=["ProcessName", "ProcessID"],
+            compact=True
+        )
+        q = Queue.Queue()
+        t = threading.Timer(2, _create,(q,))
+        try:
+            t.start()
+            spawned_process = q.get(timeout=20)
+            found_pids = []
+            while spawned_process.pid not in found_pids:
+                found_processes = watcher.next_batch(max_events=100, max_wait_ms=20000)
+                self.assert_(found_processes)
+                for found_process in found_processes:
+                    self.assert_(isinstance(found_process, tuple))
+                    self.assertEqual(found_process._fields, ("ProcessName", "ProcessID"))
+                    found_pids.append(int(found_process.ProcessID))
+        finally:
+            t.cancel()
+
 
     def do_not_test_extrinsic_event(self):
 
@@ -608,6 +1344,45 @@ class TestMethods(TestWMI):
             result, = p.Terminate()
         self.assertEqual(result, 0)
 
+    def test_call_leaves_parameters_unchanged(self):
+        "Check that each call fills in its own copy of the in parameters"
+        create = self.connection.Win32_Process.Create
+        create(
+            CommandLine=sys.executable + " -c pass",
+            ProcessStartupInformation=self.connection.Win32_ProcessStartup.new(ShowWindow=0)
+        )
+        self.assert_(create.in_parameters.Properties_("CommandLine").Value is None)
+
+    def test_call_many(self):
+        "Check that a method can be called on many instances at once"
+        handles = []
+        for i in range(3):
+            handle, _ = self.connection.Win32_Process.Create(
+                CommandLine=sys.executable,
+                ProcessStartupInformation=self.connection.Win32_ProcessStartup.new(ShowWindow=0)
+            )
+            handles.append(handle)
+        processes = [p for handle in handles for p in self.connection.Win32_Process(Handle=handle)]
+        progress = []
+        results = wmi.call_many(
+            processes, "Terminate",
+            max_per_host=2,
+            progress=lambda n_finished, n_objects, process, result: progress.append(n_finished),
+            Reason=0
+        )
+        self.assertEqual([p for p, result in results], processes)
+        self.assertEqual([result for p, result in results], [(0,)] * len(processes))
+        self.assertEqual(progress, list(range(1, 1 + len(processes))))
+
+    def test_call_many_no_params(self):
+        "Check that a method with no parameters can be called on many instances at once"
+        processes = self.connection.Win32_Process(ProcessId=os.getpid())
+        results = wmi.call_many(processes * 2, "GetOwner")
+        self.assertEqual([result for p, result in results], [processes[0].GetOwner()] * 2)
+
+    def test_call_many_invalid_param(self):
+        self.assertRaises(AttributeError, wmi.call_many, self.logical_disks, "Reset", Bogus=1)
+
 class TestProperties(TestWMI):
 
     def test_access(self):
@@ -650,6 +1425,46 @@ class TestProperties(TestWMI):
             for envvar in self.connection.Win32_Environment(Name=name, UserName=username):
                 envvar.VariableValue = None
 
+    def test_deferred_writes(self):
+        "Check that writes in a batch are held back until it ends"
+        names = [str(time.time()).split(".")[0] + str(i) for i in range(3)]
+        username = win32api.GetUserNameEx(win32con.NameSamCompatible)
+        with wmi.deferred_writes(mode="create-only") as batch:
+            for name in names:
+                self.connection.Win32_Environment.new(Name=name, UserName=username, VariableValue="***").put()
+            self.assertEqual(len(batch), len(names))
+            self.assert_(not self.connection.Win32_Environment(Name=names[0], UserName=username))
+        try:
+            envvars = [e for name in names for e in self.connection.Win32_Environment(Name=name, UserName=username)]
+            self.assertEqual([e.VariableValue for e in envvars], ["***"] * len(names))
+            with wmi.deferred_writes(mode="update-only"):
+                for envvar in envvars:
+                    envvar.VariableValue = "!!!"
+                    envvar.VariableValue = "!!!!"
+            for name in names:
+                for envvar in self.connection.Win32_Environment(Name=name, UserName=username):
+                    self.assertEqual(envvar.VariableValue, "!!!!")
+        finally:
+            for name in names:
+                for envvar in self.connection.Win32_Environment(Name=name, UserName=username):
+                    envvar.Delete_()
+
+    def test_deferred_writes_failure(self):
+        "Check that objects which can't be written are reported together"
+        username = win32api.GetUserNameEx(win32con.NameSamCompatible)
+        name = str(time.time()).split(".")[0]
+        envvar = self.connection.Win32_Environment.new(Name=name, UserName=username, VariableValue="***")
+        try:
+            with wmi.deferred_writes(mode="update-only"):
+                envvar.put()
+        except wmi.x_wmi_write_failed:
+            self.assertEqual([o for o, error in sys.exc_info()[1].failures], [envvar])
+        else:
+            self.fail("Updating a new object did not fail")
+
+    def test_deferred_writes_invalid_mode(self):
+        self.assertRaises(wmi.x_wmi, wmi.deferred_writes, mode="***")
+
 class TestInstances(TestWMI):
 
     def test_hashable(self):
@@ -706,6 +1521,23 @@ class TestInstances(TestWMI):
         self.assertEqual(self.connection.Win32_LogicalDisk.keys, ['DeviceID'])
         self.assertEqual(next(iter(self.logical_disks)).keys, ['DeviceID'])
 
+    def test_keys_found_once(self):
+        "Check that the keys of a class are found once and shared by its instances"
+        disks = self.connection.instances("Win32_LogicalDisk")
+        self.assertEqual([d.keys for d in disks], [['DeviceID']] * len(disks))
+        self.assert_(('DeviceID',) in wmi._keys_registry.values())
+
+    def test_keys_registry_bounded(self):
+        "Check that the keys registry only holds the most recently used classes"
+        size = wmi._KEYS_REGISTRY_SIZE
+        wmi._KEYS_REGISTRY_SIZE = 1
+        try:
+            wmi._class_keys(self.connection.Win32_LogicalDisk.ole_object)
+            wmi._class_keys(self.connection.Win32_Process.ole_object)
+            self.assertEqual(list(wmi._keys_registry.values()), [('Handle',)])
+        finally:
+            wmi._KEYS_REGISTRY_SIZE = size
+
 class TestInstanceCreation(TestWMI):
 
     def test_create_instance(self):
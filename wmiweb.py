@@ -105,7 +105,7 @@ def doc_wmi_class(computer, namespace, wmi_class, wmi_connection):
 
     doc.append("<hr>")
     doc.append("<h3>Children</h3>")
-    children = sorted(c.Path_.Class for c in klass._namespace.SubclassesOf(wmi_class))
+    children = sorted(wmi_connection.subclasses_of(wmi_class))
     if children:
         doc.append('<ul>')
         for child in children: